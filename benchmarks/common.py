@@ -0,0 +1,70 @@
+import os
+import sys
+import json
+import time
+import subprocess
+from jobq.json5 import json5_load
+from jobq.fileutils import AbsPath
+
+packagedir = AbsPath(os.path.dirname(os.path.abspath(__file__))).parent()/'jobq'
+
+def build_config(program='gaussian', scheduler='slurm', scratch='/tmp/&user', **extra):
+# Assemble a wrapper config the same way jobq-config setup does
+    config = dict(
+        load = [],
+        source = [],
+        export = {},
+        versions = {'bench': {'executable': '/bin/true'}},
+        defaults = {'scratch': scratch, 'version': 'bench'},
+        conflicts = {},
+        optargs = [],
+        posargs = [],
+        filekeys = {},
+        filevars = {},
+        fileopts = {},
+        inputfiles = [],
+        outputfiles = [],
+        ignorederrors = [],
+        errorclasses = {},
+        transienterrors = [],
+        eventsinks = [],
+        parameteropts = [],
+        parameterpaths = [],
+        interpolable = [],
+        interpolopts = [],
+        prescript = [],
+        postscript = [],
+        onscript = [],
+        offscript = [],
+        progname = program,
+        displayname = program,
+        clustername = 'bench',
+        filesync = 'local',
+        logdir = '/tmp',
+        delay = '0',
+        progspecfile = f'{program}.json',
+        queuespecfile = f'{scheduler}.json',
+    )
+    config.update(json5_load(packagedir/'specfiles'/'schedulers'/config['queuespecfile']))
+    config.update(json5_load(packagedir/'specfiles'/'packages'/config['progspecfile']))
+    config.update(extra)
+    return config
+
+def write_wrapper(path, config):
+# Write an executable wrapper like the ones installed by jobq-config setup
+    with open(path, 'w') as f:
+        f.write(f'#!{sys.executable}\n')
+        f.write('import sys\n')
+        f.write('from jobq import main\n')
+        f.write('main.submit_jobs(\n')
+        f.write(f"r'''{json.dumps(config)}'''\n")
+        f.write(')\n')
+    os.chmod(path, 0o755)
+
+def run_measured(arglist, env=None, stdin=None):
+# Run a command and return its exit status, wall time and peak RSS in KiB
+    start = time.perf_counter()
+    process = subprocess.Popen(arglist, env=env, stdin=stdin, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, time.perf_counter() - start, rusage.ru_maxrss
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# Compare two result files written by submit.py
+#
+# Exits with status 1 when the throughput of any scenario drops, or its
+# peak RSS grows, by more than the given threshold.
+import sys
+import json
+from argparse import ArgumentParser
+
+parser = ArgumentParser(description='Compara los resultados de dos ejecuciones de submit.py.')
+parser.add_argument('baseline', metavar='BASELINE')
+parser.add_argument('current', metavar='CURRENT')
+parser.add_argument('--threshold', type=float, default=10.0, help='Cambio porcentual tolerado.')
+args = parser.parse_args()
+
+def load(path):
+    with open(path, 'r') as f:
+        return {(i['scenario'], i['scheduler']): i for i in map(json.loads, f) if i}
+
+baseline = load(args.baseline)
+current = load(args.current)
+regressions = 0
+
+print('{:<24} {:<8} {:>12} {:>12} {:>8} {:>12} {:>12} {:>8}'.format('SCENARIO', 'SCHED', 'JOBS/S OLD', 'JOBS/S NEW', 'CHANGE', 'RSS OLD', 'RSS NEW', 'CHANGE'))
+for key in sorted(baseline.keys() & current.keys()):
+    old, new = baseline[key], current[key]
+    speed = 100*(new['jobs_per_second']/old['jobs_per_second'] - 1) if old['jobs_per_second'] else 0
+    memory = 100*(new['maxrss_kib']/old['maxrss_kib'] - 1) if old['maxrss_kib'] else 0
+    flag = ''
+    if speed < -args.threshold or memory > args.threshold:
+        flag = ' !'
+        regressions += 1
+    print('{:<24} {:<8} {:>12} {:>12} {:>+7.1f}% {:>12} {:>12} {:>+7.1f}%{}'.format(key[0], key[1], old['jobs_per_second'], new['jobs_per_second'], speed, old['maxrss_kib'], new['maxrss_kib'], memory, flag))
+
+sys.exit(1 if regressions else 0)
@@ -0,0 +1,169 @@
+# Stand-ins for the scheduler commands and for ssh/rsync
+#
+# The scheduler fakes are plain bash so that their startup cost stays well
+# below the latency of a real scheduler. Their behavior is controlled by
+# environment variables:
+#
+#   JOBQ_FAKE_LATENCY   seconds to sleep in every command (default 0)
+#   JOBQ_FAKE_FAILURES  per mille of submissions that fail (default 0)
+#   JOBQ_FAKE_STATE     state reported by the status commands, an empty
+#                       value means that the job already left the queue
+#
+# The webhook stand-in appends the body of every POST to a file.
+#
+# Submitted scripts are not kept, only a counter of job ids and the
+# arguments of every cancel command in the directory given by JOBQ_FAKE_DIR.
+import os
+import sys
+
+header = '''#!/bin/bash
+[[ ${JOBQ_FAKE_LATENCY:-0} != 0 ]] && sleep "$JOBQ_FAKE_LATENCY"
+nextid() {
+    exec 9>>"$JOBQ_FAKE_DIR/lock"
+    flock 9
+    local n=$(( $(cat "$JOBQ_FAKE_DIR/counter" 2>/dev/null || echo 1000) + 1 ))
+    echo $n > "$JOBQ_FAKE_DIR/counter"
+    exec 9>&-
+    echo $n
+}
+failing() { (( RANDOM % 1000 < ${JOBQ_FAKE_FAILURES:-0} )); }
+'''
+
+fakes = dict(
+    sbatch = '''
+script=$(cat)
+if failing; then
+    echo "sbatch: error: Batch job submission failed: Socket timed out on send/recv operation" >&2
+    exit 1
+fi
+echo "Submitted batch job $(nextid)"
+''',
+    squeue = '''
+jobid=${@: -1}
+if [[ -z $JOBQ_FAKE_STATE ]]; then
+    echo "slurm_load_jobs error: Invalid job id specified" >&2
+    exit 1
+fi
+echo "$JOBQ_FAKE_STATE"
+''',
+    scancel = '''
+echo "$@" >> "$JOBQ_FAKE_DIR/cancelled"
+''',
+    bsub = '''
+script=$(cat)
+if failing; then
+    echo "LSF is down. Please wait ..." >&2
+    exit 255
+fi
+echo "Job <$(nextid)> is submitted to default queue <normal>."
+''',
+    bjobs = '''
+jobid=${@: -1}
+if [[ -z $JOBQ_FAKE_STATE ]]; then
+    echo "Job <$jobid> is not found" >&2
+    exit 255
+fi
+echo "$JOBQ_FAKE_STATE"
+''',
+    bkill = '''
+echo "$@" >> "$JOBQ_FAKE_DIR/cancelled"
+''',
+    qsub = '''
+script=$(cat)
+if failing; then
+    echo "qsub: cannot connect to server fakeserver (errno=111) Connection refused" >&2
+    exit 111
+fi
+if [[ $script == *"#PBS -t "* ]]; then
+    echo "$(nextid)[].fakeserver"
+else
+    echo "$(nextid).fakeserver"
+fi
+''',
+    qstat = '''
+jobid=${@: -1}
+if [[ -z $JOBQ_FAKE_STATE ]]; then
+    echo "qstat: Unknown Job Id Error $jobid.fakeserver" >&2
+    exit 153
+fi
+echo "<Data><Job><Job_Id>$jobid.fakeserver</Job_Id><job_state>$JOBQ_FAKE_STATE</job_state></Job></Data>"
+''',
+    qdel = '''
+echo "$@" >> "$JOBQ_FAKE_DIR/cancelled"
+''',
+)
+
+# The remote host is the local machine: ssh runs its command with bash and
+# rsync copies the files with the relative paths that -R would preserve
+ssh = '''#!/bin/bash
+while [[ $1 == -* ]]; do
+    case $1 in
+        -[SoeilpFJ]) shift 2 ;;
+        *) shift ;;
+    esac
+done
+shift
+exec bash -c "$*"
+'''
+
+rsync = f'''#!{sys.executable}
+import os
+import sys
+import shutil
+args = sys.argv[1:]
+sources = []
+dirsonly = False
+while args:
+    arg = args.pop(0)
+    if arg in ('-e', '--rsh'):
+        args.pop(0)
+    elif arg in ('-f', '--filter'):
+        dirsonly = args.pop(0) == '-! */'
+    elif not arg.startswith('-'):
+        sources.append(arg)
+dest = sources.pop().split(':', 1)[-1]
+for source in sources:
+    relpath = source.split('/./', 1)[-1]
+    target = os.path.join(dest, relpath)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    if not dirsonly:
+        shutil.copy2(source, target)
+'''
+
+# Stand-in for a webhook receiver: appends the body of every POST to a file
+webhook = f'''#!{sys.executable}
+import sys
+from http.server import HTTPServer, BaseHTTPRequestHandler
+class Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        with open(sys.argv[2], 'ab') as f:
+            f.write(body + b'\\n')
+        self.send_response(204)
+        self.end_headers()
+    def log_message(self, *args):
+        pass
+HTTPServer(('127.0.0.1', int(sys.argv[1])), Handler).serve_forever()
+'''
+
+def install_fakes(bindir, remote=False):
+# Write the fake scheduler commands (and the remote shims) into bindir
+    os.makedirs(bindir, exist_ok=True)
+    scripts = {name: header + body for name, body in fakes.items()}
+    scripts.update(webhook=webhook)
+    if remote:
+        scripts.update(ssh=ssh, rsync=rsync)
+    for name, contents in scripts.items():
+        path = os.path.join(bindir, name)
+        with open(path, 'w') as f:
+            f.write(contents)
+        os.chmod(path, 0o755)
+
+def fake_env(bindir, statedir, **settings):
+# Environment that puts the fakes first in PATH
+    env = dict(os.environ)
+    env['PATH'] = os.pathsep.join([bindir, env.get('PATH', '')])
+    env['JOBQ_FAKE_DIR'] = statedir
+    for key, value in settings.items():
+        env[f'JOBQ_FAKE_{key.upper()}'] = str(value)
+    return env
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# Peak RSS of a dry run driven by manifests of increasing size
+#
+# Most manifest entries do not match the filter, so they exercise the
+# streaming reader and the filter without touching the filesystem, while a
+# fixed number of real inputs go through the whole staging path.
+import os
+import sys
+import json
+import shutil
+import tempfile
+from argparse import ArgumentParser
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import build_config, write_wrapper, run_measured
+
+parser = ArgumentParser(description='Benchmark de memoria para --from-file.')
+parser.add_argument('--sizes', type=int, nargs='+', default=[10**4, 10**5, 10**6])
+parser.add_argument('--jobs', type=int, default=100)
+parser.add_argument('--null', action='store_true', help='Separar las entradas con caracteres nulos.')
+args = parser.parse_args()
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    env = dict(os.environ, HOME=tmpdir)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.dirname(os.path.abspath(__file__))), env.get('PYTHONPATH')]))
+    wrapper = os.path.join(tmpdir, 'gaussian')
+    write_wrapper(wrapper, build_config(scratch=os.path.join(tmpdir, 'scratch')))
+    inputdir = os.path.join(tmpdir, 'inputs')
+    os.mkdir(inputdir)
+    for i in range(args.jobs):
+        with open(os.path.join(inputdir, f'job{i}.gjf'), 'w') as f:
+            f.write('#p hf/sto-3g\n\nbench\n\n0 1\nH 0 0 0\nH 0 0 0.74\n\n')
+    separator = '\0' if args.null else '\n'
+    results = []
+    for size in args.sizes:
+        manifest = os.path.join(tmpdir, f'manifest{size}')
+        with open(manifest, 'w') as f:
+            for i in range(size - args.jobs):
+                f.write(f'{inputdir}/skip{i}.gjf{separator}')
+            for i in range(args.jobs):
+                f.write(f'{inputdir}/job{i}.gjf{separator}')
+        for i in range(args.jobs):
+            shutil.rmtree(os.path.join(inputdir, f'job{i}'), ignore_errors=True)
+        status, walltime, maxrss = run_measured([sys.executable, wrapper, '--dry-run', '--yes', '--filter', 'job[0-9]+', '--from-file', manifest], env=env)
+        results.append(dict(entries=size, jobs=args.jobs, status=status, seconds=round(walltime, 3), maxrss_kib=maxrss))
+        os.remove(manifest)
+    for result in results:
+        print(json.dumps(result))
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# End to end submission benchmark against fake scheduler commands
+#
+# Every scenario runs a freshly written wrapper in its own HOME, with the
+# fake sbatch/squeue/bsub/bjobs/qsub/qstat first in PATH, and reports jobs
+# per second, peak RSS and the per-phase totals recorded by --trace. The
+# results are printed as JSON lines that compare.py can diff between
+# versions.
+import os
+import sys
+import json
+import platform
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import build_config, write_wrapper, run_measured
+from fakes import install_fakes, fake_env
+
+repodir = sys.path[0]
+
+parser = ArgumentParser(description='Benchmark de envío de trabajos de principio a fin.')
+parser.add_argument('--scenarios', nargs='+', default=['inputs', 'trajectory', 'parameters', 'remote'])
+parser.add_argument('--schedulers', nargs='+', default=['slurm'], choices=['slurm', 'lsf', 'lava', 'torque'])
+parser.add_argument('--sizes', type=int, nargs='+', default=[1, 100, 10000])
+parser.add_argument('--frames', type=int, default=1000)
+parser.add_argument('--sets', type=int, default=10)
+parser.add_argument('--remote-jobs', type=int, default=10)
+parser.add_argument('--latency', type=float, default=0.0, help='Latencia de los comandos del gestor de trabajos en segundos.')
+parser.add_argument('--failures', type=int, default=0, help='Envíos fallidos por cada mil.')
+parser.add_argument('--output', metavar='PATH', help='Escribir los resultados en PATH en vez de la salida estándar.')
+args = parser.parse_args()
+
+gjf = '#p hf/sto-3g\n\nbench\n\n0 1\nH 0 0 0\nH 0 0 0.74\n\n'
+hsd = 'Geometry = GenFormat {\n<<< "geo.gen"\n}\nHamiltonian = DFTB {\n}\n'
+
+def version():
+    try:
+        return subprocess.check_output(['git', '-C', repodir, 'describe', '--always', '--dirty'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def write_inputs(directory, count, name='job', ext='gjf', contents=gjf):
+    os.makedirs(directory, exist_ok=True)
+    for i in range(count):
+        with open(os.path.join(directory, f'{name}{i}.{ext}'), 'w') as f:
+            f.write(contents)
+    return [os.path.join(directory, f'{name}{i}.{ext}') for i in range(count)]
+
+def write_trajectory(path, frames):
+    with open(path, 'w') as f:
+        for i in range(frames):
+            f.write(f'3\nframe {i}\nO 0.0 0.0 {0.001*i:.4f}\nH 0.0 0.757 0.587\nH 0.0 -0.757 0.587\n')
+
+def run_scenario(name, scheduler, tmpdir, config, arglist, inputs, remote=False):
+    home = os.path.join(tmpdir, 'home')
+    bindir = os.path.join(tmpdir, 'bin')
+    statedir = os.path.join(tmpdir, 'state')
+    os.makedirs(home, exist_ok=True)
+    os.makedirs(statedir, exist_ok=True)
+    install_fakes(bindir, remote=remote)
+    write_wrapper(os.path.join(bindir, config['progname']), config)
+    env = fake_env(bindir, statedir, latency=args.latency, failures=args.failures)
+    env['HOME'] = home
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [repodir, env.get('PYTHONPATH')]))
+    env['CLUSTERQ_REMOTE_ROOT'] = os.path.join(tmpdir, 'remote')
+    tracefile = os.path.join(tmpdir, 'trace.jsonl')
+    # Long argument lists go through a manifest to stay below ARG_MAX
+    manifest = os.path.join(tmpdir, 'manifest')
+    with open(manifest, 'w') as f:
+        f.write('\0'.join(inputs))
+    wrapper = os.path.join(bindir, config['progname'])
+    status, seconds, maxrss = run_measured([sys.executable, wrapper, '--yes', '--trace', tracefile, '--from-file', manifest] + arglist, env=env)
+    try:
+        with open(os.path.join(statedir, 'counter'), 'r') as f:
+            submissions = int(f.read()) - 1000
+    except FileNotFoundError:
+        submissions = 0
+    jobs = 0
+    summary = {'phases': {}, 'counts': {}, 'counters': {}}
+    try:
+        with open(tracefile, 'r') as f:
+            for line in f:
+                record = json.loads(line)
+                if 'job' in record:
+                    jobs += 1
+                else:
+                    summary = record
+    except FileNotFoundError:
+        pass
+    return dict(
+        scenario = name,
+        scheduler = scheduler,
+        version = version(),
+        python = platform.python_version(),
+        latency = args.latency,
+        failures = args.failures,
+        status = status,
+        jobs = jobs,
+        submissions = submissions,
+        seconds = round(seconds, 4),
+        jobs_per_second = round(jobs/seconds, 2) if seconds else None,
+        maxrss_kib = maxrss,
+        phases_ms = {key: round(1e3*value, 3) for key, value in summary['phases'].items()},
+        phase_counts = summary['counts'],
+        counters = summary['counters'],
+    )
+
+results = []
+
+for scheduler in args.schedulers:
+    if 'inputs' in args.scenarios:
+        for size in args.sizes:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                config = build_config(scheduler=scheduler, scratch=os.path.join(tmpdir, 'scratch'))
+                inputs = write_inputs(os.path.join(tmpdir, 'inputs'), size)
+                results.append(run_scenario(f'inputs-{size}', scheduler, tmpdir, config, [], inputs))
+    if 'trajectory' in args.scenarios:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = build_config(scheduler=scheduler, scratch=os.path.join(tmpdir, 'scratch'))
+            inputs = write_inputs(os.path.join(tmpdir, 'inputs'), 1, contents=gjf.replace('H 0 0 0\nH 0 0 0.74', '$mol1'))
+            trajectory = os.path.join(tmpdir, 'traj.xyz')
+            write_trajectory(trajectory, args.frames)
+            results.append(run_scenario(f'trajectory-{args.frames}', scheduler, tmpdir, config, ['-M', trajectory, '--fan-out'], inputs))
+    if 'parameters' in args.scenarios:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            setnames = [f'set{i}' for i in range(args.sets)]
+            for setname in setnames:
+                os.makedirs(os.path.join(tmpdir, 'slako', setname))
+                with open(os.path.join(tmpdir, 'slako', setname, 'H-H.skf'), 'w') as f:
+                    f.write('0.02 500\n')
+            config = build_config(program='dftbplus', scheduler=scheduler, scratch=os.path.join(tmpdir, 'scratch'), parameterpaths=[os.path.join(tmpdir, 'slako', '${slako}')])
+            inputs = write_inputs(os.path.join(tmpdir, 'inputs'), 10, ext='dftb_in.hsd', contents=hsd)
+            results.append(run_scenario(f'parameters-{args.sets}x10', scheduler, tmpdir, config, ['--sweep', '--slako', ','.join(setnames)], inputs))
+    if 'remote' in args.scenarios:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = build_config(scheduler=scheduler, scratch=os.path.join(tmpdir, 'scratch'))
+            inputs = write_inputs(os.path.join(tmpdir, 'home', 'inputs'), args.remote_jobs)
+            results.append(run_scenario(f'remote-{args.remote_jobs}', scheduler, tmpdir, config, ['-R', 'localhost'], inputs, remote=True))
+
+with open(args.output, 'w') if args.output else sys.stdout as f:
+    for result in results:
+        f.write(json.dumps(result) + '\n')
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# Peak RSS of streaming a synthetic XYZ trajectory through readmol and molblock
+import os
+import sys
+import json
+import random
+import tempfile
+from argparse import ArgumentParser
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import run_measured
+
+parser = ArgumentParser(description='Benchmark de memoria para la lectura de trayectorias.')
+parser.add_argument('--frames', type=int, nargs='+', default=[1000, 10000, 100000])
+parser.add_argument('--atoms', type=int, default=300)
+parser.add_argument('--format', default='gaussian.json', help='Especificación del programa para molblock.')
+args = parser.parse_args()
+
+reader = '''
+import sys
+from jobq.fileutils import AbsPath
+from jobq.readmol import readmol, molblock
+for coords in readmol(AbsPath(sys.argv[1])):
+    molblock(coords, sys.argv[2])
+'''
+
+def write_trajectory(path, nframe, natom):
+    elements = [random.choice('HCNO') for i in range(natom)]
+    with open(path, 'w') as f:
+        for i in range(nframe):
+            f.write(f'{natom}\nframe {i}\n')
+            f.writelines(f'{e}  {random.uniform(-9, 9):.6f}  {random.uniform(-9, 9):.6f}  {random.uniform(-9, 9):.6f}\n' for e in elements)
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.dirname(os.path.abspath(__file__))), env.get('PYTHONPATH')]))
+    for nframe in args.frames:
+        trajectory = os.path.join(tmpdir, 'trajectory.xyz')
+        write_trajectory(trajectory, nframe, args.atoms)
+        status, walltime, maxrss = run_measured([sys.executable, '-c', reader, trajectory, args.format], env=env)
+        print(json.dumps(dict(frames=nframe, atoms=args.atoms, bytes=os.path.getsize(trajectory), status=status, seconds=round(walltime, 3), maxrss_kib=maxrss)))
+        os.remove(trajectory)
@@ -1,6 +1,10 @@
 import os
-from argparse import ArgumentParser, Action, SUPPRESS
-from .utils import option
+from argparse import ArgumentParser, ArgumentTypeError, Action, SUPPRESS
+from clinterface import messages, _
+from .shared import config, names, paths
+from .utils import ConfigTemplate, LogDict, GlobDict, option, print_tree
+from .fileutils import AbsPath
+from .routing import policies
 
 class ListOptions(Action):
     def __init__(self, **kwargs):
@@ -23,14 +27,31 @@ class StorePath(Action):
     def __init__(self, **kwargs):
         super().__init__(nargs=1, **kwargs)
     def __call__(self, parser, namespace, values, option_string=None):
-        setattr(namespace, self.dest, AbsPath(values[0], parent=os.getcwd()))
+        setattr(namespace, self.dest, AbsPath(values[0], parent=current_dir()))
 
 #TODO How to append value to list?
 class AppendPath(Action):
     def __init__(self, **kwargs):
         super().__init__(nargs=1, **kwargs)
     def __call__(self, parser, namespace, values, option_string=None):
-        setattr(namespace, self.dest, AbsPath(values[0], parent=os.getcwd()))
+        setattr(namespace, self.dest, AbsPath(values[0], parent=current_dir()))
+
+def current_dir():
+# Relative paths are resolved against the working directory of the client when run by the daemon
+    return paths.cwd if 'cwd' in paths else os.getcwd()
+
+def frameslice(spec):
+# Convert a frame selection like 1000:2000:50 or -1 into a slice
+    try:
+        if ':' in spec:
+            parts = spec.split(':')
+            if len(parts) > 3:
+                raise ValueError
+            return slice(*(int(i) if i else None for i in parts))
+        index = int(spec)
+    except ValueError:
+        raise ArgumentTypeError('Selección de pasos inválida: {}'.format(spec))
+    return slice(index, index + 1 or None)
 
 def dirbranches(trunk, componentlist, dirtree):
     trunk.assertdir()
@@ -46,7 +67,7 @@ def dirbranches(trunk, componentlist, dirtree):
             dirbranches(trunk/component, componentlist, dirtree)
 
 
-def parse_args(names, config):
+def parse_args(names, config, argv=None):
 
     parser = ArgumentParser(prog=names.command, add_help=False, description='Envía trabajos de {} a la cola de ejecución.'.format(config.displayname))
 
@@ -63,11 +84,18 @@ def parse_args(names, config):
     group2.add_argument('-p', '--prompt', action='store_true', help='Seleccionar interactivamente las opciones disponibles.')
     group2.add_argument('-n', '--nproc', type=int, metavar='#PROCS', default=1, help='Requerir #PROCS núcleos de procesamiento.')
     group2.add_argument('-q', '--queue', metavar='QUEUE', default=SUPPRESS, help='Requerir la cola QUEUE.')
+    group2.add_argument('--auto-queue', action='store_true', help='Elegir la cola en la que el trabajo puede empezar antes según los nodos libres (con -q elegir entre las colas dadas separadas por comas).')
+    group2.add_argument('--reshape', action='store_true', help='Ajustar el número de núcleos y nodos dentro de los límites del programa para usar los nodos libres (implica --auto-queue).')
+    group2.add_argument('--workflow', metavar='PATH', default=SUPPRESS, help='Enviar a la vez todos los pasos del flujo de trabajo PATH, cada paso espera a los pasos de los que depende.')
     group2.add_argument('-j', '--job', action='store_true', help='Interpretar los argumentos como nombres de trabajo en vez de rutas de archivo.')
     group2.add_argument('-o', '--out', action=StorePath, metavar='PATH', default=SUPPRESS, help='Escribir los archivos de salida en el directorio PATH.')
-    group2.add_argument('--cwd', action=StorePath, metavar='PATH', default=os.getcwd(), help='Usar PATH como directorio actual de trabajo.')
+    group2.add_argument('--cwd', action=StorePath, metavar='PATH', default=current_dir(), help='Usar PATH como directorio actual de trabajo.')
     group2.add_argument('--raw', action='store_true', help='No interpolar ni crear copias de los archivos de entrada.')
     group2.add_argument('--move', action='store_true', help='Mover los archivos de entrada al directorio de salida en vez de copiarlos.')
+    group2.add_argument('-b', '--batch', type=int, metavar='#JOBS', default=SUPPRESS, help='Agrupar los trabajos en arreglos de hasta #JOBS trabajos por envío.')
+    group2.add_argument('--right-size', action='store_true', help='Solicitar el tiempo y la memoria que predice el historial de los trabajos terminados.')
+    group2.add_argument('--requeue', action='store_true', help='Permitir que el gestor de trabajos vuelva a encolar el trabajo cuando lo interrumpe (por ejemplo en colas expropiables).')
+    group2.add_argument('--cache', action='store_true', help='Reutilizar los resultados de los trabajos idénticos que ya terminaron en vez de volver a calcularlos.')
     group2.add_argument('--scratch', action=StorePath, metavar='PATH', default=SUPPRESS, help='Escribir los archivos temporales en el directorio PATH.')
     hostgroup = group2.add_mutually_exclusive_group()
     hostgroup.add_argument('-N', '--nhost', type=int, metavar='#NODES', default=1, help='Requerir #NODES nodos de ejecución.')
@@ -78,11 +106,20 @@ def parse_args(names, config):
 
     group3 = parser.add_argument_group('Opciones remotas')
     group3.name = 'remote'
-    group3.add_argument('-R', '--remote-host', metavar='HOSTNAME', help='Procesar el trabajo en el host HOSTNAME.')
+    routegroup = group3.add_mutually_exclusive_group()
+    routegroup.add_argument('-R', '--remote-host', metavar='HOSTNAME', help='Procesar el trabajo en el host HOSTNAME.')
+    routegroup.add_argument('--route', metavar='HOST[:WEIGHT]', action='append', default=SUPPRESS, help='Repartir los trabajos entre los hosts HOST según su carga (se pueden repetir o separar con comas).')
+    group3.add_argument('--policy', choices=policies, default='pending', help='Criterio para repartir los trabajos: menos trabajos en espera (pending), inicio estimado más próximo (start) o proporcional a los pesos (weighted).')
+    group3.add_argument('--queue-load', action='store_true', help=SUPPRESS)
+    group3.add_argument('--report-jobs', action='store_true', help=SUPPRESS)
 
     group4 = parser.add_argument_group('Opciones de selección de archivos')
     group4.name = 'arguments'
     group4.add_argument('-f', '--filter', metavar='REGEX', default=SUPPRESS, help='Enviar únicamente los trabajos que coinciden con la expresión regular.')
+    group4.add_argument('--from-file', metavar='PATH', default=SUPPRESS, help='Leer los argumentos del archivo PATH, uno por línea o separados por caracteres nulos (- para leerlos de la entrada estándar).')
+    group4.add_argument('-w', '--watch', metavar='DIR', action='append', default=SUPPRESS, help='Vigilar el directorio DIR y enviar los archivos de entrada que se escriban en él (se puede repetir).')
+    group4.add_argument('--debounce', type=float, metavar='SECONDS', default=2.0, help='Esperar SECONDS segundos sin archivos nuevos antes de enviar los archivos vigilados.')
+    group4.add_argument('--poll', type=float, metavar='SECONDS', default=SUPPRESS, help='Revisar los directorios vigilados cada SECONDS segundos en vez de usar inotify.')
 #    group4.add_argument('-r', '--restart-file', dest='restartfiles', metavar='FILE', action='append', default=[], help='Restart file path.')
 
     group5 = parser.add_argument_group('Opciones de interpolación')
@@ -93,23 +130,28 @@ def parse_args(names, config):
     molgroup = group5.add_mutually_exclusive_group()
     molgroup.add_argument('-m', '--mol', metavar='MOLFILE', action='append', default=[], help='Incluir el último paso del archivo MOLFILE en las variables de interpolación.')
     molgroup.add_argument('-M', '--trjmol', metavar='MOLFILE', default=None, help='Incluir todos los pasos del archivo MOLFILE en las variables de interpolación.')
+    group5.add_argument('--fan-out', action='store_true', help='Enviar un trabajo por cada paso seleccionado del archivo MOLFILE usando el paso como la variable mol1.')
+    group5.add_argument('--frames', metavar='START:STOP:STEP', type=frameslice, default=slice(None), help='Incluir únicamente los pasos seleccionados del archivo MOLFILE (contando desde 0, los índices negativos cuentan desde el final).')
     group5.add_argument('-x', '--var', dest='posvars', metavar='VALUE', action='append', default=[], help='Variables posicionales de interpolación.')
+    group5.add_argument('--sweep', action='store_true', help='Separar con comas los valores de las variables de interpolación y de los conjuntos de parámetros para hacer un barrido (\\, es una coma literal).')
 
     group7 = parser.add_argument_group('Opciones de depuración')
     group7.name = 'debug'
     group7.add_argument('--dry-run', action='store_true', help='Procesar los archivos de entrada sin enviar el trabajo.')
+    group7.add_argument('--profile', action='store_true', help='Mostrar al terminar el tiempo empleado en cada fase del envío.')
+    group7.add_argument('--trace', metavar='PATH', default=SUPPRESS, help='Escribir el tiempo de cada fase de cada trabajo en el archivo PATH en formato JSONL (implica --profile).')
 
     group8 = parser.add_argument_group('Conjuntos de parámetros')
     group8.name = 'parameteropts'
     for key in config.parameteropts:
-        group8.add_argument(option(key), metavar='SETNAME', default=SUPPRESS, help='Conjuntos de parámetros.')
+        group8.add_argument(option(key), metavar='SETNAME', action='append', default=SUPPRESS, help='Conjuntos de parámetros (se pueden repetir para hacer un barrido).')
 
     group9 = parser.add_argument_group('Variables de interpolación')
     group9.name = 'interpolopts'
     for key in config.interpolopts:
-        group9.add_argument(option(key), metavar='VARNAME', default=SUPPRESS, help='Variables de interpolación.')
+        group9.add_argument(option(key), metavar='VARNAME', action='append', default=SUPPRESS, help='Variables de interpolación (se pueden repetir para hacer un barrido).')
 
-    parsedargs = parser.parse_args()
+    parsedargs = parser.parse_args(argv)
 
     options = {}
     for group in parser._action_groups:
@@ -117,7 +159,10 @@ def parse_args(names, config):
         if hasattr(group, 'name'):
             options[group.name] = group_dict
 
-    if not parsedargs.files:
+    if parsedargs.reshape:
+        options['common']['auto_queue'] = True
+
+    if not parsedargs.files and 'from_file' not in parsedargs and 'watch' not in parsedargs and not parsedargs.queue_load:
         messages.error(_('Debe especificar al menos un archivo de entrada'))
 
     return options, parsedargs.files
@@ -0,0 +1,70 @@
+import sys
+import json
+import socket
+from clinterface import messages, prompts, _
+from .shared import paths
+
+# Options that never finish, span several runs or only print something are always handled in-process
+inprocess = ('-h', '--help', '-l', '--list', '--queue-load', '-w', '--watch', '--workflow')
+
+# The remote wrappers ask through the terminal of their ssh session, not through the daemon
+remoteopts = ('-R', '--remote-host', '--route')
+
+def socket_path():
+    return paths.jobq/'daemon.sock'
+
+def unattended(argv):
+# Check that the submission can run in the daemon, which sends its prompts back to the client
+    options = argv[:argv.index('--')] if '--' in argv else argv
+    if any(arg.split('=', 1)[0] in inprocess for arg in options):
+        return False
+    for i, arg in enumerate(options):
+        if arg == '--from-file' and options[i+1:i+2] == ['-'] or arg == '--from-file=-':
+            return False
+    if any(arg.split('=', 1)[0] in remoteopts for arg in options):
+        # Existing output files on the remote host would need an answer
+        return '--yes' in options or '--no' in options
+    return True
+
+def connect():
+# Return a connection to the daemon of the user or None if it is not running
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path())
+    except OSError:
+        connection.close()
+        return None
+    return connection
+
+def answer(prompt):
+# Show a prompt of the daemon in the terminal of the client and return the choice of the user
+    if prompt['kind'] == 'selector':
+        widget = prompts.Selector()
+    else:
+        widget = prompts.Completer()
+        widget.set_truthy_options(prompt['truthy'])
+        widget.set_falsy_options(prompt['falsy'])
+    widget.set_message(prompt['message'])
+    if 'options' in prompt:
+        widget.set_options(prompt['options'])
+    if 'default' in prompt:
+        widget.set_single_default(prompt['default'])
+    return getattr(widget, prompt['method'])()
+
+def request(connection, **message):
+# Send a request to the daemon relaying its output and prompts, return the exit status and the result
+    with connection, connection.makefile('rw', encoding='utf-8') as stream:
+        stream.write(json.dumps(message) + '\n')
+        stream.flush()
+        for line in stream:
+            reply = json.loads(line)
+            if 'status' in reply:
+                return reply['status'], reply.get('result')
+            if 'prompt' in reply:
+                stream.write(json.dumps(dict(answer=answer(reply['prompt']))) + '\n')
+                stream.flush()
+                continue
+            output = getattr(sys, reply['stream'])
+            output.write(reply['text'])
+            output.flush()
+    messages.error(_('Se perdió la conexión con el servicio de envío'))
@@ -0,0 +1,212 @@
+import os
+import re
+import json
+from argparse import ArgumentParser
+from collections import defaultdict
+from clinterface import messages, _
+from .shared import config
+from .jobindex import job_table, select_jobs, requeue_entry, report_control, remote_control, load_scheduler
+from .queue import controljobs
+from .fileutils import AbsPath
+from .client import connect, request
+from .daemon import serve, stop
+from .history import harvest_history
+from .outbox import drain_outbox, pending_count
+
+stagenames = ('imports', 'prescript', 'run', 'postscript', 'exports')
+
+controlactions = {
+    'cancel': 'Cancela los trabajos pendientes o en ejecución',
+    'hold': 'Retiene los trabajos pendientes',
+    'release': 'Libera los trabajos retenidos',
+    'requeue': 'Vuelve a encolar los trabajos en ejecución o terminados',
+}
+
+def jobq():
+    parser = ArgumentParser(prog='jobq', description='Herramienta de seguimiento de trabajos.')
+    subparsers = parser.add_subparsers(dest='command', help='Subcomando a ejecutar')
+    status_parser = subparsers.add_parser('status', help='Muestra el estado de los trabajos enviados y la duración de cada fase')
+    status_parser.add_argument('-f', '--filter', metavar='REGEX', default='.+', help='Mostrar únicamente los trabajos cuyo nombre coincide con la expresión regular.')
+    status_parser.add_argument('-s', '--summary', action='store_true', help='Mostrar únicamente el resumen de las fases de los trabajos terminados.')
+    status_parser.add_argument('--json', action='store_true', help='Mostrar los trabajos en formato JSON.')
+    for action, help in controlactions.items():
+        control_parser = subparsers.add_parser(action, help=help)
+        control_parser.add_argument('jobids', nargs='*', metavar='JOBID', help='Identificadores de los trabajos.')
+        control_parser.add_argument('-f', '--filter', metavar='REGEX', default=None, help='Seleccionar los trabajos cuyo nombre coincide con la expresión regular.')
+        control_parser.add_argument('-o', '--outdir', metavar='GLOB', default=None, help='Seleccionar los trabajos cuyo directorio de salida coincide con el patrón.')
+        control_parser.add_argument('-p', '--program', metavar='PROGRAM', default=None, help='Seleccionar los trabajos del programa PROGRAM.')
+        control_parser.add_argument('-v', '--version', metavar='VERSION', default=None, help='Seleccionar los trabajos de la versión VERSION del programa.')
+        control_parser.add_argument('-s', '--set', metavar='KEY=SETNAME', action='append', default=[], help='Seleccionar los trabajos que usaron el conjunto de parámetros SETNAME (se puede repetir).')
+        control_parser.add_argument('--state', metavar='REGEX', default=None, help='Seleccionar los trabajos cuyo estado coincide con la expresión regular.')
+    history_parser = subparsers.add_parser('history', help='Compara el tiempo y la memoria solicitados con los usados por los trabajos terminados')
+    history_parser.add_argument('-f', '--filter', metavar='REGEX', default='.+', help='Mostrar únicamente los programas cuyo nombre coincide con la expresión regular.')
+    subparsers.add_parser('flush', help='Envía los trabajos que quedaron pendientes porque el gestor de trabajos no respondía')
+    daemon_parser = subparsers.add_parser('daemon', help='Inicia el servicio de envío de trabajos del usuario')
+    daemon_parser.add_argument('-w', '--window', type=float, metavar='SECONDS', default=0.1, help='Agrupar los envíos que llegan dentro de SECONDS segundos.')
+    daemon_parser.add_argument('--stop', action='store_true', help='Detener el servicio en ejecución.')
+    args = parser.parse_args()
+
+    if args.command == 'status':
+        job_status(args)
+    elif args.command in controlactions:
+        job_control(args)
+    elif args.command == 'history':
+        job_history(args)
+    elif args.command == 'flush':
+        job_flush()
+    elif args.command == 'daemon':
+        if args.stop:
+            stop()
+        else:
+            serve(args.window)
+    else:
+        messages.error(_('$command no es un subcomando válido', command=args.command))
+
+def job_status(args):
+    connection = connect()
+    if connection is None:
+        table = job_table(args.filter, args.summary)
+    else:
+        status, table = request(connection, action='status', filter=args.filter, summary=args.summary, env=dict(os.environ))
+        if status:
+            raise SystemExit(status)
+    # The hosts that routed jobs here read the state of their jobs from this output
+    if args.json:
+        print(json.dumps(table))
+        return
+    rows = []
+    totals = {key: [] for key in stagenames}
+    maxrss = []
+
+    for entry in table:
+        stages = entry['stages']
+        if not args.summary:
+            jobid = entry['id'] or '-'
+            if 'remote' in entry:
+                jobid = f'{jobid}@{entry["remote"]}'
+            rows.append((entry['name'], jobid, entry['state'], stages))
+        if stages is not None:
+            for key in stagenames:
+                if key in stages:
+                    totals[key].append((stages[key]['end'] - stages[key]['start'], stages[key]['bytes']))
+            if stages['maxrss'] is not None:
+                maxrss.append(stages['maxrss'])
+
+    if rows:
+        print('{:<32} {:>14} {:>10} '.format('JOB', 'ID', 'STATE') + ' '.join('{:>10}'.format(key) for key in stagenames) + ' {:>10}'.format('RSS(MiB)'))
+        for name, jobid, state, stages in rows:
+            columns = ['{:<32} {:>14} {:>10}'.format(name, jobid, state)]
+            for key in stagenames:
+                if stages is not None and key in stages:
+                    columns.append('{:>10.2f}'.format(stages[key]['end'] - stages[key]['start']))
+                else:
+                    columns.append('{:>10}'.format('-'))
+            if stages is not None and stages['maxrss'] is not None:
+                columns.append('{:>10.1f}'.format(stages['maxrss']/1024))
+            else:
+                columns.append('{:>10}'.format('-'))
+            print(' '.join(columns))
+
+    if any(totals.values()):
+        if rows:
+            print()
+        grandtotal = sum(seconds for values in totals.values() for seconds, size in values)
+        print('{:<12} {:>8} {:>12} {:>12} {:>12} {:>7}'.format('STAGE', 'JOBS', 'MEAN(s)', 'MAX(s)', 'MEAN(MiB)', '%'))
+        for key, values in totals.items():
+            if values:
+                seconds = [i for i, j in values]
+                sizes = [j for i, j in values]
+                print('{:<12} {:>8} {:>12.2f} {:>12.2f} {:>12.1f} {:>7.1f}'.format(key, len(values), sum(seconds)/len(values), max(seconds), sum(sizes)/len(values)/2**20, 100*sum(seconds)/grandtotal if grandtotal else 0))
+        if maxrss:
+            print('{:<12} {:>8} {:>12.1f} {:>12.1f}'.format('rss(MiB)', len(maxrss), sum(maxrss)/len(maxrss)/1024, max(maxrss)/1024))
+
+def job_control(args):
+    parameters = {}
+    for item in args.set:
+        key, sep, value = item.partition('=')
+        if not sep:
+            messages.error(_('El conjunto de parámetros debe tener la forma KEY=SETNAME'), f'--set {item}')
+        parameters[key] = value
+    selection = dict(
+        jobids = args.jobids,
+        filter = args.filter,
+        outdir = AbsPath(args.outdir, parent=os.getcwd()) if args.outdir else None,
+        program = args.program,
+        version = args.version,
+        parameters = parameters,
+        state = args.state,
+    )
+    if not any(selection.values()):
+        messages.error(_('Debe especificar los trabajos'))
+    connection = connect()
+    if connection is not None:
+        status, result = request(connection, action='control', operation=args.command, selection=selection, env=dict(os.environ))
+        raise SystemExit(status)
+    byscheduler = defaultdict(list)
+    byhost = defaultdict(list)
+    # Finished jobs can only be requeued
+    for entry in select_jobs(selection, finished=args.command == 'requeue'):
+        if 'remote' in entry:
+            byhost[entry['remote']].append(entry)
+        else:
+            byscheduler[entry['scheduler']].append(entry)
+    if not byscheduler and not byhost:
+        messages.warning(_('No hay trabajos que coincidan con la selección'))
+    for host, entries in byhost.items():
+        error = remote_control(args.command, host, [entry['id'] for entry in entries])
+        if error is None and args.command == 'requeue':
+            for entry in entries:
+                requeue_entry(entry)
+        report_control(args.command, len(entries), error)
+    for scheduler, entries in byscheduler.items():
+        load_scheduler(scheduler)
+        if f'{args.command}cmd' not in config:
+            messages.failure(_('El gestor de trabajos $scheduler no soporta la operación $action', scheduler=config.scheduler, action=args.command))
+            continue
+        try:
+            controljobs(args.command, [entry['id'] for entry in entries])
+        except (OSError, RuntimeError) as e:
+            report_control(args.command, len(entries), str(e))
+        else:
+            if args.command == 'requeue':
+                for entry in entries:
+                    requeue_entry(entry)
+            report_control(args.command, len(entries))
+
+def job_flush():
+    if not pending_count():
+        messages.warning(_('No hay envíos pendientes'))
+        return
+    count = drain_outbox()
+    if pending_count():
+        raise SystemExit(1)
+    messages.success(_('Se enviaron $count trabajos pendientes', count=count))
+
+def job_history(args):
+    filtere = re.compile(args.filter)
+    groups = defaultdict(list)
+    for record in harvest_history().values():
+        if filtere.fullmatch(record['program']):
+            groups[record['program'], record['version'], record['nproc']].append(record)
+    if not groups:
+        messages.warning(_('No hay trabajos terminados en el historial'))
+        return
+    # Misses are the jobs that needed more than they were predicted, WAIT* is the queue wait of the right-sized jobs
+    print('{:<16} {:<10} {:>6} {:>6} {:>10} {:>10} {:>10} {:>10} {:>6} {:>10} {:>10}'.format('PROGRAM', 'VERSION', 'NPROC', 'JOBS', 'RUN(s)', 'PRED(s)', 'RSS(MiB)', 'PRED(MiB)', 'MISSES', 'WAIT(s)', 'WAIT*(s)'))
+    for (program, version, nproc), records in sorted(groups.items()):
+        timed = [i for i in records if i['walltime']]
+        sized = [i for i in records if i['memory'] and i['maxrss']]
+        misses = sum(1 for i in timed if i['elapsed'] > i['walltime']) + sum(1 for i in sized if i['maxrss'] > i['memory'])
+        columns = ['{:<16} {:<10} {:>6} {:>6}'.format(program, version, nproc, len(records))]
+        columns.append(mean_column(i['elapsed'] for i in records))
+        columns.append(mean_column(i['walltime'] for i in timed))
+        columns.append(mean_column(i['maxrss']/1024 for i in records if i['maxrss']))
+        columns.append(mean_column(i['memory']/1024 for i in sized))
+        columns.append('{:>6}'.format(misses if timed or sized else '-'))
+        columns.append(mean_column(i['wait'] for i in records if i['wait'] is not None and not i['walltime']))
+        columns.append(mean_column(i['wait'] for i in records if i['wait'] is not None and i['walltime']))
+        print(' '.join(columns))
+
+def mean_column(values):
+    values = list(values)
+    return '{:>10.1f}'.format(sum(values)/len(values)) if values else '{:>10}'.format('-')
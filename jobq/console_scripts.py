@@ -127,6 +127,9 @@ def config_setup():
             inputfiles = [],
             outputfiles = [],
             ignorederrors = [],
+            errorclasses = {},
+            transienterrors = [],
+            eventsinks = [],
             parameteropts = [],
             parameterpaths = [],
             interpolable = [],
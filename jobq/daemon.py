@@ -0,0 +1,317 @@
+import os
+import re
+import sys
+import json
+import signal
+import hashlib
+import threading
+import traceback
+from copy import deepcopy
+from contextvars import ContextVar, copy_context
+from socketserver import ThreadingUnixStreamServer, StreamRequestHandler
+from clinterface import messages, _
+from .shared import currentstate, get_state, new_state, names, paths, config, completer
+from .fileutils import AbsPath
+from .argparsing import parse_args
+from .main import submit_options
+from .session import Session
+from .jobindex import job_table, select_jobs, requeue_entry, report_control, remote_control, load_scheduler
+from .queue import controljobs
+from .client import socket_path, connect, request
+from . import routing
+
+# Clients that receive the output written in the current context
+output = ContextVar('output', default=None)
+
+wrapperre = re.compile(r"main\.submit_jobs\(\nr'''(.*)'''\n\)", re.DOTALL)
+
+class OutputRouter:
+# Stand-in for sys.stdout and sys.stderr that sends the output of a request to its clients
+    def __init__(self, name, stream):
+        self.name = name
+        self.stream = stream
+        self.encoding = 'utf-8'
+    def write(self, text):
+        clients = output.get()
+        if clients is None:
+            return self.stream.write(text)
+        for client in clients:
+            client.send(stream=self.name, text=text)
+        return len(text)
+    def flush(self):
+        if output.get() is None:
+            self.stream.flush()
+    def isatty(self):
+        return False
+
+class Client:
+    def __init__(self, rfile, wfile):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.lock = threading.Lock()
+    def send(self, **reply):
+        with self.lock:
+            try:
+                self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+                self.wfile.flush()
+            # A client that went away does not stop its submission
+            except OSError:
+                pass
+    def ask(self, prompt):
+    # Send a prompt to the client and wait for the answer of the user
+        with self.lock:
+            try:
+                self.wfile.write((json.dumps(dict(prompt=prompt)) + '\n').encode('utf-8'))
+                self.wfile.flush()
+                reply = json.loads(self.rfile.readline())
+            except (OSError, ValueError):
+                messages.error(_('Se perdió la conexión con el cliente'))
+        return reply['answer']
+
+class RelayedPrompt:
+# Stand-in for the prompts of clinterface that asks the client of the current request
+    def __init__(self, kind):
+        self.prompt = dict(kind=kind, truthy=[], falsy=[])
+    def set_message(self, message):
+        self.prompt['message'] = message
+    def set_options(self, options):
+        self.prompt['options'] = list(options)
+    def set_single_default(self, default):
+        self.prompt['default'] = default
+    def set_truthy_options(self, options):
+        self.prompt['truthy'] = list(options)
+    def set_falsy_options(self, options):
+        self.prompt['falsy'] = list(options)
+    def ask(self, method):
+        # The prompts of the shared part of a group go to its first client
+        return output.get()[0].ask(dict(self.prompt, method=method))
+    def single_choice(self):
+        return self.ask('single_choice')
+    def binary_choice(self):
+        return self.ask('binary_choice')
+
+class Batch:
+    def __init__(self):
+        self.items = []
+        self.result = None
+        self.done = threading.Event()
+
+class Coalescer:
+# Group the requests with the same key that arrive within the window and run them together
+    def __init__(self, window):
+        self.window = window
+        self.pending = {}
+        self.lock = threading.Lock()
+    def add(self, key, item, flush):
+        with self.lock:
+            if key not in self.pending:
+                self.pending[key] = Batch()
+                threading.Timer(self.window, self.run, (key, flush)).start()
+            batch = self.pending[key]
+            batch.items.append(item)
+        batch.done.wait()
+        return batch.result
+    def run(self, key, flush):
+        with self.lock:
+            batch = self.pending.pop(key)
+        try:
+            batch.result = flush(batch.items)
+        finally:
+            batch.done.set()
+
+def exit_status(function, *args):
+# Run function and return the exit status that the wrapper would have returned
+    try:
+        function(*args)
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else 0 if e.code is None else 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+def isolated(request, function, *args):
+# Run function with a fresh runtime state and the environment of the client
+    def fresh():
+        currentstate.set(new_state())
+        get_state().environment = request['env']
+        return function(*args)
+    return copy_context().run(fresh)
+
+class Daemon(ThreadingUnixStreamServer):
+    daemon_threads = True
+    def __init__(self, address, window):
+        super().__init__(address, RequestHandler)
+        self.coalescer = Coalescer(window)
+        self.sessions = {}
+        self.lock = threading.Lock()
+    def session(self, text):
+    # Sessions keep the parsed config of every wrapper that has been used
+        key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        with self.lock:
+            if key not in self.sessions:
+                self.sessions[key] = Session(text)
+        return key, self.sessions[key]
+    def preload(self, bindir):
+    # Load the configs of the wrappers installed next to the jobq command
+        for filename in bindir.listdir():
+            try:
+                with open(bindir/filename, 'r') as f:
+                    if 'from jobq import main' not in f.read(256):
+                        continue
+                    f.seek(0)
+                    match = wrapperre.search(f.read())
+            except (OSError, UnicodeDecodeError):
+                continue
+            if match:
+                self.session(match.group(1))
+    def run(self, request, session, function, *args):
+    # Run function with the working directory, environment and command name of the client
+        def prepared():
+            paths.cwd = AbsPath(request['cwd'])
+            get_state().environment = request['env']
+            get_state().selector = RelayedPrompt('selector')
+            get_state().completer = RelayedPrompt('completer')
+            completer.set_truthy_options(['si', 'yes'])
+            completer.set_falsy_options(['no'])
+            names.command = request['command']
+            return function(*args)
+        return session.run(prepared)
+    def submit(self, request, client):
+        key, session = self.session(request['config'])
+        try:
+            optiondict, files = self.run(request, session, lambda: parse_args(names, config, request['argv']))
+        except SystemExit as e:
+            return e.code if isinstance(e.code, int) else 1
+        # Only array jobs turn several requests into fewer scheduler calls, the choices of one client must not apply to others
+        if not self.coalescer.window or 'arraysize' not in session.config or 'from_file' in optiondict['arguments'] or optiondict['common']['prompt']:
+            return self.run(request, session, exit_status, submit_options, optiondict, files)
+        groupkey = (key, request['cwd'], request['command'], json.dumps(optiondict, sort_keys=True, default=str), json.dumps(request['env'], sort_keys=True))
+        statuses = self.coalescer.add(groupkey, (request, optiondict, files, client), lambda items: self.submit_group(session, items))
+        return statuses[client]
+    def submit_group(self, session, items):
+    # Submit the jobs of all the requests of a group at once and return the exit status of every client
+        request, optiondict, files, client = items[0]
+        clients = [item[3] for item in items]
+        if len(items) == 1:
+            output.set(clients)
+            return {client: self.run(request, session, exit_status, submit_options, optiondict, files)}
+        # The options of the first request may still be referenced by its caller
+        optiondict = deepcopy(optiondict)
+        optiondict['common'].setdefault('batch', session.config['arraysize'])
+        failing = list(clients)
+        def inputs():
+        # Messages about the files of a request go only to its client
+            for item in items:
+                output.set([item[3]])
+                failing[:] = [item[3]]
+                yield from item[2]
+            output.set(clients)
+            failing[:] = clients
+        output.set(clients)
+        status = self.run(request, session, exit_status, submit_options, optiondict, inputs())
+        if status != 0:
+            # An error stops the whole group, the jobs of the other clients are not submitted either
+            for other in clients:
+                if other not in failing:
+                    output.set([other])
+                    messages.failure(_('El envío se canceló por un error en otra solicitud enviada al mismo tiempo'))
+        return {item[3]: status for item in items}
+    def control(self, request):
+        action = request['operation']
+        entries = {}
+        hosts = {}
+        for entry in isolated(request, lambda: list(select_jobs(request['selection'], finished=action == 'requeue'))):
+            if 'remote' in entry:
+                hosts.setdefault(entry['remote'], []).append(entry)
+            else:
+                entries.setdefault(entry['scheduler'], []).append(entry)
+        if not entries and not hosts:
+            messages.warning(_('No hay trabajos que coincidan con la selección'))
+        # The jobs of a remote host are controlled by that host
+        for host, entrylist in hosts.items():
+            error = isolated(request, remote_control, action, host, [entry['id'] for entry in entrylist])
+            if error is None and action == 'requeue':
+                isolated(request, lambda: [requeue_entry(entry) for entry in entrylist])
+            report_control(action, len(entrylist), error)
+        for scheduler, entrylist in entries.items():
+            idlist = [entry['id'] for entry in entrylist]
+            error = self.coalescer.add((action, scheduler, json.dumps(request['env'], sort_keys=True)), idlist, lambda items: isolated(request, self.control_group, action, scheduler, items))
+            if error is None and action == 'requeue':
+                isolated(request, lambda: [requeue_entry(entry) for entry in entrylist])
+            report_control(action, len(idlist), error)
+        return 0
+    def control_group(self, action, scheduler, items):
+        load_scheduler(scheduler)
+        if f'{action}cmd' not in config:
+            return _('El gestor de trabajos $scheduler no soporta la operación $action', scheduler=config.scheduler, action=action)
+        try:
+            controljobs(action, [jobid for idlist in items for jobid in idlist])
+        except (OSError, RuntimeError) as e:
+            return str(e)
+
+class RequestHandler(StreamRequestHandler):
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+        client = Client(self.rfile, self.wfile)
+        output.set([client])
+        result = None
+        if request['action'] == 'submit':
+            status = self.server.submit(request, client)
+        elif request['action'] == 'status':
+            result = []
+            status = exit_status(lambda: result.extend(isolated(request, job_table, request['filter'], request['summary'])))
+        elif request['action'] == 'control':
+            status = exit_status(self.server.control, request)
+        elif request['action'] == 'stop':
+            status = 0
+        else:
+            messages.failure(_('$action no es una solicitud válida', action=request['action']))
+            status = 1
+        client.send(status=status, result=result)
+        if request['action'] == 'stop':
+            threading.Thread(target=self.server.shutdown).start()
+
+def serve(window):
+# Serve the submissions of the wrappers and the requests of the jobq command until stopped
+    paths.jobq.mkdir()
+    connection = connect()
+    if connection is not None:
+        connection.close()
+        messages.error(_('El servicio de envío ya está en ejecución'))
+    try:
+        os.remove(socket_path())
+    except FileNotFoundError:
+        pass
+    # Only the owner can connect to the socket
+    umask = os.umask(0o177)
+    try:
+        server = Daemon(socket_path(), window)
+    finally:
+        os.umask(umask)
+    server.preload(AbsPath(sys.argv[0], parent=os.getcwd()).parent())
+    # The ssh connections to the remote hosts are reused by the following submissions
+    routing.controlpersist = 600
+    messages.success(_('Servicio de envío escuchando en $path con $count configuraciones cargadas', path=socket_path(), count=len(server.sessions)))
+    # Prompts are sent to the clients, nothing else may wait for input on the terminal of the daemon
+    sys.stdin = open(os.devnull, 'r')
+    sys.stdout = OutputRouter('stdout', sys.stdout)
+    sys.stderr = OutputRouter('stderr', sys.stderr)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path())
+
+def stop():
+    connection = connect()
+    if connection is None:
+        messages.error(_('El servicio de envío no está en ejecución'))
+    request(connection, action='stop')
+    messages.success(_('Servicio de envío detenido'))
@@ -1,4 +1,5 @@
 import os
+import sys
 import string
 import shutil
 import fnmatch
@@ -28,6 +29,43 @@ def dir_except_info(exception, path):
     else:
         messages.error(exctype=type(exception).__name__, excmessage=str(exception))
 
+# Longest path that an entry of a manifest can hold
+pathmax = 4096
+
+def read_manifest(path, chunksize=65536):
+# Lazily yield the entries of a manifest file separated by newlines or NUL characters
+    if path == '-':
+        fh = sys.stdin.buffer
+    else:
+        fh = open(path, 'rb')
+    try:
+        separator = None
+        pending = b''
+        while True:
+            chunk = fh.read(chunksize)
+            pending += chunk
+            if separator is None:
+                # A manifest separated by NUL has one before the end of its first path
+                if b'\0' in pending:
+                    separator = b'\0'
+                elif not chunk or len(pending) > pathmax:
+                    separator = b'\n'
+                else:
+                    continue
+            *entries, pending = pending.split(separator)
+            for entry in entries:
+                entry = entry.rstrip(b'\r') if separator == b'\n' else entry
+                if entry:
+                    yield os.fsdecode(entry)
+            if not chunk:
+                break
+        pending = pending.rstrip(b'\r\n') if separator == b'\n' else pending
+        if pending:
+            yield os.fsdecode(pending)
+    finally:
+        if fh is not sys.stdin.buffer:
+            fh.close()
+
 class NotAbsolutePath(Exception):
     pass
 
@@ -101,6 +139,15 @@ class AbsPath(str):
         shutil.copy(self, dest)
     def copyas(self, dest):
         shutil.copyfile(self, dest)
+    def linkas(self, dest):
+    # Hard link that falls back to a copy across file systems
+        try:
+            os.link(self, dest)
+        except FileExistsError:
+            os.remove(dest)
+            os.link(self, dest)
+        except OSError:
+            shutil.copyfile(self, dest)
     def symlink(self, dest):
         try:
             os.symlink(self, dest)
@@ -0,0 +1,154 @@
+import re
+import json
+import math
+import time
+from subprocess import Popen, PIPE
+from contextvars import copy_context
+from .shared import currentstate, get_state, new_state, config, paths, environment
+from .utils import ConfigTemplate
+from .fileutils import AbsPath
+from .jobindex import read_index, read_stages, update_index, load_scheduler
+from . import profiling
+
+memoryunits = {'': 1, 'K': 1, 'M': 1024, 'G': 1024**2, 'T': 1024**3}
+
+def parse_duration(text):
+# Seconds of a duration written as seconds or as [D-][HH:]MM:SS
+    if ':' not in text:
+        return float(text)
+    days, _, clock = text.rpartition('-')
+    seconds = 0
+    for part in clock.split(':'):
+        seconds = 60*seconds + float(part)
+    return seconds + 86400*int(days or 0)
+
+def parse_memory(value, unit=None):
+# KiB of a memory amount with an optional K, M, G or T unit
+    return float(value)*memoryunits[(unit or '').upper()[:1]]
+
+def accounting(jobid):
+# Elapsed seconds and peak memory in KiB of a finished job according to the scheduler accounting
+    if 'acctcmd' not in config:
+        return None
+    profiling.count('subprocesses')
+    try:
+        process = Popen(config.acctcmd + [jobid], stdout=PIPE, stderr=PIPE, close_fds=True, universal_newlines=True, env=dict(environment))
+    except OSError:
+        return None
+    output, error = process.communicate()
+    if process.returncode != 0:
+        return None
+    elapsed = maxrss = None
+    # Accounting tools print a line per job step, the job used the most of each
+    for match in re.finditer(config.acctregex, output, re.MULTILINE):
+        groups = match.groupdict()
+        if groups.get('elapsed'):
+            elapsed = max(elapsed or 0, parse_duration(groups['elapsed']))
+        if groups.get('maxrss'):
+            maxrss = max(maxrss or 0, parse_memory(groups['maxrss'], groups.get('unit')))
+    if elapsed is None:
+        return None
+    return elapsed, maxrss
+
+def load_history():
+    history = {}
+    try:
+        with open(paths.jobq/'history.jsonl', 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                history[record['key']] = record
+    except FileNotFoundError:
+        pass
+    return history
+
+def harvest_history():
+# Add the jobs that finished since the last harvest to the history store
+    env = dict(environment)
+    def isolated():
+        currentstate.set(new_state())
+        get_state().environment = env
+        return collect_history()
+    return copy_context().run(isolated)
+
+def collect_history():
+    update_index()
+    history = load_history()
+    records = []
+    for entry in read_index():
+        key = f'{entry["jobdir"]}#{entry["id"]}'
+        if entry['id'] is None or key in history:
+            continue
+        stages = entry.get('stages') or read_stages(entry['jobdir'])
+        if stages is None:
+            continue
+        # Only the jobs submitted with their resource request can be modeled
+        try:
+            with open(AbsPath(entry['jobdir'])/'resources.json', 'r') as f:
+                resources = json.load(f)
+        except (FileNotFoundError, ValueError):
+            continue
+        starts = [stage['start'] for stage in stages.values() if isinstance(stage, dict)]
+        ends = [stage['end'] for stage in stages.values() if isinstance(stage, dict)]
+        load_scheduler(entry['scheduler'])
+        usage = accounting(entry['id'])
+        if usage is None:
+            elapsed = max(ends) - min(starts) if starts else None
+            maxrss = stages.get('maxrss') or (stages.get('peakmem') or 0)/1024 or None
+            source = 'stages'
+        else:
+            elapsed, maxrss = usage
+            source = 'accounting'
+        if elapsed is None:
+            continue
+        records.append(dict(resources,
+            key = key,
+            status = stages['status'],
+            elapsed = elapsed,
+            maxrss = maxrss,
+            wait = min(starts) - entry['time'] if starts else None,
+            source = source,
+            time = time.time(),
+        ))
+    if records:
+        with open(paths.jobq/'history.jsonl', 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        history.update((record['key'], record) for record in records)
+    return history
+
+def fit(points, size):
+# Power law of the input size fitted in log space, raised so that every past job would have fit
+    logs = [(math.log(max(x, 1)), math.log(max(y, 1))) for x, y in points]
+    meanx = sum(x for x, y in logs)/len(logs)
+    meany = sum(y for x, y in logs)/len(logs)
+    sxx = sum((x - meanx)**2 for x, y in logs)
+    slope = max(0, sum((x - meanx)*(y - meany) for x, y in logs)/sxx) if sxx > 1e-9 else 0
+    margin = max(y - meany - slope*(x - meanx) for x, y in logs)
+    return math.exp(meany + slope*(math.log(max(size, 1)) - meanx) + margin)
+
+def predict(history, program, version, nproc, size, minjobs=3, headroom=1.2):
+# Walltime in seconds and memory in KiB for a new job, None where the history is too short
+    records = [i for i in history.values() if i['program'] == program and i['version'] == version and i['nproc'] == nproc and i['status'] == 0]
+    walltime = memory = None
+    points = [(i['size'], i['elapsed']) for i in records]
+    if len(points) >= minjobs:
+        # Whole minutes and never less than five
+        walltime = 60*max(5, math.ceil(headroom*fit(points, size)/60))
+    points = [(i['size'], i['maxrss']) for i in records if i['maxrss']]
+    if len(points) >= minjobs:
+        # Whole MiB and never less than 256 MiB
+        memory = 1024*max(256, math.ceil(headroom*fit(points, size)/1024))
+    return walltime, memory
+
+def sizing_meta(walltime, memory):
+# Scheduler directives that request the predicted walltime and memory
+    meta = []
+    if walltime is not None and 'walltime' in config:
+        hms = '{:02d}:{:02d}:00'.format(walltime//3600, walltime%3600//60)
+        meta.append(ConfigTemplate(config.walltime).substitute(minutes=walltime//60, hms=hms))
+    if memory is not None and 'memory' in config:
+        meta.append(ConfigTemplate(config.memory).substitute(memory=memory))
+    return meta
@@ -0,0 +1,236 @@
+import os
+import re
+import sys
+import json
+import time
+import fcntl
+from shlex import quote
+from fnmatch import fnmatchcase
+from subprocess import CalledProcessError, DEVNULL, STDOUT, check_output
+from clinterface import messages, _
+from .shared import names, paths, config, environment
+from .fileutils import AbsPath
+from .json5 import json5_load
+from .queue import getjobstate
+from .routing import connect_remote
+
+def index_job(jobid, jobname, jobdir, host=None, remotejobdir=None):
+# Append a submitted job to the index so that the jobq command can find it later
+    paths.jobq.mkdir()
+    entry = dict(id=jobid, name=jobname, jobdir=jobdir, program=config.progname, scheduler=config.queuespecfile, cluster=names.cluster, time=time.time())
+    # Jobs routed to a remote host are followed through the index of that host
+    if host is not None:
+        entry['remote'] = host
+        entry['remotejobdir'] = remotejobdir
+    # Lines shorter than PIPE_BUF are appended atomically by concurrent writers
+    with open(paths.jobq/'jobs.jsonl', 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+def read_index():
+# Yield the latest entry of every job directory in submission order
+    entries = {}
+    try:
+        with open(paths.jobq/'jobs.jsonl', 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                # Completion records keep the place of their submission
+                if entries.get(entry['jobdir'], {}).get('time') != entry['time']:
+                    entries.pop(entry['jobdir'], None)
+                entries[entry['jobdir']] = entry
+    except FileNotFoundError:
+        pass
+    yield from entries.values()
+
+def read_stages(jobdir):
+# Load the stage timings written by the job script, None if the job has not finished
+    try:
+        with open(AbsPath(jobdir)/'stages.json', 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def update_index():
+# Fold the completion events written by the jobs since the last update into the index
+    paths.jobq.mkdir()
+    with open(paths.jobq/'events.offset', 'a+') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        lock.seek(0)
+        try:
+            offset = int(lock.read() or 0)
+        except ValueError:
+            offset = 0
+        try:
+            with open(paths.jobq/'events.jsonl', 'rb') as f:
+                # Start over if the events file was rotated
+                if os.fstat(f.fileno()).st_size < offset:
+                    offset = 0
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # A line that is still being written is read on the next update
+        data = data[:data.rfind(b'\n') + 1]
+        if not data:
+            return
+        entries = {entry['jobdir']: entry for entry in read_index()}
+        with open(paths.jobq/'jobs.jsonl', 'a') as f:
+            for line in data.splitlines():
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    continue
+                entry = entries.get(event.get('jobdir'))
+                # Events of an earlier run of the same job directory are stale
+                if entry is None or 'status' in entry or event['end'] < entry['time']:
+                    continue
+                entry.update(status=event['status'], end=event['end'], duration=event['duration'], host=event['host'], stages=event['stages'])
+                f.write(json.dumps(entry) + '\n')
+        lock.seek(0)
+        lock.truncate()
+        lock.write(str(offset + len(data)))
+
+def load_scheduler(specfile):
+# Switch the shared configuration to the scheduler that submitted the job
+    if config.get('queuespecfile') != specfile:
+        config.clear()
+        config.update(json5_load(AbsPath(__file__).parent()/'specfiles'/'schedulers'/specfile))
+        config.queuespecfile = specfile
+
+class RemoteEntries(dict):
+# Index entries of every remote host by job directory, each host is asked only once
+    def __missing__(self, host):
+        self[host] = {}
+        remote = connect_remote(host)
+        if remote is not None:
+            try:
+                table = json.loads(check_output(['ssh', '-S', remote.socket, host, 'jobq status --json'], stderr=DEVNULL, env=dict(environment)))
+            except (CalledProcessError, ValueError):
+                pass
+            else:
+                self[host] = {entry['jobdir']: entry for entry in table}
+        return self[host]
+
+def remote_entry(entry, remotes):
+# Entry of the job in the index of the remote host that runs it, None if the host does not know it
+    # Older entries only kept the job directory on the remote host
+    remote = remotes[entry['remote']].get(entry.get('remotejobdir', entry['jobdir']))
+    # Jobs postponed by the remote host got their id later
+    if remote is not None and entry['id'] is None:
+        entry['id'] = remote['id']
+    return remote
+
+def remote_control(action, host, jobids):
+# Run the operation on the jobs of a remote host with its own jobq command, return the error or None
+    remote = connect_remote(host)
+    if remote is None:
+        return _('No se pudo conectar con el servidor $host', host=host)
+    try:
+        check_output(['ssh', '-S', remote.socket, host, ' '.join(['jobq', action] + [quote(jobid) for jobid in jobids])], stderr=STDOUT, env=dict(environment))
+    except CalledProcessError as e:
+        return e.output.decode(sys.stdout.encoding).strip()
+
+def job_state(entry, stages, remotes=None):
+    if 'remote' in entry:
+        remote = remote_entry(entry, RemoteEntries() if remotes is None else remotes)
+        return 'UNKNOWN' if remote is None else remote['state']
+    if 'status' in entry:
+        return 'DONE' if entry['status'] == 0 else f'FAILED({entry["status"]})'
+    if stages is not None:
+        return 'DONE' if stages['status'] == 0 else f'FAILED({stages["status"]})'
+    load_scheduler(entry['scheduler'])
+    try:
+        state = getjobstate(entry['id'])
+    except (OSError, RuntimeError):
+        return 'UNKNOWN'
+    # A job that left the queue without writing its stage file was killed
+    return 'LOST' if state is None else state
+
+def job_table(pattern, summary=False):
+# Index entries whose name matches pattern with their stage timings and state
+    filtere = re.compile(pattern)
+    table = []
+    remotes = RemoteEntries()
+    update_index()
+    for entry in read_index():
+        if filtere.fullmatch(entry['name']):
+            if 'remote' in entry:
+                remote = remote_entry(entry, remotes)
+                entry['stages'] = None if remote is None else remote['stages']
+            # Jobs that reported their completion need neither the stage file nor the scheduler
+            elif 'status' not in entry:
+                entry['stages'] = read_stages(entry['jobdir'])
+            entry['state'] = None if summary else job_state(entry, entry['stages'], remotes)
+            table.append(entry)
+    return table
+
+def read_resources(jobdir):
+# Load the program, version and parameter sets that the job was submitted with
+    try:
+        with open(AbsPath(jobdir)/'resources.json', 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def select_jobs(selection, finished=False):
+# Index entries of the jobs that match every criterion of the selection, only the unfinished ones unless finished is true
+    filtere = re.compile(selection['filter']) if selection.get('filter') else None
+    statere = re.compile(selection['state']) if selection.get('state') else None
+    remotes = RemoteEntries()
+    update_index()
+    for entry in read_index():
+        if 'remote' in entry:
+            remote = remote_entry(entry, remotes)
+            # Jobs that the remote host does not know cannot be controlled
+            if remote is None or remote['id'] is None:
+                continue
+            stages = remote['stages']
+            done = 'status' in remote or stages is not None
+        else:
+            if entry['id'] is None:
+                continue
+            stages = None if 'status' in entry else read_stages(entry['jobdir'])
+            done = 'status' in entry or stages is not None
+        if not finished and done:
+            continue
+        if selection.get('jobids') and entry['id'] not in selection['jobids']:
+            continue
+        if filtere and not filtere.fullmatch(entry['name']):
+            continue
+        if selection.get('outdir') and not fnmatchcase(os.path.dirname(entry['jobdir']), selection['outdir']):
+            continue
+        if selection.get('program') and entry['program'] != selection['program']:
+            continue
+        if selection.get('version') or selection.get('parameters'):
+            resources = read_resources(entry['jobdir'])
+            if selection.get('version') and resources.get('version') != selection['version']:
+                continue
+            if any(resources.get('parameters', {}).get(key) != value for key, value in selection.get('parameters', {}).items()):
+                continue
+        # The state is the only criterion that may need the scheduler
+        if statere and not statere.fullmatch(job_state(entry, stages, remotes)):
+            continue
+        yield entry
+
+def requeue_entry(entry):
+# Index a requeued job again so that its next completion is not taken for the previous one
+    (AbsPath(entry['jobdir'])/'stages.json').remove()
+    entry = {key: value for key, value in entry.items() if key not in ('status', 'end', 'duration', 'host', 'stages', 'state')}
+    entry['time'] = time.time()
+    with open(paths.jobq/'jobs.jsonl', 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+def report_control(action, count, error=None):
+# Tell the user how the scheduler took the operation on the selected jobs
+    if error is not None:
+        messages.failure(_('El gestor de trabajos no pudo completar la operación $action', action=action), error)
+    elif action == 'cancel':
+        messages.success(_('Se cancelaron $count trabajos', count=count))
+    elif action == 'hold':
+        messages.success(_('Se retuvieron $count trabajos', count=count))
+    elif action == 'release':
+        messages.success(_('Se liberaron $count trabajos', count=count))
+    elif action == 'requeue':
+        messages.success(_('Se volvieron a encolar $count trabajos', count=count))
@@ -2,66 +2,262 @@ import os
 import re
 import sys
 import json
+import time
+import hashlib
+from copy import deepcopy
+from itertools import chain
+from contextvars import copy_context
 from socket import gethostname
 from clinterface import messages, _
-from .shared import names, nodes, paths, environ, config, options
+from .shared import currentstate, new_state, names, nodes, paths, environ, config, options, settings, submitted, track_submitted, add_submitted
 from .utils import ConfDict, LogDict, GlobDict, ConfigTemplate, InterpolationTemplate, option, natural_sorted as sorted, catch_keyboard_interrupt
-from .fileutils import AbsPath, file_except_info
+from .fileutils import AbsPath, file_except_info, read_manifest
 from .parsing import BoolParser
 from .argparsing import parse_args
-from .submission import configure_submission, submit_single_job
+from .submission import configure_submission, submit_single_job, submit_batch, sweep_combinations
+from .readmol import enumframes, molblock
+from .client import unattended, connect, request
+from .watch import open_watcher
+from .outbox import drain_outbox
+from .queue import queueload
+from .workflow import load_workflow
+from . import profiling, metrics
 
 @catch_keyboard_interrupt
-def submit_jobs(json_config):
+def submit_jobs(json_config, argv=None):
 
+    start = time.perf_counter()
+    if argv is None:
+        argv = sys.argv[1:]
+    # Hand the submission to the daemon of the user when it is running
+    if unattended(argv):
+        connection = connect()
+        if connection is not None:
+            status, result = request(connection, action='submit', config=json_config, command=os.path.basename(sys.argv[0]), argv=argv, cwd=os.getcwd(), env=dict(os.environ))
+            sys.exit(status)
     config.update(json.loads(json_config))
     names.command = os.path.basename(sys.argv[0])
-    optiondict, argumentlist = parse_args(names, config)
+    submit_arguments(argv, start)
+
+def submit_arguments(argv=None, start=None):
+# Submit the jobs given by the command line arguments with the already loaded config
+
+    optiondict, argumentlist = parse_args(names, config, argv)
+    # Hosts that route jobs to this one ask for the load of its scheduler
+    if optiondict['remote']['queue_load']:
+        print(json.dumps(queueload()))
+    elif 'workflow' in optiondict['common']:
+        submit_workflow(argv, optiondict)
+    elif 'watch' in optiondict['arguments']:
+        watch_inputs(optiondict)
+    else:
+        submit_options(optiondict, argumentlist, start)
+
+def submit_workflow(argv, optiondict):
+# Submit every step of the workflow for all the inputs at once, the jobs of a step wait for the jobs of its parents
+
+    if 'watch' in optiondict['arguments']:
+        messages.error(_('No se pueden vigilar directorios al enviar un flujo de trabajo'))
+    if optiondict['remote']['remote_host'] or 'route' in optiondict['remote']:
+        messages.error(_('Los flujos de trabajo no se pueden enviar a servidores remotos'))
+
+    if argv is None:
+        argv = sys.argv[1:]
+    steps = load_workflow(AbsPath(optiondict['common']['workflow'], parent=optiondict['common']['cwd']))
+    baseconfig = deepcopy(dict(config))
+    command = names.command
+    # Jobs of every step by input, the child steps wait for them and stage their outputs
+    stepjobs = {}
+
+    for stepname, step in steps:
+        # Every step runs with a fresh state and its own arguments appended to the command line
+        def fresh():
+            currentstate.set(new_state())
+            config.update(deepcopy(baseconfig))
+            names.command = command
+            # The jobs of the step are needed by its children
+            track_submitted()
+            stepoptions, stepfiles = parse_args(names, config, argv + step['args'])
+            settings.step = ConfDict(dict(
+                name = stepname,
+                parents = {parent: stepjobs[parent] for parent in step['after']},
+                stage = step['stage'],
+                jobs = {},
+                jobdirs = {},
+            ))
+            submit_options(stepoptions, stepfiles)
+            for jobname, jobdir, jobid in submitted:
+                stepkey, outdir = settings.step.jobdirs[jobdir]
+                settings.step.jobs[stepkey] = ConfDict(dict(outdir=outdir, jobname=jobname, jobid=jobid))
+            return settings.step.jobs, list(submitted)
+        stepjobs[stepname], stepsubmitted = copy_context().run(fresh)
+        for job in stepsubmitted:
+            add_submitted(*job)
+
+def watch_inputs(optiondict):
+# Submit the input files written to the watched directories in batches until interrupted
+
+    directories = [AbsPath(directory, parent=optiondict['common']['cwd']) for directory in optiondict['arguments']['watch']]
+    for directory in directories:
+        if not directory.isdir():
+            messages.error(_('El directorio $directory no existe', directory=directory))
+
+    # Jobs already submitted are remembered across restarts
+    (paths.jobq/'watched').mkdir()
+    checkpoint = paths.jobq/'watched'/'{}-{}'.format(names.command, hashlib.sha1('\0'.join(sorted(directories)).encode()).hexdigest()[:12])
+    try:
+        with open(checkpoint, 'r') as f:
+            processed = set(f.read().splitlines())
+    except FileNotFoundError:
+        processed = set()
+
+    def jobkey(directory, filename):
+        for key in config.inputfiles:
+            if filename.endswith('.' + key):
+                return directory/filename[:-len('.' + key)]
+
+    baseconfig = deepcopy(dict(config))
+    command = names.command
+    pending = {}
+
+    def submit_pending():
+        inputlist = list(pending.values())
+        # Every batch runs with a fresh state like a new invocation of the wrapper
+        def fresh():
+            currentstate.set(new_state())
+            config.update(deepcopy(baseconfig))
+            names.command = command
+            submit_options(deepcopy(optiondict), inputlist)
+        copy_context().run(fresh)
+        with open(checkpoint, 'a') as f:
+            f.write(''.join(key + '\n' for key in pending))
+        processed.update(pending)
+        pending.clear()
+
+    # Only the names are listed to find the files written while not watching
+    for directory in directories:
+        for filename in os.listdir(directory):
+            key = jobkey(directory, filename)
+            if key is not None and key not in processed:
+                pending[key] = directory/filename
+
+    watcher = open_watcher(directories, optiondict['arguments'].get('poll'))
+    debounce = optiondict['arguments']['debounce']
+    limit = optiondict['common'].get('batch', config.get('arraysize', 0))
+    firstevent = lastevent = time.monotonic()
+
+    while True:
+        events = watcher.read(debounce if pending else None)
+        now = time.monotonic()
+        for directory, filename in events:
+            key = jobkey(AbsPath(directory), filename)
+            if key is not None:
+                if not pending:
+                    firstevent = now
+                lastevent = now
+                # A job written again is submitted again
+                processed.discard(key)
+                pending[key] = AbsPath(directory)/filename
+        # Wait until the writer is quiet but never hold a steady stream for long
+        if pending and (now - lastevent >= debounce or now - firstevent >= 10*debounce or limit and len(pending) >= limit):
+            submit_pending()
+
+def submit_options(optiondict, argumentlist, start=None):
+# Submit the jobs of already parsed options and input files
+
     options.update(optiondict)
-    configure_submission()
+
+    if options.debug.profile or 'trace' in options.debug:
+        profiling.enable(time.perf_counter() if start is None else start, options.debug.get('trace'))
+        profiling.lap('config')
+
+    with profiling.phase('configure'):
+        configure_submission()
+
+    # Jobs postponed by earlier runs go before the new ones
+    if not options.debug.dry_run:
+        drain_outbox()
 
     if 'filter' in options.arguments:
         filtere = re.compile(options.arguments.filter)
     else:
         filtere = re.compile('.+')
 
-    for inputfile in argumentlist:
+    if 'from_file' in options.arguments:
+        manifest = options.arguments.from_file
+        if manifest != '-':
+            manifest = AbsPath(manifest, parent=options.common.cwd)
+        inputlist = chain(argumentlist, read_manifest(manifest))
+    else:
+        inputlist = argumentlist
+
+    for inputfile in inputlist:
+        if options.common.job:
+            inputname = inputfile
+        else:
+            path = AbsPath(inputfile, parent=options.common.cwd)
+            for key in config.inputfiles:
+                if path.name.endswith('.' + key):
+                    inputname = path.name[:-len('.' + key)]
+                    break
+            else:
+                messages.failure(_('$file no es un archivo de entrada de $program', file=path.name, program=config.progname))
+                continue
+        # Filter before touching the filesystem
+        matched = filtere.fullmatch(inputname)
+        if not matched:
+            continue
         if options.common.job:
             workdir = AbsPath(options.common.cwd)
             for key in config.inputfiles:
-                if (workdir/inputfile*key).isfile():
-                    inputname = inputfile
+                if (workdir/inputname-key).isfile():
                     break
             else:
-                messages.failure(_('No hay archivos de entrada del trabajo $job', job=inputfile))
+                messages.failure(_('No hay archivos de entrada del trabajo $job', job=inputname))
                 continue
         else:
-            path = AbsPath(inputfile, parent=options.common.cwd)
             try:
                 path.assertfile()
             except Exception as e:
                 file_except_info(e, path)
                 continue
-            for key in config.inputfiles:
-                if path.name.endswith('.' + key):
-                    inputname = path.name[:-len('.' + key)]
-                    break
-            else:
-                messages.failure(_('$file no es un archivo de entrada de $program', file=path.name, program=config.progname))
-                continue
             workdir = path.parent()
         filestatus = {}
         for key in config.filekeys:
             path = workdir/inputname-key
-            filestatus[key] = path.isfile() #or key in options.restartfiles
+            # Files staged from a parent step exist once the job runs
+            filestatus[key] = path.isfile() or 'step' in settings and key in settings.step.stage #or key in options.restartfiles
         for conflict, message in config.conflicts.items():
             if BoolParser(conflict).evaluate(filestatus):
                 messages.failure(InterpolationTemplate(message).safe_substitute(file=inputname))
                 continue
-        matched = filtere.fullmatch(inputname)
-        if matched:
-            filtergroups = {str(i): x for i, x in enumerate(matched.groups())}
-            submit_single_job(workdir, inputname, filtergroups)
+        filtergroups = {str(i): x for i, x in enumerate(matched.groups())}
+        profiling.lap('checks')
+        if options.interpolation.fan_out:
+            # Format each frame only when its job is staged
+            framelist = ({'mol1': molblock(frame, config.progspecfile), 'frame': str(index)} for index, frame in enumframes(settings.trjmol, options.interpolation.frames))
+        else:
+            framelist = [{}]
+        for framevars in framelist:
+            profiling.lap('interpolation')
+            for tag, sweepvars, sweepparams in sweep_combinations():
+                with profiling.span(inputname):
+                    submit_single_job(workdir, inputname, filtergroups, {**framevars, **sweepvars}, sweepparams, tag)
+
+    submit_batch()
+
+    if settings.postponed:
+        messages.warning(_('El envío de $count trabajos quedó pendiente, se enviarán con jobq flush o en la próxima ejecución', count=settings.postponed))
+
+    if settings.cachehits:
+        messages.success(_('Se reutilizaron los resultados de $count trabajos ahorrando $hours horas de cómputo', count=settings.cachehits, hours=f'{settings.savedhours:.2f}'))
+
+    try:
+        metrics.flush()
+    except OSError as e:
+        messages.warning(_('No se pudieron actualizar las métricas'), str(e))
+
+    profiling.report()
 
 #if __name__ == '__main__':
 #    run()
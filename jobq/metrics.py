@@ -0,0 +1,105 @@
+import os
+import json
+import fcntl
+import tempfile
+from bisect import bisect_left
+from collections import ChainMap
+from .shared import config, names, paths, metricdata
+from .utils import ConfigTemplate
+from .fileutils import AbsPath
+
+# Upper bounds in seconds of the latency histogram buckets
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Counters keep the _total suffix in their type line as node_exporter expects
+metricinfo = {
+    'jobq_submissions_total': ('counter', 'Jobs submitted to the scheduler.'),
+    'jobq_submit_failures_total': ('counter', 'Failed submissions by scheduler error class.'),
+    'jobq_submit_retries_total': ('counter', 'Submissions retried after a transient scheduler error.'),
+    'jobq_postponed_jobs_total': ('counter', 'Jobs left in the outbox because the scheduler did not respond.'),
+    'jobq_submit_latency_seconds': ('histogram', 'Latency of the scheduler submission command.'),
+    'jobq_status_query_seconds': ('histogram', 'Latency of the scheduler status command.'),
+    'jobq_staged_bytes_total': ('counter', 'Bytes copied to the job output directories.'),
+    'jobq_staging_seconds': ('histogram', 'Time spent copying the input files of a job.'),
+    'jobq_throttle_wait_seconds_total': ('counter', 'Time spent waiting between consecutive submissions.'),
+    'jobq_cache_hits_total': ('counter', 'Jobs whose results were reused from an identical finished job.'),
+    'jobq_cache_saved_core_hours_total': ('counter', 'Core hours of computation saved by reused results.'),
+}
+
+def labelset(**labels):
+    return ','.join('{}="{}"'.format(key, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')) for key, value in sorted(labels.items()))
+
+# Every series carries the user label so that the collector can tell the users apart
+def inc(name, amount=1, **labels):
+    if 'metricsfile' in config:
+        metricdata.counters[f'{name}|{labelset(user=names.user, **labels)}'] += amount
+
+def observe(name, value, **labels):
+    if 'metricsfile' in config:
+        key = f'{name}|{labelset(user=names.user, **labels)}'
+        # Updates are kept in memory and merged into the persistent state once per run
+        if key not in metricdata.histograms:
+            metricdata.histograms[key] = [0]*(len(buckets) + 1) + [0.0]
+        histogram = metricdata.histograms[key]
+        histogram[bisect_left(buckets, value)] += 1
+        histogram[-1] += value
+
+def render(state):
+    lines = []
+    for name, (kind, text) in metricinfo.items():
+        lines.append(f'# HELP {name} {text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for key, value in sorted(state['counters'].items()):
+            metric, labels = key.split('|', 1)
+            if metric == name:
+                lines.append(f'{name}{{{labels}}} {float(value)!r}')
+        for key, histogram in sorted(state['histograms'].items()):
+            metric, labels = key.split('|', 1)
+            if metric == name:
+                separator = ',' if labels else ''
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), histogram):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_count{{{labels}}} {cumulative}')
+                lines.append(f'{name}_sum{{{labels}}} {float(histogram[-1])!r}')
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+def flush():
+# Merge the updates into the cumulative state and atomically replace the textfile
+    if 'metricsfile' not in config or not (metricdata.counters or metricdata.histograms):
+        return
+    metricsfile = AbsPath(ConfigTemplate(config.metricsfile).substitute(names))
+    # Users sharing a collector directory must not replace each other's file
+    if metricsfile == AbsPath(ConfigTemplate(config.metricsfile).substitute(ChainMap({'user': ''}, names))):
+        stem, ext = os.path.splitext(metricsfile.name)
+        metricsfile = metricsfile.parent()/f'{stem}-{names.user}{ext or ".prom"}'
+    paths.jobq.mkdir()
+    # Concurrent runs of the same user serialize on the state file
+    with open(paths.jobq/'metrics.json', 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        try:
+            state = json.load(f)
+        except ValueError:
+            state = {'counters': {}, 'histograms': {}}
+        for key, value in metricdata.counters.items():
+            state['counters'][key] = state['counters'].get(key, 0) + value
+        for key, histogram in metricdata.histograms.items():
+            if key in state['histograms']:
+                state['histograms'][key] = [i + j for i, j in zip(state['histograms'][key], histogram)]
+            else:
+                state['histograms'][key] = histogram
+        f.seek(0)
+        f.truncate()
+        json.dump(state, f)
+        f.flush()
+        # The collector must never see a partially written file
+        fd, tmpfile = tempfile.mkstemp(prefix='.jobq.', dir=metricsfile.parent())
+        with os.fdopen(fd, 'w') as tmp:
+            tmp.write(render(state))
+        os.chmod(tmpfile, 0o644)
+        os.replace(tmpfile, metricsfile)
+    metricdata.counters.clear()
+    metricdata.histograms.clear()
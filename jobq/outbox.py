@@ -0,0 +1,108 @@
+import os
+import json
+import time
+import fcntl
+import tempfile
+from contextvars import copy_context
+from clinterface import messages, _
+from .shared import currentstate, get_state, new_state, config, names, paths, environment
+from .fileutils import AbsPath
+from .queue import retrysubmit, TransientError
+from .jobindex import index_job
+from .utils import ConfigTemplate
+
+# Settings needed to submit a postponed job from any wrapper or from the jobq command
+schedulerkeys = ('progname', 'scheduler', 'queuespecfile', 'sbmtcmd', 'sbmtregex', 'arraysbmtregex', 'arrayjobid', 'findcmd', 'findregex', 'unsureerrors', 'transienterrors', 'submitattempts', 'submitbackoff')
+
+def outbox_dir():
+    return paths.jobq/'outbox'
+
+def postpone(jobscript, name, jobs, array=False):
+# Keep a copy of the rendered script in the outbox until the scheduler accepts it
+    outbox_dir().makedirs()
+    with open(jobscript, 'r') as f:
+        text = f.read()
+    entry = dict(
+        name = name,
+        jobs = [(jobname, str(jobdir)) for jobname, jobdir in jobs],
+        array = array,
+        config = {key: config[key] for key in schedulerkeys if key in config},
+        cluster = names.cluster,
+        env = dict(environment),
+        time = time.time(),
+    )
+    # The entry only becomes visible once it is complete
+    fd, tmpfile = tempfile.mkstemp(prefix='.', dir=outbox_dir())
+    with os.fdopen(fd, 'w') as f:
+        json.dump(dict(entry, script=text), f)
+    os.rename(tmpfile, outbox_dir()/f'{entry["time"]:.6f}-{os.getpid()}-{jobs[0][0]}.json')
+
+def pending_count():
+    try:
+        return sum(1 for filename in os.listdir(outbox_dir()) if filename.endswith('.json'))
+    except FileNotFoundError:
+        return 0
+
+def drain_outbox():
+# Submit the postponed jobs in order, stop at the first one that still finds the scheduler down
+    try:
+        filenames = sorted(i for i in os.listdir(outbox_dir()) if i.endswith('.json'))
+    except FileNotFoundError:
+        return 0
+    submittedcount = 0
+    for filename in filenames:
+        try:
+            f = open(outbox_dir()/filename, 'r')
+        except FileNotFoundError:
+            continue
+        with f:
+            # Another invocation may be draining the same entry
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            if os.fstat(f.fileno()).st_nlink == 0:
+                continue
+            entry = json.load(f)
+            try:
+                accepted = copy_context().run(submit_entry, entry)
+            except TransientError as error:
+                messages.warning(_('El gestor de trabajos sigue sin responder, quedan $count trabajos pendientes de envío', count=pending_count()), str(error))
+                break
+            os.remove(outbox_dir()/filename)
+            submittedcount += accepted
+    return submittedcount
+
+def submit_entry(entry):
+# Submit a postponed job with the scheduler settings and environment it was created with
+    currentstate.set(new_state())
+    get_state().environment = entry['env']
+    config.update(entry['config'])
+    names.cluster = entry['cluster']
+    jobs = [(jobname, AbsPath(jobdir)) for jobname, jobdir in entry['jobs']]
+    for jobname, jobdir in jobs:
+        # The output directory was removed or the job was submitted again meanwhile
+        if not jobdir.isdir() or os.path.exists(jobdir/'id') and os.path.getmtime(jobdir/'id') > entry['time']:
+            messages.warning(_('Se descartó el envío pendiente del trabajo "$jobname" porque su directorio cambió', jobname=jobname))
+            return 0
+    fd, jobscript = tempfile.mkstemp(prefix='.', dir=outbox_dir())
+    with os.fdopen(fd, 'w') as f:
+        f.write(entry['script'])
+    try:
+        # Entries of older versions did not keep the name of the scheduler job
+        jobid = retrysubmit(jobscript, entry.get('name', entry['jobs'][0][0]), array=entry['array'])
+    except TransientError:
+        raise
+    except RuntimeError as error:
+        for jobname, jobdir in jobs:
+            messages.failure(_('El gestor de trabajos reportó el siguiente error al enviar el trabajo $jobname: $error', jobname=jobname, error=error))
+        return 0
+    finally:
+        os.remove(jobscript)
+    for i, (jobname, jobdir) in enumerate(jobs, start=1):
+        taskid = ConfigTemplate(config.arrayjobid).substitute(jobid=jobid, task=i) if entry['array'] else jobid
+        messages.success(_('El trabajo pendiente "$jobname" se envió a $clustername con el número $jobid', jobname=jobname, clustername=names.cluster, jobid=taskid))
+        with open(jobdir/'id', 'w') as f:
+            f.write(taskid)
+        index_job(taskid, jobname, jobdir)
+    return len(jobs)
@@ -6,6 +6,10 @@ Lit = [A-Z]  | ( Disj )
 '''
 
 import re
+from contextvars import ContextVar
+
+# Values of the expression being evaluated, kept per context for thread safety
+evaldict = ContextVar('evaldict')
 
 def tokenize(expr):
     for token in re.findall(r'(?:[^ ()]+|[()])', expr):
@@ -32,8 +36,8 @@ class Node:
             return self.left.evaluate() and self.right.evaluate()
         elif self.name == 'or':
             return self.left.evaluate() or self.right.evaluate()
-        elif self.name in evaldict:
-            return evaldict[self.name]
+        elif self.name in evaldict.get():
+            return evaldict.get()[self.name]
         else:
             raise Exception(self.name, 'not in value dict')
 
@@ -45,8 +49,7 @@ class BoolParser:
     def pr(self):
         return self.etree.pr()
     def evaluate(self, values):
-        global evaldict
-        evaldict = values
+        evaldict.set(values)
         return self.etree.evaluate()
     def accept(self, c):
         if self.current == c:
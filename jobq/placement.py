@@ -0,0 +1,61 @@
+import math
+from .shared import config, paths
+from .queue import partitionload
+from .routing import cached_sample
+
+def node_fits(node, cores):
+# Whether the node has the cores idle and their share of its memory free
+    if node['idle'] < cores:
+        return False
+    if node['memory'] is None or not node['totalmemory'] or not node['cores']:
+        return True
+    return node['memory'] >= node['totalmemory']*cores/node['cores']
+
+def fits(nodes, nproc, nhost):
+    percore = math.ceil(nproc/nhost)
+    return sum(1 for node in nodes if node_fits(node, percore)) >= nhost
+
+def reshape(nodes, nproc, limits):
+# Largest shape within the limits of the program that fits the idle nodes, fewest hosts first
+    minproc = limits.get('minproc', 1)
+    maxhost = limits.get('maxhost', 1)
+    for cores in range(min(nproc, limits.get('maxproc', nproc)), minproc - 1, -1):
+        for hosts in range(1, maxhost + 1):
+            if fits(nodes, cores, hosts):
+                return cores, hosts
+    return None
+
+def choose_partition(nproc, nhost, candidates=None, reshaping=False):
+# Partition with the earliest feasible start for the request and the shape to ask for in it
+    load = cached_sample(paths.jobq/f'partitions-{config.queuespecfile}', partitionload)
+    if not load:
+        return None
+    limits = config.get('reshape', {}) if reshaping and config.parallel.lower() != 'none' else {}
+    best = None
+    for partition, nodes in load['nodes'].items():
+        if candidates and partition not in candidates:
+            continue
+        # Skip the partitions whose nodes could not take the job even when empty
+        capacity = [dict(node, idle=node['cores'], memory=node['totalmemory']) for node in nodes]
+        if not fits(capacity, nproc, nhost) and not (limits and reshape(capacity, nproc, limits)):
+            continue
+        totalcores = sum(node['cores'] for node in nodes) or 1
+        pending = load['pending'].get(partition, 0)
+        if fits(nodes, nproc, nhost):
+            shape = nproc, nhost
+        elif limits:
+            shape = reshape(nodes, nproc, limits)
+        else:
+            shape = None
+        if shape:
+            # Starts now, the larger shape and the shorter queue win
+            score = (0, -shape[0], pending/totalcores)
+        else:
+            # Waits about as many turnovers of the partition as cores are queued ahead
+            score = (1, (pending + nproc)/totalcores, 0)
+            shape = nproc, nhost
+        if best is None or score < best[0]:
+            best = score, partition, shape
+    if best is None:
+        return None
+    return best[1], best[2]
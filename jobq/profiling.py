@@ -0,0 +1,102 @@
+import os
+import sys
+import json
+import time
+from contextlib import contextmanager
+from .shared import profiledata as prof
+
+# Profiling is off unless --profile is given so every hook starts with a cheap flag check
+
+def syscalls():
+# Read and write class system calls issued so far by this process (Linux only)
+    try:
+        with open('/proc/self/io', 'rb') as f:
+            stats = dict(line.split(b':', 1) for line in f.read().splitlines())
+        return int(stats[b'syscr']) + int(stats[b'syscw'])
+    except (OSError, KeyError, ValueError):
+        return 0
+
+def enable(start, trace=None):
+# Start profiling as if it had been enabled at the given perf_counter time
+    prof.enabled = True
+    if trace:
+        prof.tracefile = open(trace, 'w')
+    prof.counters['syscalls'] -= syscalls()
+    prof.lastmark = start
+
+def record(name, seconds):
+    prof.phasetimes[name] += seconds
+    prof.phasecounts[name] += 1
+    if prof.jobspan is not None:
+        prof.jobspan['phases'][name] = prof.jobspan['phases'].get(name, 0.0) + seconds
+
+def lap(name):
+# Charge the time elapsed since the last mark to the given phase
+    if not prof.enabled:
+        return
+    now = time.perf_counter()
+    record(name, now - prof.lastmark)
+    prof.lastmark = now
+
+@contextmanager
+def phase(name):
+# Time a nested block, the enclosing laps do not count it twice
+    if not prof.enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        prof.lastmark = time.perf_counter()
+        record(name, prof.lastmark - start)
+
+def count(name, amount=1):
+    if prof.enabled:
+        prof.counters[name] += amount
+        if prof.jobspan is not None:
+            prof.jobspan['counters'][name] = prof.jobspan['counters'].get(name, 0) + amount
+
+def copied(path):
+# Count the size of a staged file without an extra stat when profiling is off
+    if prof.enabled:
+        count('bytes', os.path.getsize(path))
+
+@contextmanager
+def span(name):
+# Group the phases of a single job and append them to the trace
+    if not prof.enabled:
+        yield
+        return
+    prof.jobspan = {'job': name, 'start': time.time(), 'phases': {}, 'counters': {}}
+    before = syscalls()
+    try:
+        yield
+    finally:
+        lap('other')
+        prof.jobspan['counters']['syscalls'] = syscalls() - before
+        if prof.tracefile:
+            prof.tracefile.write(json.dumps(prof.jobspan) + '\n')
+        prof.jobspan = None
+
+def rename(name):
+    if prof.jobspan is not None:
+        prof.jobspan['job'] = name
+
+def report():
+    if not prof.enabled:
+        return
+    lap('other')
+    prof.counters['syscalls'] += syscalls()
+    if prof.tracefile:
+        # The last line of the trace holds the totals of the whole run
+        prof.tracefile.write(json.dumps({'phases': prof.phasetimes, 'counts': prof.phasecounts, 'counters': prof.counters}) + '\n')
+        prof.tracefile.close()
+    total = sum(prof.phasetimes.values())
+    lines = ['{:<16} {:>8} {:>12} {:>12} {:>7}'.format('phase', 'count', 'total (ms)', 'mean (ms)', '%')]
+    for name, seconds in sorted(prof.phasetimes.items(), key=lambda item: -item[1]):
+        lines.append('{:<16} {:>8} {:>12.2f} {:>12.3f} {:>7.1f}'.format(name, prof.phasecounts[name], 1e3*seconds, 1e3*seconds/prof.phasecounts[name], 100*seconds/total if total else 0))
+    lines.append('')
+    for name, value in sorted(prof.counters.items()):
+        lines.append('{:<16} {:>8}'.format(name, value))
+    print('\n'.join(lines), file=sys.stderr)
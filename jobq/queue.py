@@ -1,25 +1,116 @@
 import os
 import re
-import sys
+import time
+import random
+from datetime import datetime
 from subprocess import Popen, PIPE
-from .shared import config
+from .shared import config, names, environment
+from .utils import ConfigTemplate
+from . import profiling, metrics
 
-def submitjob(jobscript):
-    with open(jobscript, 'r') as fh:
-        process = Popen(config.sbmtcmd, stdin=fh, stdout=PIPE, stderr=PIPE, close_fds=True)
-    output, error = process.communicate()
-    output = output.decode(sys.stdout.encoding).strip()
-    error = error.decode(sys.stdout.encoding).strip()
+unsuremessage = 'El trabajo pudo haberse enviado de todas formas, revise la cola antes de enviarlo de nuevo'
+
+class TransientError(RuntimeError):
+    pass
+
+class UnsureError(TransientError):
+# The reply of the scheduler was lost and the job may have been accepted anyway
+    pass
+
+def errorclass(error):
+# Reduce a scheduler error message to a short class for the failure metrics
+    for regex, label in config.get('errorclasses', {}).items():
+        if re.search(regex, error):
+            return label
+    return 'other'
+
+def submitjob(jobscript, array=False):
+    profiling.count('subprocesses')
+    start = time.perf_counter()
+    with profiling.phase('submit'), open(jobscript, 'r') as fh:
+        process = Popen(config.sbmtcmd, stdin=fh, stdout=PIPE, stderr=PIPE, close_fds=True, universal_newlines=True, env=dict(environment))
+        output, error = process.communicate()
+    metrics.observe('jobq_submit_latency_seconds', time.perf_counter() - start, scheduler=config.scheduler)
+    output = output.strip()
+    error = error.strip()
     if process.returncode == 0:
+        if array and 'arraysbmtregex' in config:
+            return re.fullmatch(config.arraysbmtregex, output).group(1)
         return re.fullmatch(config.sbmtregex, output).group(1)
     else:
+        metrics.inc('jobq_submit_failures_total', scheduler=config.scheduler, errorclass=errorclass(error))
+        # A timeout may come after the job was accepted, retrying it blindly would submit it twice
+        for regex in config.get('unsureerrors', []):
+            if re.search(regex, error):
+                if 'findcmd' in config:
+                    raise UnsureError(error)
+                raise RuntimeError(f'{error}\n{unsuremessage}')
+        # Errors of an overloaded or restarting scheduler are worth retrying
+        for regex in config.get('transienterrors', []):
+            if re.search(regex, error):
+                raise TransientError(error)
         raise RuntimeError(error)
-        
-def getjobstatus(jobid):
-    process = Popen(config.statcmd + [jobid], stdout=PIPE, stderr=PIPE, close_fds=True)
+
+def retrysubmit(jobscript, jobname, array=False, attempts=None):
+# Submit retrying the transient errors with exponential backoff and full jitter
+    if attempts is None:
+        attempts = config.get('submitattempts', 5)
+    backoff = float(config.get('submitbackoff', 1))
+    # Time of the first submission whose reply was lost
+    unsure = None
+    for attempt in range(1, attempts + 1):
+        try:
+            if unsure is not None:
+                jobid = findjob(jobname, unsure)
+                if jobid is not None:
+                    return jobid
+            start = time.time()
+            return submitjob(jobscript, array)
+        except UnsureError as error:
+            if unsure is None:
+                unsure = start
+            if attempt == attempts:
+                raise RuntimeError(f'{error}\n{unsuremessage}')
+        except TransientError as error:
+            if attempt == attempts:
+                # A postponed job could be submitted twice
+                if unsure is not None:
+                    raise RuntimeError(f'{error}\n{unsuremessage}')
+                raise
+        delay = random.uniform(0, min(60, backoff*2**(attempt - 1)))
+        metrics.inc('jobq_submit_retries_total', scheduler=config.scheduler)
+        with profiling.phase('backoff'):
+            time.sleep(delay)
+
+def findjob(jobname, since):
+# Return the id of a job named jobname that the scheduler accepted after since or None
+    profiling.count('subprocesses')
+    command = [ConfigTemplate(i).substitute(jobname=jobname, user=names.user) for i in config.findcmd]
+    process = Popen(command, stdout=PIPE, stderr=PIPE, close_fds=True, universal_newlines=True, env=dict(environment))
     output, error = process.communicate()
-    output = output.decode(sys.stdout.encoding).strip()
-    error = error.decode(sys.stdout.encoding).strip()
+    if process.returncode != 0:
+        raise TransientError(error.strip())
+    for line in output.splitlines():
+        match = re.fullmatch(config.findregex, line.strip())
+        if match is None:
+            continue
+        # Allow for a controller clock slightly behind this one
+        try:
+            if datetime.fromisoformat(match.group('submit')).timestamp() >= since - 10:
+                return match.group('jobid')
+        except ValueError:
+            continue
+    return None
+
+def getjobstatus(jobid):
+    profiling.count('subprocesses')
+    start = time.perf_counter()
+    with profiling.phase('status'):
+        process = Popen(config.statcmd + [jobid], stdout=PIPE, stderr=PIPE, close_fds=True, universal_newlines=True, env=dict(environment))
+        output, error = process.communicate()
+    metrics.observe('jobq_status_query_seconds', time.perf_counter() - start, scheduler=config.scheduler)
+    output = output.strip()
+    error = error.strip()
     if process.returncode == 0:
         if not output:
             return True, None
@@ -37,3 +128,95 @@ def getjobstatus(jobid):
             if re.fullmatch(regex, error):
                 return True, None
         return False, f'El trabajo "$name" no se envió porque ocurrió un error al consultar su estado:\n{error}'
+
+def getjobstate(jobid):
+# Return the scheduler state of the job or None if the scheduler no longer knows it
+    process = Popen(config.statcmd + [jobid], stdout=PIPE, stderr=PIPE, close_fds=True, universal_newlines=True, env=dict(environment))
+    output, error = process.communicate()
+    output = output.strip()
+    error = error.strip()
+    if process.returncode == 0:
+        if not output:
+            return None
+        match = re.fullmatch(config.statregex, output)
+        if match is None:
+            raise RuntimeError(output)
+        return match.group(1)
+    else:
+        for regex in config.ignorederrors:
+            if re.fullmatch(regex, error):
+                return None
+        raise RuntimeError(error)
+
+def queueload():
+# Pending jobs and idle cores of the scheduler, None where the specfile does not say how to get them
+    load = dict(pending=None, idle=None)
+    if 'pendingcmd' in config:
+        process = Popen(config.pendingcmd, stdout=PIPE, stderr=PIPE, close_fds=True, universal_newlines=True, env=dict(environment))
+        output, error = process.communicate()
+        if process.returncode == 0:
+            if 'pendingregex' in config:
+                load['pending'] = len(re.findall(config.pendingregex, output, re.MULTILINE))
+            else:
+                load['pending'] = sum(1 for line in output.splitlines() if line.strip())
+    if 'idlecmd' in config:
+        process = Popen(config.idlecmd, stdout=PIPE, stderr=PIPE, close_fds=True, universal_newlines=True, env=dict(environment))
+        output, error = process.communicate()
+        if process.returncode == 0:
+            load['idle'] = 0
+            # Every match is a number of idle cores, the free part of a host or a free node
+            for match in re.finditer(config.idleregex, output, re.MULTILINE):
+                groups = match.groupdict()
+                if groups.get('idle') is not None:
+                    load['idle'] += int(groups['idle'])
+                elif groups.get('total') is not None:
+                    load['idle'] += max(0, int(groups['total']) - int(groups.get('used') or 0))
+                else:
+                    load['idle'] += 1
+    return load
+
+def partitionload():
+# Idle cores and free memory of the nodes of every partition and the cores pending in each, None if unknown
+    if 'partitioncmd' not in config:
+        return None
+    process = Popen(config.partitioncmd, stdout=PIPE, stderr=PIPE, close_fds=True, universal_newlines=True, env=dict(environment))
+    output, error = process.communicate()
+    if process.returncode != 0:
+        return None
+    nodes = {}
+    pending = {}
+    for match in re.finditer(config.partitionregex, output, re.MULTILINE):
+        groups = match.groupdict()
+        # Only the ratio of free to total memory is used, so the units do not matter
+        memory = groups.get('memory')
+        totalmemory = groups.get('totalmemory')
+        nodes.setdefault(groups['partition'], []).append(dict(
+            idle = int(groups['idle']),
+            cores = int(groups['cores']),
+            memory = int(memory) if memory and memory.isdigit() else None,
+            totalmemory = int(totalmemory) if totalmemory and totalmemory.isdigit() else None,
+        ))
+    if 'partitionpendingcmd' in config:
+        process = Popen(config.partitionpendingcmd, stdout=PIPE, stderr=PIPE, close_fds=True, universal_newlines=True, env=dict(environment))
+        output, error = process.communicate()
+        if process.returncode == 0:
+            for match in re.finditer(config.partitionpendingregex, output, re.MULTILINE):
+                pending[match.group('partition')] = pending.get(match.group('partition'), 0) + int(match.group('cores'))
+    return dict(nodes=nodes, pending=pending)
+
+def controljobs(action, jobids):
+# Cancel, hold, release or requeue several jobs with one call to the scheduler per chunk of ids
+    jobids = list(jobids)
+    chunksize = int(config.get('controlchunk', 500))
+    for start in range(0, len(jobids), chunksize):
+        chunk = jobids[start:start + chunksize]
+        # Commands that take a single comma separated list have it in place of &jobids
+        if '&jobids' in config[f'{action}cmd']:
+            command = [ConfigTemplate(i).substitute(jobids=','.join(chunk)) for i in config[f'{action}cmd']]
+        else:
+            command = config[f'{action}cmd'] + chunk
+        profiling.count('subprocesses')
+        process = Popen(command, stdout=PIPE, stderr=PIPE, close_fds=True, universal_newlines=True, env=dict(environment))
+        output, error = process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError(error.strip() or output.strip())
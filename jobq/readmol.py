@@ -1,51 +1,127 @@
+import io
+import os
+import re
+import gzip
+import lzma
+import json
+import mmap
+import hashlib
+import struct
+import zipfile
+from array import array
+from collections import deque
+from itertools import islice, count
+import numpy
 from clinterface import messages, _
+from .shared import paths
 #from logging import WARNING
 
 class ParseError(Exception):
     def __init__(self, *message):
         super().__init__(' '.join(message))
 
-def molblock(coords, progspecfile):
+class Frame:
+# Atomic coordinates as a float64 (N,3) array plus an index into the element list for each atom
+    def __init__(self, elements, species, coords):
+        self.elements = elements
+        self.species = species
+        self.coords = coords
+    def __len__(self):
+        return len(self.species)
+    def symbols(self):
+        return numpy.array(self.elements)[self.species]
+    @classmethod
+    def fromtable(cls, symbols, coords):
+        # Number elements by first appearance
+        elements, first, inverse = numpy.unique(symbols, return_index=True, return_inverse=True)
+        order = numpy.argsort(first)
+        rank = numpy.empty_like(order)
+        rank[order] = numpy.arange(len(order))
+        return cls([str(e) for e in elements[order]], rank[inverse.ravel()], numpy.asarray(coords, dtype=numpy.float64).reshape(-1, 3))
+
+def molblock(frame, progspecfile):
+# Format the whole block with a single format operation
     if progspecfile in ('gaussian.json', 'demon2k.json'):
-        return '\n'.join('{:<2s}  {:10.4f}  {:10.4f}  {:10.4f}'.format(*line) for line in coords)
-    elif progspecfile in ('dftbplus.json'):
-       atoms = []
-       blocklines = []
-       for line in coords:
-           if not line[0] in atoms:
-               atoms.append(line[0])
-       blocklines.append(f'{len(coords):5} C')
-       blocklines.append(' '.join(atoms))
-       for i, line in enumerate(coords, start=1):
-           blocklines.append(f'{i:5}  {atoms.index(line[0])+1:3}  {line[1]:10.4f}  {line[2]:10.4f}  {line[3]:10.4f}')
-       return '\n'.join(blocklines)
+        table = numpy.empty((len(frame), 4), dtype=object)
+        table[:, 0] = frame.symbols()
+        table[:, 1:] = frame.coords
+        return '\n'.join(['%-2s  %10.4f  %10.4f  %10.4f'] * len(frame)) % tuple(table.ravel().tolist())
+    elif progspecfile == 'dftbplus.json':
+        table = numpy.empty((len(frame), 5), dtype=object)
+        table[:, 0] = numpy.arange(1, len(frame) + 1)
+        table[:, 1] = frame.species + 1
+        table[:, 2:] = frame.coords
+        blocklines = [f'{len(frame):5} C', ' '.join(frame.elements)]
+        blocklines.append('\n'.join(['%5d  %3d  %10.4f  %10.4f  %10.4f'] * len(frame)) % tuple(table.ravel().tolist()))
+        return '\n'.join(blocklines)
     else:
-       messages.error(_('Formato desconocido'), f'molformat={molformat}')
+        messages.error(_('Formato desconocido'), f'progspecfile={progspecfile}')
+
+class TrajectoryBlocks(dict):
+# Format the selected frames of a trajectory as molblocks only when they are looked up as mol1, mol2, ...
+    def __init__(self, molfile, progspecfile, frames=slice(None)):
+        super().__init__()
+        self.molfile = molfile
+        self.progspecfile = progspecfile
+        self.selection = frames
+        self.offsets = None
+        self.frames = None
+        self.position = 0
+        self.lastblock = None
+    def __missing__(self, key):
+        match = re.fullmatch(r'mol([1-9][0-9]*)', key)
+        if match is None:
+            raise KeyError(key)
+        index = int(match.group(1))
+        if self.lastblock and self.lastblock[0] == index:
+            return self.lastblock[1]
+        if self.molfile.hasext('.xyz'):
+            # Random access through the frame index
+            if self.offsets is None:
+                self.offsets = xyzindex(self.molfile)
+            try:
+                position = range(len(self.offsets))[self.selection][index - 1]
+            except IndexError:
+                raise KeyError(key)
+            coords = readxyzframe(self.molfile, self.offsets[position])
+            self.lastblock = (index, molblock(coords, self.progspecfile))
+            return self.lastblock[1]
+        if self.frames is None or index <= self.position:
+            self.frames = readmol(self.molfile, self.selection)
+            self.position = 0
+        for coords in self.frames:
+            self.position += 1
+            if self.position == index:
+                self.lastblock = (index, molblock(coords, self.progspecfile))
+                return self.lastblock[1]
+        self.frames = None
+        raise KeyError(key)
 
-def readmol(molfile):
-# Guess format and read molfile
+def readmol(molfile, frames=slice(None)):
+# Guess format and return an iterator over the selected frames of molfile
     if molfile.isfile():
-        with open(molfile, mode='r') as fh:
-            if molfile.hasext('.mol'):
-                try:
-                    return parsemdl(fh)
-                except ParseError:
-                    try:
-                        return parsexyz(fh)
-                    except ParseError:
-                        messages.error(_('$file no es un archivo de coordenadas válido', file=molfile))
-            elif molfile.hasext('.xyz'):
-                try:
-                    return parsexyz(fh)
-                except ParseError as e:
-                    messages.error(_('$file no es un archivo XYZ válido', file=molfile))
-            elif molfile.hasext('.log'):
+        if molfile.suffix in compressions:
+            if os.path.splitext(molfile.stem)[1] == '.mol':
+                return selectframes(molfile, (parsemdl, parsexyz), _('$file no es un archivo de coordenadas válido', file=molfile), frames)
+            elif os.path.splitext(molfile.stem)[1] == '.xyz':
+                return selectframes(molfile, (parsexyz,), _('$file no es un archivo XYZ válido', file=molfile), frames)
+            else:
+                messages.error(_('Solamente se pueden leer archivos mol y xyz comprimidos'))
+        elif molfile.hasext('.mol'):
+            return selectframes(molfile, (parsemdl, parsexyz), _('$file no es un archivo de coordenadas válido', file=molfile), frames)
+        elif molfile.hasext('.xyz'):
+            return indexedframes(molfile, frames)
+        elif molfile.hasext('.log'):
+            if frames == slice(-1, None):
                 try:
-                    return parseglf(fh)
+                    return iter([lastglfgeom(molfile)])
                 except ParseError:
-                    messages.error(_('$file no es un archivo de salida de gaussian válido', file=molfile))
-            else:
-                messages.error(_('Solamente se pueden leer archivos mol, xyz y log'))
+                    pass
+            return selectframes(molfile, (parseglf, parseccl), _('$file no es un archivo de salida de gaussian válido', file=molfile), frames)
+        elif molfile.suffix in ('.npy', '.npz', '.dcd'):
+            return binaryframes(molfile, frames)
+        else:
+            messages.error(_('Solamente se pueden leer archivos mol, xyz, log, npy, npz y dcd'))
     elif molfile.isdir():
         messages.error(_('El archivo $file es un directorio', file=molfile))
     elif molfile.exists():
@@ -53,36 +129,269 @@ def readmol(molfile):
     else:
         messages.error(_('El archivo $file no existe', file=molfile))
 
+def molstem(molfile):
+# Name of molfile without its format and compression extensions
+    if molfile.suffix in compressions:
+        return os.path.splitext(molfile.stem)[0]
+    return molfile.stem
+
+def enumframes(molfile, frames=slice(None)):
+# Pair each selected frame with its position in molfile
+    if (frames.step or 1) > 0 and (frames.start or 0) >= 0:
+        return zip(count(frames.start or 0, frames.step or 1), readmol(molfile, frames))
+    return zip(range(countframes(molfile))[frames], readmol(molfile, frames))
+
+def countframes(molfile):
+    if molfile.hasext('.xyz'):
+        return len(xyzindex(molfile))
+    return sum(1 for frame in readmol(molfile))
+
+def openmol(molfile):
+# Open a text molfile decompressing it on the fly
+    if molfile.suffix == '.gz':
+        return gzip.open(molfile, mode='rt')
+    elif molfile.suffix == '.xz':
+        return lzma.open(molfile, mode='rt')
+    elif molfile.suffix == '.zst':
+        try:
+            import zstandard
+        except ImportError:
+            messages.error(_('Debe instalar zstandard para poder leer el archivo de coordenadas'))
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(molfile, mode='rb'), read_across_frames=True, closefd=True))
+    else:
+        return open(molfile, mode='r')
+
+def readlast(molfile):
+# Read only the last frame of molfile
+    return next(readmol(molfile, slice(-1, None)))
+
+def selectframes(molfile, parsers, errormessage, frames):
+# Select frames from formats that can only be read sequentially
+    if frames == slice(None):
+        return iterframes(molfile, parsers, errormessage)
+    if all(i is None or i >= 0 for i in (frames.start, frames.stop)) and (frames.step or 1) > 0:
+        return islice(iterframes(molfile, parsers, errormessage), frames.start, frames.stop, frames.step)
+    if frames.start is not None and frames.start < 0 and frames.stop is None and (frames.step or 1) == 1:
+        return iter(deque(iterframes(molfile, parsers, errormessage), maxlen=-frames.start))
+    # Other negative indices require the number of frames
+    total = sum(1 for coords in iterframes(molfile, parsers, errormessage))
+    selected = range(total)[frames]
+    if selected.step < 0:
+        messages.error(_('No se pueden leer en orden inverso los pasos del archivo $file', file=molfile))
+    return islice(iterframes(molfile, parsers, errormessage), selected.start, selected.stop, selected.step)
+
+def indexedframes(molfile, frames):
+# Read the selected frames of an XYZ file seeking to their offsets
+    offsets = xyzindex(molfile)
+    if not offsets:
+        messages.error(_('El archivo de coordenadas está vacío'))
+    for position in range(len(offsets))[frames]:
+        yield readxyzframe(molfile, offsets[position])
+
+def readxyzframe(molfile, offset):
+    with open(molfile, 'rb') as fh:
+        fh.seek(offset)
+        try:
+            return next(parsexyz(line.decode() for line in fh))
+        except ParseError:
+            messages.error(_('$file no es un archivo XYZ válido', file=molfile))
+
+# Smaller files are scanned again every time instead of caching their index
+indexminsize = 64 << 20
+
+def xyzindex(molfile):
+# Return the byte offsets of the frames of an XYZ file, large files keep them in the jobq directory
+    stat = os.stat(molfile)
+    indexfile = paths.jobq/'xyzindex'/(hashlib.sha1(str(molfile).encode()).hexdigest() + '.idx')
+    try:
+        with open(indexfile, 'rb') as f:
+            header = json.loads(f.readline())
+            if header['path'] == str(molfile) and header['size'] == stat.st_size and header['mtime'] == stat.st_mtime_ns:
+                offsets = array('q')
+                offsets.frombytes(f.read())
+                return offsets
+    except (OSError, ValueError, KeyError):
+        pass
+    offsets = array('q')
+    if stat.st_size > 0:
+        with open(molfile, 'rb') as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = len(mm)
+            position = 0
+            framesize = 0
+            while position < size:
+                end = mm.find(b'\n', position)
+                header = mm[position:end if end >= 0 else size]
+                if not header.strip():
+                    break
+                try:
+                    natom = int(header)
+                except ValueError:
+                    messages.error(_('$file no es un archivo XYZ válido', file=molfile))
+                offsets.append(position)
+                # Most trajectories repeat the frame size, so try it before scanning line by line
+                if framesize and mm[position+framesize-1:position+framesize] == b'\n' and mm[position:position+framesize].count(b'\n') == natom + 2:
+                    position += framesize
+                    continue
+                start = position
+                for i in range(natom + 2):
+                    end = mm.find(b'\n', position)
+                    if end < 0:
+                        if i < natom + 1:
+                            messages.error(_('$file no es un archivo XYZ válido', file=molfile))
+                        end = size - 1
+                    position = end + 1
+                framesize = position - start
+    if stat.st_size < indexminsize:
+        return offsets
+    try:
+        indexfile.parent().makedirs()
+        tmpfile = indexfile.parent()/(indexfile.name + f'.{os.getpid()}')
+        with open(tmpfile, 'wb') as f:
+            f.write(json.dumps({'path': str(molfile), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}).encode() + b'\n')
+            f.write(offsets.tobytes())
+        os.replace(tmpfile, indexfile)
+    except OSError:
+        pass
+    return offsets
+
+def iterframes(molfile, parsers, errormessage):
+# Yield frames one at a time with the first parser that accepts the file
+    for parser in parsers:
+        with openmol(molfile) as fh:
+            frames = parser(fh)
+            try:
+                first = next(frames)
+            except ParseError:
+                continue
+            yield first
+            try:
+                yield from frames
+            except ParseError:
+                messages.error(errormessage)
+            return
+    messages.error(errormessage)
+
+def binaryframes(molfile, frames):
+# Slice frames from binary coordinate arrays without reading the whole file
+    if molfile.hasext('.npy'):
+        coords = numpy.load(molfile, mmap_mode='r')
+    elif molfile.hasext('.npz'):
+        coords = npzmember(molfile, 'coords')
+    else:
+        coords = DCDArray(molfile)
+    if coords.ndim == 2:
+        coords = coords.reshape((1,) + coords.shape)
+    if coords.ndim != 3 or coords.shape[2] != 3:
+        messages.error(_('Las coordenadas del archivo $file deben tener dimensiones (pasos, átomos, 3)', file=molfile))
+    if molfile.hasext('.npz'):
+        with numpy.load(molfile) as npz:
+            if 'elements' in npz:
+                topology = Frame.fromtable(npz['elements'].astype(str), numpy.zeros((coords.shape[1], 3)))
+            elif 'atomnos' in npz:
+                topology = Frame.fromtable([elements[i] for i in npz['atomnos']], numpy.zeros((coords.shape[1], 3)))
+            else:
+                messages.error(_('El archivo $file no contiene los elementos de los átomos', file=molfile))
+    else:
+        topology = findtopology(molfile)
+    if len(topology) != coords.shape[1]:
+        messages.error(_('El número de átomos del archivo $file no coincide con su topología', file=molfile))
+    for position in range(coords.shape[0])[frames]:
+        yield Frame(topology.elements, topology.species, numpy.array(coords[position], dtype=numpy.float64))
+
+def findtopology(molfile):
+# Binary trajectories take their elements from a mol or xyz file with the same name
+    for ext in ('xyz', 'mol'):
+        for suffix in ('',) + compressions:
+            path = molfile.parent()/(molfile.stem + '.' + ext + suffix)
+            if path.isfile():
+                return next(readmol(path))
+    messages.error(_('No se encontró un archivo mol o xyz con los elementos de los átomos de $file', file=molfile))
+
+def npzmember(molfile, name):
+# Memory map a member of an uncompressed npz archive or load it if compressed
+    with zipfile.ZipFile(molfile) as archive:
+        try:
+            info = archive.getinfo(name + '.npy')
+        except KeyError:
+            messages.error(_('El archivo $file no contiene el arreglo $name', file=molfile, name=name))
+        if info.compress_type != zipfile.ZIP_STORED:
+            with archive.open(info) as f:
+                return numpy.lib.format.read_array(f)
+    with open(molfile, 'rb') as f:
+        f.seek(info.header_offset)
+        local = f.read(30)
+        namelength, extralength = struct.unpack('<HH', local[26:30])
+        f.seek(info.header_offset + 30 + namelength + extralength)
+        version = numpy.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran, dtype = numpy.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran, dtype = numpy.lib.format.read_array_header_2_0(f)
+        return numpy.memmap(molfile, dtype=dtype, mode='r', offset=f.tell(), shape=shape, order='F' if fortran else 'C')
+
+class DCDArray:
+# Read only view of the coordinates of a CHARMM/NAMD DCD file indexed by frame
+    def __init__(self, molfile):
+        with open(molfile, 'rb') as f:
+            header = f.read(92)
+            if len(header) < 92:
+                messages.error(_('$file no es un archivo DCD válido', file=molfile))
+            for endian in ('<', '>'):
+                if struct.unpack(endian + 'i', header[:4])[0] == 84 and header[4:8] == b'CORD':
+                    break
+            else:
+                messages.error(_('$file no es un archivo DCD válido', file=molfile))
+            icntrl = struct.unpack(endian + '20i', header[8:88])
+            if icntrl[8]:
+                messages.error(_('No se pueden leer archivos DCD con átomos fijos'))
+            cellblock = 56 if icntrl[19] and icntrl[10] else 0
+            titlesize, = struct.unpack(endian + 'i', f.read(4))
+            f.seek(titlesize + 4, os.SEEK_CUR)
+            f.seek(4, os.SEEK_CUR)
+            natom, = struct.unpack(endian + 'i', f.read(4))
+            f.seek(4, os.SEEK_CUR)
+            self.start = f.tell()
+        self.mm = numpy.memmap(molfile, dtype='u1', mode='r')
+        self.dtype = numpy.dtype(endian + 'f4')
+        self.natom = natom
+        self.cellblock = cellblock
+        self.framesize = cellblock + 3*(8 + 4*natom)
+        self.ndim = 3
+        self.shape = ((len(self.mm) - self.start)//self.framesize, natom, 3)
+    def __getitem__(self, position):
+        base = self.start + position*self.framesize + self.cellblock
+        axes = [numpy.frombuffer(self.mm, dtype=self.dtype, count=self.natom, offset=base + i*(8 + 4*self.natom) + 4) for i in range(3)]
+        return numpy.stack(axes, axis=1)
+
 def parsexyz(fh):
-# Parse XYZ molfile
-    fh.seek(0)
-    trajectory = []
+# Parse XYZ molfile one frame at a time
+    empty = True
     while True:
-        coords = []
         try:
             natom = next(fh)
         except StopIteration:
-            if trajectory:
-                return trajectory
-            else:
+            if empty:
                 messages.error(_('El archivo de coordenadas está vacío'))
+            return
         try:
             natom = int(natom)
         except ValueError:
             raise ParseError(_('Invalid format'))
         try:
             title = next(fh)
-            for line in range(natom):
-                e, x, y, z, *_ = next(fh).split()
-                coords.append((e, float(x), float(y), float(z)))
+            lines = [next(fh) for i in range(natom)]
         except StopIteration:
             raise ParseError(_('Unexpected end of file'))
-        trajectory.append(coords)
+        try:
+            table = numpy.array([line.split()[:4] for line in lines], dtype=str).reshape(natom, 4)
+            frame = Frame.fromtable(table[:, 0], table[:, 1:].astype(numpy.float64))
+        except ValueError:
+            raise ParseError(_('Invalid format'))
+        empty = False
+        yield frame
 
 # Parse MDL molfile
 def parsemdl(fh):
-    fh.seek(0)
-    coords = []
     try:
         title = next(fh)
     except StopIteration:
@@ -90,26 +399,85 @@ def parsemdl(fh):
     try:
         metadata = next(fh)
         comment = next(fh)
-        natom, nbond, *_ = next(fh).split()
+        natom, nbond, *extra = next(fh).split()
         try:
             natom = int(natom)
             nbond = int(nbond)
         except ValueError:
             raise ParseError(_('Invalid format'))
-        for _ in range(natom):
-            x, y, z, e, *_ = next(fh).split()
-            coords.append((e, float(x), float(y), float(z)))
-        for _ in range(nbond):
+        lines = [next(fh) for i in range(natom)]
+        for i in range(nbond):
             next(fh)
     except StopIteration:
         raise ParseError(_('Unexpected end of file'))
+    except ValueError:
+        raise ParseError(_('Invalid format'))
+    try:
+        table = numpy.array([line.split()[:4] for line in lines], dtype=str).reshape(natom, 4)
+        frame = Frame.fromtable(table[:, 3], table[:, :3].astype(numpy.float64))
+    except ValueError:
+        raise ParseError(_('Invalid format'))
     for line in fh:
         if line.split()[0] != 'M':
             raise ParseError(_('Invalid format'))
-    return [coords]
+    yield frame
 
-# Parse Gaussian logfile
+# Parse Gaussian logfile streaming its orientation tables
 def parseglf(fh):
+    header = glfheader(fh).decode()
+    empty = True
+    for line in fh:
+        if line.strip() == header:
+            empty = False
+            yield glftable(fh)
+    if empty:
+        raise ParseError(_('Invalid format'))
+
+def lastglfgeom(molfile):
+# Read the last geometry of a Gaussian logfile scanning it backwards
+    with open(molfile, 'rb') as fh:
+        orientation = glfheader(fh)
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            position = mm.rfind(orientation)
+            if position < 0:
+                raise ParseError(_('Invalid format'))
+            mm.seek(position)
+            mm.readline()
+            return glftable(line.decode() for line in iter(mm.readline, b''))
+
+def glfheader(fh):
+# Prefer the standard orientation unless symmetry was turned off
+    try:
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm.find(b'Standard orientation:') >= 0:
+                return b'Standard orientation:'
+            elif mm.find(b'Input orientation:') >= 0:
+                return b'Input orientation:'
+    except ValueError:
+        pass
+    raise ParseError(_('Invalid format'))
+
+def glftable(lines):
+    lines = iter(lines)
+    try:
+        for i in range(4):
+            next(lines)
+        rows = []
+        for line in lines:
+            if line.lstrip().startswith('-'):
+                break
+            rows.append(line.split())
+        else:
+            raise ParseError(_('Unexpected end of file'))
+        table = numpy.array(rows, dtype=str)
+        atomnos = table[:, 1].astype(int)
+        coords = table[:, -3:].astype(numpy.float64)
+        return Frame.fromtable([elements[i] if i > 0 else 'Bq' for i in atomnos], coords)
+    except (StopIteration, ValueError, IndexError):
+        raise ParseError(_('Invalid format'))
+
+# Parse Gaussian logfile with cclib
+def parseccl(fh):
     try:
         import cclib
     except ImportError:
@@ -121,4 +489,18 @@ def parseglf(fh):
     except Exception:
         raise ParseError(_('Invalid format'))
     pt = cclib.parser.utils.PeriodicTable()
-    return [(pt.element[data.atomnos[i]], e[0], e[1], e[2]) for i, e in enumerate(data.atomcoords[-1])]
+    symbols = [pt.element[i] for i in data.atomnos]
+    for coords in data.atomcoords:
+        yield Frame.fromtable(symbols, coords)
+
+compressions = ('.gz', '.xz', '.zst')
+
+elements = (
+    'X', 'H', 'He', 'Li', 'Be', 'B', 'C', 'N', 'O', 'F', 'Ne', 'Na', 'Mg', 'Al', 'Si', 'P', 'S', 'Cl', 'Ar',
+    'K', 'Ca', 'Sc', 'Ti', 'V', 'Cr', 'Mn', 'Fe', 'Co', 'Ni', 'Cu', 'Zn', 'Ga', 'Ge', 'As', 'Se', 'Br', 'Kr',
+    'Rb', 'Sr', 'Y', 'Zr', 'Nb', 'Mo', 'Tc', 'Ru', 'Rh', 'Pd', 'Ag', 'Cd', 'In', 'Sn', 'Sb', 'Te', 'I', 'Xe',
+    'Cs', 'Ba', 'La', 'Ce', 'Pr', 'Nd', 'Pm', 'Sm', 'Eu', 'Gd', 'Tb', 'Dy', 'Ho', 'Er', 'Tm', 'Yb', 'Lu',
+    'Hf', 'Ta', 'W', 'Re', 'Os', 'Ir', 'Pt', 'Au', 'Hg', 'Tl', 'Pb', 'Bi', 'Po', 'At', 'Rn',
+    'Fr', 'Ra', 'Ac', 'Th', 'Pa', 'U', 'Np', 'Pu', 'Am', 'Cm', 'Bk', 'Cf', 'Es', 'Fm', 'Md', 'No', 'Lr',
+    'Rf', 'Db', 'Sg', 'Bh', 'Hs', 'Mt', 'Ds', 'Rg', 'Cn', 'Nh', 'Fl', 'Mc', 'Lv', 'Ts', 'Og',
+)
@@ -0,0 +1,128 @@
+import os
+import json
+import time
+import hashlib
+from .shared import paths, config, settings
+from .fileutils import AbsPath
+from .jobindex import read_stages
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def text_digest(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def result_key(program, version, command, inputs, parameterpaths, **jobopts):
+# Hash everything that determines the results of a job, inputs maps file keys to content digests
+    contents = dict(program=program, version=version, command=command, inputs=inputs, parameters=[str(i) for i in parameterpaths], options=jobopts)
+    return hashlib.sha256(json.dumps(contents, sort_keys=True).encode()).hexdigest()
+
+def load_results():
+# Index the records of the results file by key, the latest record of a job directory replaces the older ones
+    settings.resultcache = {}
+    settings.resultjobdirs = {}
+    try:
+        with open(paths.jobq/'results.jsonl', 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                # The outputs of a job are added to its record when it is first reused
+                if 'key' not in record:
+                    target = settings.resultjobdirs.get(record['jobdir'])
+                    if target is not None and target.get('jobid') == record['jobid']:
+                        target['outputs'] = record['outputs']
+                    continue
+                settings.resultjobdirs.pop(record['jobdir'], None)
+                settings.resultjobdirs[record['jobdir']] = record
+    except FileNotFoundError:
+        pass
+    for record in settings.resultjobdirs.values():
+        settings.resultcache.setdefault(record['key'], []).insert(0, record)
+
+def cached_result(key):
+# Return the record of a successful job with the same key or None
+    if 'resultcache' not in settings:
+        load_results()
+    # The latest run that finished successfully wins
+    for record in settings.resultcache.get(key, []):
+        # The job directory was submitted again with other inputs
+        if settings.resultjobdirs.get(record['jobdir']) is not record:
+            continue
+        # Records of older versions did not keep the job id and cannot be checked
+        if record.get('jobid') is None:
+            continue
+        # The job directory may have been reused by another job since
+        try:
+            with open(AbsPath(record['jobdir'])/'id', 'r') as f:
+                if f.read() != record['jobid']:
+                    continue
+        except FileNotFoundError:
+            continue
+        stages = read_stages(record['jobdir'])
+        if stages is None or stages['status'] != 0:
+            continue
+        if not check_outputs(record):
+            continue
+        record['stages'] = stages
+        return record
+    return None
+
+def output_files(record):
+# Size and modification time of every output file of a record
+    files = {}
+    for key in config.outputfiles:
+        path = AbsPath(record['outdir'])/record['name']-key
+        if path.isfile():
+            stat = os.stat(path)
+            files[key] = dict(path=path, size=stat.st_size, mtime=stat.st_mtime_ns)
+    return files
+
+def check_outputs(record):
+# Check that the outputs did not change since the first reuse of the job, which records their digests
+    files = output_files(record)
+    known = record.get('outputs')
+    if known is not None:
+        if files.keys() != known.keys():
+            return False
+        # Files with the same size and modification time are not hashed again
+        if all(known[key]['size'] == info['size'] and known[key]['mtime'] == info['mtime'] for key, info in files.items()):
+            return True
+    outputs = {key: dict(digest=file_digest(info['path']), size=info['size'], mtime=info['mtime']) for key, info in files.items()}
+    if known is not None and any(outputs[key]['digest'] != known[key]['digest'] for key in outputs):
+        return False
+    record['outputs'] = outputs
+    append_outputs(record)
+    return True
+
+def record_result(key, jobname, outdir, jobdir, jobid, nproc):
+# Remember a submitted job so that later runs with the same key can reuse its outputs
+    record = dict(key=key, name=jobname, outdir=str(outdir), jobdir=str(jobdir), jobid=jobid, nproc=nproc, time=time.time())
+    if 'resultcache' in settings:
+        # Records of the job that used the directory before no longer apply
+        settings.resultjobdirs[record['jobdir']] = record
+        settings.resultcache.setdefault(key, []).insert(0, record)
+    append_record(record)
+
+def append_record(record):
+    with open(paths.jobq/'results.jsonl', 'a') as f:
+        f.write(json.dumps({k: v for k, v in record.items() if k != 'stages'}) + '\n')
+
+def append_outputs(record):
+# Add the outputs to the record of the job without writing the whole record again
+    with open(paths.jobq/'results.jsonl', 'a') as f:
+        f.write(json.dumps(dict(jobdir=record['jobdir'], jobid=record['jobid'], outputs=record['outputs'])) + '\n')
+
+def saved_hours(record):
+# Core hours that the cached job spent running the program
+    stages = record['stages']
+    if 'run' in stages:
+        seconds = stages['run']['end'] - stages['run']['start']
+    else:
+        seconds = 0
+    return seconds*record['nproc']/3600
@@ -0,0 +1,140 @@
+import os
+import sys
+import json
+import time
+import codecs
+import tempfile
+from subprocess import CalledProcessError, DEVNULL, PIPE, STDOUT, Popen, call, check_output
+from clinterface import messages, _
+from .shared import names, paths, environment
+from .utils import ConfDict
+from .fileutils import AbsPath
+
+# Seconds that a sample of the load of a cluster is reused
+sampleage = 60
+
+# Seconds that an ssh master connection stays open after its last use, the daemon keeps them longer
+controlpersist = 60
+
+# Remote hosts already connected by this process
+connections = {}
+
+# Start of the lines that the remote wrappers write for every submitted job
+reportprefix = '{"jobid": '
+
+policies = ('pending', 'start', 'weighted')
+
+def parse_routes(values):
+# Map every host of --route HOST[:WEIGHT],... to its weight
+    routes = {}
+    for value in values:
+        for item in value.split(','):
+            host, colon, weight = item.partition(':')
+            try:
+                routes[host] = float(weight) if weight else 1.0
+            except ValueError:
+                messages.error(_('El peso del servidor $host no es un número', host=host), f'--route {item}')
+    return routes
+
+def connect_remote(host):
+# Open the multiplexed ssh connection to host, None if it cannot take jobs
+    (paths.home/'.ssh').mkdir()
+    socket = paths.home/'.ssh'/host-'sock'
+    # A live master connection is reused without asking the host again
+    if host in connections and call(['ssh', '-S', socket, '-O', 'check', host], stdout=DEVNULL, stderr=DEVNULL, env=dict(environment)) == 0:
+        return connections[host]
+    try:
+        remotedir = check_output(['ssh', '-o', 'ControlMaster=auto', '-o', f'ControlPersist={controlpersist}', '-S', socket, \
+            host, 'printenv CLUSTERQ_REMOTE_ROOT || true'], stderr=STDOUT, env=dict(environment)).strip().decode(sys.stdout.encoding)
+    except CalledProcessError as e:
+        messages.failure(_('Error al conectar con el servidor $host', host=host), e.output.decode(sys.stdout.encoding).strip())
+        return None
+    if not remotedir:
+        messages.failure(_('El servidor $host no está configurado para aceptar trabajos', host=host))
+        return None
+    connections[host] = ConfDict(dict(socket=socket, remotedir=AbsPath(remotedir)))
+    return connections[host]
+
+def run_remote(arglist):
+# Run the wrapper of a remote host writing its output to sys.stdout, which the daemon sends to its client
+# Return the exit status and the jobs that the wrapper reported
+    process = Popen(arglist, stdout=PIPE, stderr=STDOUT, env=dict(environment))
+    decoder = codecs.getincrementaldecoder(sys.stdout.encoding or 'utf-8')(errors='replace')
+    reports = []
+    pending = ''
+    # Prompts do not end with a newline so the output is not read by lines
+    while True:
+        chunk = os.read(process.stdout.fileno(), 4096)
+        if not chunk:
+            break
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split('\n')
+        for line in lines:
+            if line.startswith(reportprefix):
+                try:
+                    reports.append(json.loads(line))
+                    continue
+                except ValueError:
+                    pass
+            sys.stdout.write(line + '\n')
+        # Only the start of a report is held back until its line is complete
+        if not (reportprefix.startswith(pending) or pending.startswith(reportprefix)):
+            sys.stdout.write(pending)
+            pending = ''
+        sys.stdout.flush()
+    sys.stdout.write(pending)
+    process.stdout.close()
+    return process.wait(), reports
+
+def cached_sample(samplefile, sample):
+# Return the sample saved in samplefile if it is recent enough, otherwise take and save a new one
+    try:
+        if time.time() - os.path.getmtime(samplefile) < sampleage:
+            with open(samplefile, 'r') as f:
+                return json.load(f)
+    except (OSError, ValueError):
+        pass
+    data = sample()
+    samplefile.parent().makedirs()
+    fd, tmpfile = tempfile.mkstemp(prefix='.', dir=samplefile.parent())
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmpfile, samplefile)
+    return data
+
+def sample_load(host, remote):
+# Pending jobs and idle cores of the cluster of host
+    def sample():
+        # The wrapper of the remote host knows which scheduler it runs
+        try:
+            return json.loads(check_output(['ssh', '-S', remote.socket, host, f'{names.command} --queue-load'], stderr=DEVNULL, env=dict(environment)))
+        except (CalledProcessError, ValueError):
+            return dict(pending=None, idle=None)
+    return cached_sample(paths.jobq/'routes'/host-'json', sample)
+
+class Router:
+# Assign the jobs one at a time so that a batch is split across the hosts according to the policy
+    def __init__(self, remotes, weights, policy):
+        self.remotes = remotes
+        self.weights = {host: weights[host] for host in remotes}
+        self.policy = policy
+        self.assigned = dict.fromkeys(remotes, 0)
+        if policy == 'weighted':
+            self.loads = {}
+        else:
+            self.loads = {host: sample_load(host, remote) for host, remote in remotes.items()}
+    def score(self, host):
+        weight = self.weights[host] or 1e-9
+        load = self.loads.get(host, {})
+        # Hosts whose load is unknown only get jobs when no load is known
+        if self.policy == 'weighted' or load.get('pending') is None:
+            return (self.policy != 'weighted', self.assigned[host]/weight)
+        pending = load['pending'] + self.assigned[host]
+        if self.policy == 'start' and load.get('idle') is not None:
+            # Jobs ahead in the queue for every idle core
+            return (False, (pending + 1)/(load['idle'] + 1)/weight)
+        return (False, pending/weight)
+    def choose(self):
+        host = min(self.remotes, key=self.score)
+        self.assigned[host] += 1
+        return host
@@ -0,0 +1,92 @@
+import json
+from copy import deepcopy
+from contextvars import copy_context
+from .shared import currentstate, new_state, config, names, submitted, track_submitted
+from .utils import option
+from .fileutils import AbsPath
+from .jobindex import read_stages, job_state
+from .main import submit_arguments
+
+class SubmissionError(Exception):
+    pass
+
+class Session:
+    '''Submit jobs from Python with the compiled config of a wrapper.
+
+    The config is the JSON string embedded in the wrapper (or the same
+    content already loaded as a dict) and is parsed only once. Every call
+    runs with its own runtime state, so a session can be shared between
+    threads and no state leaks from one call to the next.
+
+        session = Session(config)
+        jobs = session.submit(['h2o.gjf', 'nh3.gjf'], nproc=4, yes=True)
+        for job in jobs:
+            print(job.name, job.id, job.state())
+
+    Options are the long command line options of the wrapper with dashes
+    replaced by underscores. True adds a flag, False or None skips the
+    option and lists repeat it. Prompts are never shown: unless yes=True
+    is given existing output files are left untouched.
+    '''
+    def __init__(self, config, command=None):
+        if isinstance(config, str):
+            config = json.loads(config)
+        self.config = config
+        self.command = command or config['progname']
+    def run(self, function, *args, **kwargs):
+    # Call function with a fresh runtime state loaded with the session config
+        def isolated():
+            currentstate.set(new_state())
+            # Runs may modify nested values of the config
+            config.update(deepcopy(self.config))
+            names.command = self.command
+            return function(*args, **kwargs)
+        return copy_context().run(isolated)
+    def submit(self, inputs, **options):
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        argv = []
+        if not options.get('yes'):
+            options['no'] = True
+        for key, value in options.items():
+            if value is None or value is False:
+                continue
+            elif value is True:
+                argv.append(option(key))
+            elif isinstance(value, (list, tuple)):
+                for item in value:
+                    argv.extend([option(key), str(item)])
+            else:
+                argv.extend([option(key), str(value)])
+        argv.append('--')
+        argv.extend(str(i) for i in inputs)
+        def submit():
+            track_submitted()
+            try:
+                submit_arguments(argv)
+            except SystemExit as e:
+                raise SubmissionError(f'La configuración o las opciones del envío no son válidas: {argv}') from e
+            return [Job(self, jobname, jobdir, jobid) for jobname, jobdir, jobid in submitted]
+        return self.run(submit)
+
+class Job:
+    '''Handle of a job submitted by a Session.'''
+    def __init__(self, session, name, jobdir, jobid):
+        self.session = session
+        self.name = name
+        self.jobdir = AbsPath(jobdir)
+        self.id = jobid
+    def __repr__(self):
+        return f'Job({self.name!r}, id={self.id!r})'
+    @property
+    def outdir(self):
+        return self.jobdir.parent()
+    def stages(self):
+    # Stage timings written by the job script, None until the job finishes
+        return read_stages(self.jobdir)
+    def state(self):
+    # DONE or FAILED(status) once finished, otherwise the scheduler state
+        if self.id is None:
+            return None
+        entry = dict(id=self.id, scheduler=self.session.config['queuespecfile'])
+        return self.session.run(job_state, entry, self.stages())
@@ -1,23 +1,124 @@
+import os
 from os import path
 from pwd import getpwnam
 from grp import getgrgid
-from getpass import getuser 
+from getpass import getuser
 from socket import gethostname
+from contextvars import ContextVar
+from collections import ChainMap, defaultdict
+from clinterface import prompts
 from .utils import ConfDict
 from .fileutils import AbsPath
 
-config = ConfDict()
-options = ConfDict()
-parameterdict = {}
-parameterpaths = []
-interpolationdict = {}
-script = ConfDict()
-names = ConfDict()
-nodes = ConfDict()
-paths = ConfDict()
-environ = ConfDict()
-settings = ConfDict()
-names.user = getuser()
-names.host = gethostname()
-paths.home = AbsPath(path.expanduser('~'))
-paths.jobq = paths.home/'.jobq'
+def new_state():
+# Create the runtime state of a single submission run
+    state = ConfDict()
+    state.config = ConfDict()
+    state.options = ConfDict()
+    state.parameterdict = {}
+    state.parameterpaths = []
+    state.interpolationdict = ChainMap()
+    state.batchjobs = []
+    # Listed only for the callers that read it, a manifest can hold millions of jobs
+    state.submitted = None
+    state.script = ConfDict()
+    # Prompts keep the message and choices of the run that shows them
+    state.selector = prompts.Selector()
+    state.completer = prompts.Completer()
+    state.completer.set_truthy_options(['si', 'yes'])
+    state.completer.set_falsy_options(['no'])
+    state.names = ConfDict()
+    state.nodes = ConfDict()
+    state.paths = ConfDict()
+    state.environ = ConfDict()
+    # Environment of the scheduler commands, the daemon replaces it with the one of its client
+    state.environment = os.environ
+    state.settings = ConfDict()
+    state.profiledata = ConfDict()
+    state.profiledata.enabled = False
+    state.profiledata.tracefile = None
+    state.profiledata.phasetimes = defaultdict(float)
+    state.profiledata.phasecounts = defaultdict(int)
+    state.profiledata.counters = defaultdict(int)
+    state.profiledata.jobspan = None
+    state.profiledata.lastmark = 0.0
+    state.metricdata = ConfDict()
+    state.metricdata.counters = defaultdict(float)
+    state.metricdata.histograms = {}
+    state.names.user = getuser()
+    state.names.host = gethostname()
+    state.paths.home = AbsPath(path.expanduser('~'))
+    state.paths.jobq = state.paths.home/'.jobq'
+    return state
+
+# Every Session call runs with its own state, any other context creates one the first time it is used
+currentstate = ContextVar('currentstate', default=None)
+
+def get_state():
+# Return the state of the current context creating it if needed
+    state = currentstate.get()
+    if state is None:
+        state = new_state()
+        currentstate.set(state)
+    return state
+
+def track_submitted():
+# List the jobs submitted from now on in the current state
+    get_state().submitted = []
+
+def add_submitted(jobname, jobdir, jobid):
+# Remember a submitted job if the current run lists them
+    jobs = get_state().submitted
+    if jobs is not None:
+        jobs.append((jobname, jobdir, jobid))
+
+class StateProxy:
+# Forward every access to the object of the same name in the current state
+    __slots__ = ('_name',)
+    def __init__(self, name):
+        object.__setattr__(self, '_name', name)
+    def _target(self):
+        return get_state()[object.__getattribute__(self, '_name')]
+    def __getattr__(self, attr):
+        return getattr(self._target(), attr)
+    def __setattr__(self, attr, value):
+        setattr(self._target(), attr, value)
+    def __delattr__(self, attr):
+        delattr(self._target(), attr)
+    def __getitem__(self, key):
+        return self._target()[key]
+    def __setitem__(self, key, value):
+        self._target()[key] = value
+    def __delitem__(self, key):
+        del self._target()[key]
+    def __contains__(self, key):
+        return key in self._target()
+    def __iter__(self):
+        return iter(self._target())
+    def __len__(self):
+        return len(self._target())
+    def __bool__(self):
+        return bool(self._target())
+    def __eq__(self, other):
+        return self._target() == other
+    def __repr__(self):
+        return repr(self._target())
+
+config = StateProxy('config')
+options = StateProxy('options')
+parameterdict = StateProxy('parameterdict')
+parameterpaths = StateProxy('parameterpaths')
+interpolationdict = StateProxy('interpolationdict')
+batchjobs = StateProxy('batchjobs')
+submitted = StateProxy('submitted')
+script = StateProxy('script')
+selector = StateProxy('selector')
+completer = StateProxy('completer')
+names = StateProxy('names')
+nodes = StateProxy('nodes')
+paths = StateProxy('paths')
+environ = StateProxy('environ')
+environment = StateProxy('environment')
+settings = StateProxy('settings')
+profiledata = StateProxy('profiledata')
+metricdata = StateProxy('metricdata')
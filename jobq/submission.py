@@ -1,18 +1,27 @@
 import os
 import sys
+import json
 import time
-from clinterface import messages, prompts, _
-from subprocess import CalledProcessError, call, check_output
-from .queue import submitjob, getjobstatus
-from .shared import names, nodes, paths, config, options, environ, settings, script, parameterdict, interpolationdict, parameterpaths
-from .utils import GlobDict, LogDict, ConfigTemplate, FilterGroupTemplate, InterpolationTemplate, ArgGroups, booleans, option, template_parse
-from .readmol import readmol, molblock
-from .fileutils import AbsPath
-
-selector = prompts.Selector()
-completer = prompts.Completer()
-completer.set_truthy_options(['si', 'yes'])
-completer.set_falsy_options(['no'])
+import tempfile
+from shlex import quote
+from itertools import product
+from collections import ChainMap
+from contextvars import copy_context
+from clinterface import messages, _
+from subprocess import CalledProcessError, check_output
+from .queue import retrysubmit, getjobstatus, TransientError
+from .shared import names, nodes, paths, config, options, environ, environment, settings, script, parameterdict, interpolationdict, batchjobs, selector, completer, add_submitted
+from .utils import ConfDict, GlobDict, LogDict, ConfigTemplate, FilterGroupTemplate, InterpolationTemplate, ArgGroups, booleans, option, template_parse, sweep_split, sweep_tag
+from .readmol import readlast, molblock, molstem, TrajectoryBlocks
+from .fileutils import AbsPath, NotAbsolutePath
+from . import profiling, metrics
+from .jobindex import index_job, read_stages
+from .outbox import postpone
+from .placement import choose_partition
+from .workflow import dependency_meta
+from .routing import Router, parse_routes, connect_remote, run_remote
+from .history import harvest_history, predict, sizing_meta
+from .resultcache import file_digest, text_digest, result_key, cached_result, record_result, saved_hours
 
 def configure_submission():
 
@@ -50,8 +59,8 @@ def configure_submission():
         nodes.head = names.host
 
     try:
-        environ.TELEGRAM_BOT_URL = os.environ['TELEGRAM_BOT_URL']
-        environ.TELEGRAM_CHAT_ID = os.environ['TELEGRAM_CHAT_ID']
+        environ.TELEGRAM_BOT_URL = environment['TELEGRAM_BOT_URL']
+        environ.TELEGRAM_CHAT_ID = environment['TELEGRAM_CHAT_ID']
     except KeyError:
         pass
 
@@ -59,76 +68,145 @@ def configure_submission():
 #        if not path.isfile():
 #            messages.error(_('El archivo de reinicio $path no existe', path=path))
 
-    if options.remote.remote_host:
-        (paths.home/'.ssh').mkdir()
-        paths.socket = paths.home/'.ssh'/options.remote.remote_host*'sock'
-        try:
-            paths.remotedir = check_output(['ssh', '-o', 'ControlMaster=auto', '-o', 'ControlPersist=60', '-S', paths.socket, \
-                options.remote.remote_host, 'printenv CLUSTERQ_REMOTE_ROOT || true']).strip().decode(sys.stdout.encoding)
-        except CalledProcessError as e:
-            messages.error(_('Error al conectar con el servidor $host', host=options.remote.remote_host), e.output.decode(sys.stdout.encoding).strip())
-        if paths.remotedir:
-            paths.remotedir = AbsPath(paths.remotedir)
+    # Every job goes to one of the remote hosts when they are given
+    settings.remotes = {}
+    settings.router = None
+
+    if options.remote.remote_host or 'route' in options.remote:
+        if options.remote.remote_host:
+            weights = {options.remote.remote_host: 1.0}
         else:
-            messages.error(_('El servidor $host no está configurado para aceptar trabajos', host=options.remote.remote_host))
+            weights = parse_routes(options.remote.route)
+        for host in weights:
+            remote = connect_remote(host)
+            if remote is not None:
+                settings.remotes[host] = remote
+        if not settings.remotes:
+            messages.error(_('No hay servidores disponibles para enviar los trabajos'))
+        settings.router = Router(settings.remotes, weights, options.remote.policy if 'route' in options.remote else 'weighted')
 
     if options.common.prompt:
         settings.defaults = False
     else:
         settings.defaults = True
 
-    interpolationdict.update(options.interpolopts)
+    # Options with several values are swept over their cartesian product
+    settings.sweepvars = {}
+    settings.sweepparams = {}
+
+    # Values are only split on commas when asked for, they may contain commas themselves
+    if options.interpolation.sweep:
+        split = sweep_split
+    else:
+        split = lambda value: [value]
+
+    for key, values in options.interpolopts.items():
+        values = list(dict.fromkeys(i for value in values for i in split(value)))
+        if len(values) > 1:
+            settings.sweepvars[key] = values
+        else:
+            interpolationdict[key] = values[0]
 
     for i, var in enumerate(options.interpolation.posvars, start=1):
-        interpolationdict[str(i)] = var
+        values = split(var)
+        if len(values) > 1:
+            settings.sweepvars[str(i)] = values
+        else:
+            interpolationdict[str(i)] = values[0]
 
-    if options.interpolation.mol or options.interpolation.trjmol or interpolationdict:
+    if options.interpolation.mol or options.interpolation.trjmol or interpolationdict or settings.sweepvars:
         options.interpolate = True
     else:
         options.interpolate = False
 
-    for key, value in options.parameteropts.items():
-        if '/' in options.parameteropts[key]:
-            messages.error(_('El nombre del conjunto de parámetros no es válido'), f'options.parameteropts[{key}]={value}')
+    for key, values in options.parameteropts.items():
+        values = list(dict.fromkeys(i for value in values for i in split(value)))
+        for value in values:
+            if '/' in value:
+                messages.error(_('El nombre del conjunto de parámetros no es válido'), f'options.parameteropts[{key}]={value}')
+        if len(values) > 1:
+            settings.sweepparams[key] = values
+        else:
+            parameterdict[key] = values[0]
 
-    parameterdict.update(options.parameteropts)
+    if options.interpolation.fan_out and not options.interpolation.trjmol:
+        messages.error(_('La opción --fan-out requiere un archivo de trayectoria (-M/--trjmol)'))
 
     if options.interpolate:
         if options.interpolation.mol:
             for i, path in enumerate(options.interpolation.mol, start=1):
                 path = AbsPath(path, parent=options.common.cwd)
-                molprefix = path.stem
-                coords = readmol(path)[-1]
+                molprefix = molstem(path)
+                coords = readlast(path)
                 interpolationdict[f'mol{i}'] = molblock(coords, config.progspecfile)
         elif options.interpolation.trjmol:
             path = AbsPath(options.interpolation.trjmol, parent=options.common.cwd)
-            molprefix = path.stem
-            for i, coords in enumerate(readmol(path), start=1):
-                interpolationdict[f'mol{i}'] = molblock(coords, config.progspecfile)
+            molprefix = molstem(path)
+            if options.interpolation.fan_out:
+                settings.trjmol = path
+            else:
+                interpolationdict.maps.append(TrajectoryBlocks(path, config.progspecfile, options.interpolation.frames))
+        # Job name templates are interpolated for every job
         if options.interpolation.prefix:
-            try:
-                settings.prefix = InterpolationTemplate(options.interpolation.prefix).substitute(interpolationdict)
-            except ValueError as e:
-                messages.error(_('El prefijo contiene variables de interpolación inválidas'), f'options.interpolation.prefix={options.interpolation.prefix}, key={e.args[0]}')
-            except KeyError as e:
-                messages.error(_('El prefijo contiene variables de interpolación indefinidas'), f'options.interpolation.prefix={options.interpolation.prefix}, key={e.args[0]}')
+            settings.prefix = options.interpolation.prefix
         elif options.interpolation.suffix:
-            try:
-                settings.suffix = InterpolationTemplate(options.interpolation.suffix).substitute(interpolationdict)
-            except ValueError as e:
-                messages.error(_('El prefijo contiene variables de interpolación inválidas'), f'options.interpolation.suffix={options.interpolation.suffix}, key={e.args[0]}')
-            except KeyError as e:
-                messages.error(_('El prefijo contiene variables de interpolación indefinidas'), f'options.interpolation.suffix={options.interpolation.suffix}, key={e.args[0]}')
+            settings.suffix = options.interpolation.suffix
         else:
             if options.interpolation.mol:
                 if len(options.interpolation.mol) == 1:
-                    settings.prefix = molprefix
+                    settings.prefix = molprefix.replace('$', '$$')
                 else:
                     messages.error(_('Se debe especificar un prefijo o sufijo cuando se especifican múltiples archivos de coordenadas'))
             elif options.interpolation.trjmol:
-                settings.prefix = molprefix
-            else:
+                if options.interpolation.fan_out:
+                    settings.prefix = molprefix.replace('$', '$$') + '_${frame}'
+                else:
+                    settings.prefix = molprefix.replace('$', '$$')
+            elif not settings.sweepvars and 'step' not in settings:
+                # Swept values and workflow steps are tagged onto the job name so they need no prefix
                 messages.error(_('Se debe especificar un prefijo o sufijo para interpolar sin archivo coordenadas'))
+        settings.tagkeys = list(settings.sweepvars)
+        for key in ('prefix', 'suffix'):
+            if key in settings:
+                logdict = LogDict()
+                InterpolationTemplate(settings[key]).safe_substitute(logdict)
+                if options.interpolation.fan_out and 'frame' not in logdict.logged_keys:
+                    messages.error(_('El prefijo o sufijo debe contener la variable $$frame para enviar un trabajo por paso'), f'options.interpolation.{key}={settings[key]}')
+                # Swept variables that already appear in the job name need no tag
+                settings.tagkeys = [i for i in settings.tagkeys if i not in logdict.logged_keys]
+                if not options.interpolation.fan_out:
+                    interpolatedname(key, interpolationdict.new_child({k: v[0] for k, v in settings.sweepvars.items()}))
+    else:
+        settings.tagkeys = []
+
+    settings.cachehits = 0
+    settings.savedhours = 0.0
+    settings.postponed = 0
+
+    if options.common.right_size:
+        settings.history = harvest_history()
+        settings.sizing = {}
+
+    if 'batch' in options.common:
+        if options.common.batch < 1:
+            messages.error(_('El tamaño del lote debe ser un entero positivo'), f'options.common.batch={options.common.batch}')
+        settings.batchsize = options.common.batch
+    elif (options.interpolation.fan_out or settings.sweepvars or settings.sweepparams or 'watch' in options.arguments) and 'arraysize' in config:
+        settings.batchsize = config.arraysize
+    else:
+        settings.batchsize = 0
+
+    # Every job of a dependent step waits for its own parents
+    if 'step' in settings and settings.step.parents:
+        settings.batchsize = 0
+
+    if settings.batchsize and not 'array' in config:
+        messages.error(_('El gestor de trabajos no soporta el envío de trabajos en lotes'))
+
+    # Contexts where the batched jobs were staged by job directory
+    settings.batchcontexts = {}
+    # Result cache keys of the batched jobs waiting for an id
+    settings.cachekeys = {}
 
     if not 'scratch' in config.defaults:
         messages.error(_('No se especificó el directorio de escritura por defecto'), f'config.defaults.scratch={config.defaults.scratch}')
@@ -138,6 +216,31 @@ def configure_submission():
     else:
         settings.execdir = AbsPath(ConfigTemplate(config.defaults.scratch).substitute(names))/'$jobid'
 
+    # The job script takes the first scratch tier with room for the job and falls back to the default scratch
+    settings.scratchtiers = []
+
+    if 'scratch' not in options.common:
+        for i, tier in enumerate(config.get('scratchtiers', [])):
+            try:
+                settings.scratchtiers.append((AbsPath(ConfigTemplate(tier['path']).substitute(names)), tier.get('memory', False)))
+            except (KeyError, NotAbsolutePath):
+                messages.error(_('La ruta del directorio de escritura no es válida'), f'config.scratchtiers[{i}]={tier}')
+
+    script.scratch = [f'execdir="{settings.execdir}"']
+
+    if settings.scratchtiers:
+        script.scratch = [
+            r'''scratchfits() { local free=$(df -Pk "$1" 2> /dev/null | awk 'NR==2{print $4}'); [[ -w $1 ]] && (( ${free:-0} >= scratchneed )) && { [[ $2 != memory ]] || (( $(awk '/^MemAvailable:/{print $2}' /proc/meminfo) - maxram >= scratchneed )); }; }''',
+        ]
+        # The tiers are only checked on the head node, the other hosts of the job may not have room
+        if config.filesync != 'local':
+            script.scratch.append(r'singlehost() { set -- ${hosts[*]}; (( $# <= 1 )); }')
+            script.scratch.append(f'if ! singlehost; then execdir="{settings.execdir}"')
+        for path, memory in settings.scratchtiers:
+            keyword = 'if' if len(script.scratch) == 1 else 'elif'
+            script.scratch.append(f'{keyword} scratchfits "{path}"{" memory" if memory else ""}; then execdir="{path/"$jobid"}"')
+        script.scratch.append(f'else execdir="{settings.execdir}"; fi')
+
     if 'mpilaunch' in config:
         try: config.mpilaunch = booleans[config.mpilaunch]
         except KeyError:
@@ -160,7 +263,11 @@ def configure_submission():
     else:
         messages.error(_('La lista de archivos de salida está vacía'), 'config.outputfiles')
 
-    if options.remote.remote_host:
+    for key, target in config.get('restartfiles', {}).items():
+        if not key in config.outputfiles or not target in config.filekeys:
+            messages.error(_('Elemento no encontrado'), f'{key}: {target} in config.restartfiles but not in config.outputfiles and config.filekeys')
+
+    if settings.remotes:
         return
 
     ############ Local execution ###########
@@ -168,11 +275,34 @@ def configure_submission():
     if 'jobtype' in config:
         script.meta.append(ConfigTemplate(config.jobtype).substitute(jobtype=config.progname))
 
-    if 'queues' in options.common:
+    if options.common.auto_queue and 'hosts' not in options.common:
+        candidates = options.common.queue.split(',') if 'queue' in options.common else None
+        placement = choose_partition(options.common.nproc, options.common.nhost, candidates, options.common.reshape)
+        if placement is None:
+            # A single queue asked by the user is kept, only a list of queues falls back to the default one
+            if candidates is not None and len(candidates) == 1:
+                messages.warning(_('No se pudo determinar la disponibilidad de los nodos, se usará la cola $queue', queue=candidates[0]))
+                options.common.queue = candidates[0]
+            else:
+                messages.warning(_('No se pudo determinar la disponibilidad de los nodos, se usará la cola predeterminada'))
+                options.common.pop('queue', None)
+        else:
+            options.common.queue, (nproc, nhost) = placement
+            if (nproc, nhost) != (options.common.nproc, options.common.nhost):
+                messages.warning(_('Se ajustó la solicitud a $nproc núcleo(s) en $nhost nodo(s) para usar los nodos libres de la cola $queue', nproc=nproc, nhost=nhost, queue=options.common.queue))
+                options.common.nproc, options.common.nhost = nproc, nhost
+
+    if 'queue' in options.common:
         script.meta.append(ConfigTemplate(config.queue).substitute(queue=options.common.queue))
-    elif 'queues' in config.defaults:
+    elif 'queue' in config.defaults:
         script.meta.append(ConfigTemplate(config.queue).substitute(queue=config.defaults.queue))
 
+    if options.common.requeue:
+        if 'rerunnable' in config:
+            script.meta.append(config.rerunnable)
+        else:
+            messages.warning(_('El gestor de trabajos no permite volver a encolar los trabajos interrumpidos'))
+
     #TODO MPI support for Slurm
     if config.parallel:
         if config.parallel.lower() == 'none':
@@ -251,7 +381,7 @@ def configure_submission():
                 messages.error(_('La ruta $path contiene variables de interpolación indefinidas'), f'config.parameterpaths[{i}]={path}')
         else:
             path = ConfigTemplate(path).safe_substitute(names)
-            path = InterpolationTemplate(path).safe_substitute(parameterdict)
+            path = InterpolationTemplate(path).safe_substitute(parameterdict, **{k: v[0] for k, v in settings.sweepparams.items()})
             trunk = AbsPath()
             for part in AbsPath(path).parts:
                 trunk.assertdir()
@@ -273,6 +403,9 @@ def configure_submission():
     except NotAbsolutePath:
         script.body.append(config.versions[settings.version].executable)
 
+    if settings.batchsize and 'arraylogfiles' in config:
+        config.logfiles = config.arraylogfiles
+
     for i, path in enumerate(config.logfiles):
         script.meta.append(ConfigTemplate(path).safe_substitute(dict(logdir=AbsPath(ConfigTemplate(config.logdir).substitute(names)))))
 
@@ -303,6 +436,9 @@ def configure_submission():
         else:
             messages.error(_('El nombre del módulo es nulo'), 'config.load')
 
+    if settings.batchsize and 'arrayenvars' in config:
+        config.envars.update(config.arrayenvars)
+
     for key, value in config.envars.items():
         script.vars.append(f'{key}="{value}"')
 
@@ -319,6 +455,49 @@ def configure_submission():
     for key, value in nodes.items():
         script.vars.append(f'{key}node="{value}"')
 
+    # Shell helpers that time each stage of the job and dump the results as JSON
+    script.timing = [
+        r'''jsonstring() { local s=${1//\\/\\\\}; s=${s//\"/\\\"}; s=${s//$'\n'/\\n}; s=${s//$'\t'/\\t}; s=${s//$'\r'/\\r}; printf '"%s"' "$s"; }''',
+        r'stagebytes() { du -sbc "$@" 2>/dev/null | tail -n1 | cut -f1; }',
+        r'stagetime() { local now=$(date +%s.%N); stages+=("\"$1\": {\"start\": $stagestart, \"end\": $now, \"bytes\": ${2:-0}}"); stagestart=$now; }',
+        r'''peakmem() { cat "/sys/fs/cgroup$(sed -n 's/^0:://p' /proc/self/cgroup)/memory.peak" 2>/dev/null || cat "/sys/fs/cgroup/memory$(sed -n 's/^[0-9]*:memory://p' /proc/self/cgroup)/memory.max_usage_in_bytes" 2>/dev/null || echo null; }''',
+        r'''writestages() { local IFS=, maxrss=$(tail -n1 .maxrss 2>/dev/null); [[ $maxrss =~ ^[0-9]+$ ]] || maxrss=null; echo "{${stages[*]}, \"status\": $runstatus, \"interrupted\": \"$interrupted\", \"scratch\": $(jsonstring "$execdir"), \"maxrss\": $maxrss, \"peakmem\": $(peakmem)}" > "$1"; }''',
+        r'if [[ -x /usr/bin/time ]]; then runtimer=(/usr/bin/time -f %M -o .maxrss env); else runtimer=(env); fi',
+    ]
+
+    # The completion event of every job goes to the events file of the user and to the configured sinks
+    script.events = [
+        r'jobevent() { local now=$(date +%s.%N); echo "{\"event\": \"finished\", \"id\": \"$jobid\", \"name\": $(jsonstring "$jobname"), \"status\": $runstatus, \"start\": $jobstart, \"end\": $now, \"duration\": $(awk "BEGIN {print $now - $jobstart}"), \"host\": $(jsonstring "$(hostname)"), \"outdir\": $(jsonstring "$1"), \"jobdir\": $(jsonstring "$2"), \"stages\": $(cat "$3" 2>/dev/null || echo null)}"; }',
+        'emitevent() {',
+    ]
+
+    for sink in [paths.jobq/'events.jsonl'] + config.get('eventsinks', []):
+        sink = ConfigTemplate(sink).substitute(names)
+        if sink.startswith(('http://', 'https://')):
+            script.events.append(f'    curl -fsS -m 10 -H "Content-Type: application/json" -d "$1" {quote(sink)} > /dev/null || wget -q -T 10 -O /dev/null --header="Content-Type: application/json" --post-data="$1" {quote(sink)}')
+        elif sink.startswith('unix://'):
+            script.events.append(f'    python3 -c "import sys, socket; s = socket.socket(socket.AF_UNIX); s.settimeout(5); s.connect(sys.argv[1]); s.sendall(sys.argv[2].encode())" {quote(sink[7:])} "$1"')
+        elif sink.startswith('fifo://'):
+            # A FIFO without reader must not block the job
+            script.events.append(f'    [[ -p {quote(sink[7:])} ]] && timeout 5 bash -c \'echo "$1" > "$2"\' - "$1" {quote(sink[7:])}')
+        elif sink.startswith('file://'):
+            script.events.append(f'    echo "$1" >> {quote(sink[7:])}')
+        else:
+            script.events.append(f'    echo "$1" >> {quote(sink)}')
+
+    if 'TELEGRAM_BOT_URL' in environ:
+        script.events.append(f'    curl -fsS -m 10 {quote(environ.TELEGRAM_BOT_URL + "/sendMessage")} -d chat_id={quote(environ.TELEGRAM_CHAT_ID)} --data-urlencode text="El trabajo $jobname terminó con el estado $runstatus" > /dev/null')
+
+    script.events.append('} 2> /dev/null')
+
+    # Termination signals are forwarded to the program so that it can write its restart files before the job ends
+    script.traps = [
+        r'forward() { interrupted=$1; if [[ ${runtimer[0]} == env ]]; then kill -$1 $runpid; else pkill -$1 -P $runpid; fi; } 2> /dev/null',
+    ]
+
+    for signal in config.get('termsignals', []):
+        script.traps.append(f"trap 'forward {signal}' {signal}")
+
     for key in config.optargs:
         if not config.optargs[key] in config.filekeys:
             messages.error(_('Elemento no encontrado'), f'{key} in config.optargs but not in config.filekeys')
@@ -352,43 +531,85 @@ def configure_submission():
     if config.filesync == 'local':
         script.makedir = 'mkdir -p -m 700 "{}"'.format
         script.removedir = 'rm -rf "{}"'.format
+        # Restart files are always copied so that a job that is interrupted again still finds them
+        script.copyfile = 'cp "{}" "{}"'.format
         if options.common.move:
             script.importfile = 'mv "{}" "{}"'.format
         else:
-            script.importfile = 'cp "{}" "{}"'.format
+            script.importfile = script.copyfile
         script.importdir = 'cp -r "{}/." "{}"'.format
         script.exportfile = 'cp "{}" "{}"'.format
     elif config.filesync == 'remote':
         script.makedir = 'for host in ${{hosts[*]}}; do rsh $host mkdir -p -m 700 "\'{}\'"; done'.format
         script.removedir = 'for host in ${{hosts[*]}}; do rsh $host rm -rf "\'{}\'"; done'.format
+        script.copyfile = 'for host in ${{hosts[*]}}; do rcp $headnode:"\'{0}\'" $host:"\'{1}\'"; done'.format
         if options.common.move:
             script.importfile = 'for host in ${{hosts[*]}}; do rcp $headnode:"\'{0}\'" $host:"\'{1}\'" && rsh $headnode rm "\'{0}\'"; done'.format
         else:
-            script.importfile = 'for host in ${{hosts[*]}}; do rcp $headnode:"\'{0}\'" $host:"\'{1}\'"; done'.format
+            script.importfile = script.copyfile
         script.importdir = 'for host in ${{hosts[*]}}; do rsh $host cp -r "\'{0}/.\'" "\'{1}\'"; done'.format
         script.exportfile = 'rcp "{}" $headnode:"\'{}\'"'.format
     elif config.filesync == 'secure':
         script.makedir = 'for host in ${{hosts[*]}}; do ssh $host mkdir -p -m 700 "\'{}\'"; done'.format
         script.removedir = 'for host in ${{hosts[*]}}; do ssh $host rm -rf "\'{}\'"; done'.format
+        script.copyfile = 'for host in ${{hosts[*]}}; do scp $headnode:"\'{0}\'" $host:"\'{1}\'"; done'.format
         if options.common.move:
             script.importfile = 'for host in ${{hosts[*]}}; do scp $headnode:"\'{0}\'" $host:"\'{1}\'" && ssh $headnode rm "\'{0}\'"; done'.format
         else:
-            script.importfile = 'for host in ${{hosts[*]}}; do scp $headnode:"\'{0}\'" $host:"\'{1}\'"; done'.format
+            script.importfile = script.copyfile
         script.importdir = 'for host in ${{hosts[*]}}; do ssh $host cp -r "\'{0}/.\'" "\'{1}\'"; done'.format
         script.exportfile = 'scp "{}" $headnode:"\'{}\'"'.format
     else:
         messages.error(_('El método de copia no es válido'), 'config.filesync={config.filesync}')
-def submit_single_job(workdir, inputname, filtergroups):
+def interpolatedname(key, mapping):
+    template = settings[key]
+    try:
+        return InterpolationTemplate(template).substitute(mapping)
+    except ValueError as e:
+        messages.error(_('El prefijo contiene variables de interpolación inválidas'), f'options.interpolation.{key}={template}, key={e.args[0]}')
+    except KeyError as e:
+        messages.error(_('El prefijo contiene variables de interpolación indefinidas'), f'options.interpolation.{key}={template}, key={e.args[0]}')
+
+def sweep_combinations():
+# Yield the name tag, interpolation variables and parameter sets of every sweep combination
+    keys = list(settings.sweepvars) + list(settings.sweepparams)
+    for combination in product(*settings.sweepvars.values(), *settings.sweepparams.values()):
+        sweepvars = dict(zip(settings.sweepvars, combination))
+        sweepparams = dict(zip(settings.sweepparams, combination[len(settings.sweepvars):]))
+        tag = '_'.join(sweep_tag(value) for key, value in zip(keys, combination) if key in settings.tagkeys or key in settings.sweepparams)
+        yield tag, sweepvars, sweepparams
+
+def submit_single_job(workdir, inputname, filtergroups, jobvars={}, jobparams={}, jobtag=''):
+
+    jobdict = interpolationdict.new_child(jobvars)
+    paramdict = ChainMap(jobparams, parameterdict)
 
     if 'prefix' in settings:
-        jobname = f'{settings.prefix}_{inputname}'
+        jobname = f'{interpolatedname("prefix", jobdict)}_{inputname}'
     elif 'suffix' in settings:
-        jobname = f'{inputname}_{settings.suffix}'
+        jobname = f'{inputname}_{interpolatedname("suffix", jobdict)}'
     else:
         jobname = inputname
 
-    script.vars.append(f'jobname="{jobname}"')
-    script.meta.append(ConfigTemplate(config.jobname).substitute(jobname=jobname))
+    if jobtag:
+        jobname = f'{jobname}_{jobtag}'
+
+    # The jobs of the workflow steps of the same input are named after the step
+    if 'step' in settings:
+        stepkey = str(workdir/jobname)
+        parentjobs = {}
+        for parent, jobs in settings.step.parents.items():
+            if stepkey not in jobs:
+                messages.failure(_('El trabajo "$jobname" no se envió porque no se envió su paso $step', jobname=f'{jobname}_{settings.step.name}', step=parent))
+                return
+            parentjobs[parent] = jobs[stepkey]
+        jobname = f'{jobname}_{settings.step.name}'
+
+    profiling.rename(jobname)
+
+    # Keep per-job lines out of the shared script so that no state outlives the job
+    namevars = [f'jobname="{jobname}"']
+    jobmeta = [ConfigTemplate(config.jobname).substitute(jobname=jobname)]
 
     if 'out' in options.common:
         outdir = AbsPath(options.common.out, parent=workdir)
@@ -414,7 +635,7 @@ def submit_single_job(workdir, inputname, filtergroups):
                         contents = f.read()
                         if options.interpolate:
                             try:
-                                interpolatedfiles[destpath] = InterpolationTemplate(contents).substitute(interpolationdict)
+                                interpolatedfiles[destpath] = InterpolationTemplate(contents).substitute(jobdict)
                             except ValueError:
                                 messages.failure(_('El archivo $file contiene variables de interpolación inválidas', file=srcpath), f'key={e.args[0]}')
                                 return
@@ -435,8 +656,36 @@ def submit_single_job(workdir, inputname, filtergroups):
                 else:
                     literalfiles[destpath] = srcpath
 
+    profiling.lap('interpolation')
+
     jobdir = stagedir/'.job'
 
+    if options.common.cache and not settings.remotes:
+        parameterpaths = resolve_parameterpaths(filtergroups, paramdict)
+        inputs = {}
+        for key in config.inputfiles:
+            if stagedir/jobname-key in interpolatedfiles:
+                inputs[key] = text_digest(interpolatedfiles[stagedir/jobname-key])
+            elif (workdir/inputname-key).isfile():
+                inputs[key] = file_digest(workdir/inputname-key)
+        cachekey = result_key(config.progname, settings.version, ' '.join(str(i) for i in script.body), inputs, parameterpaths, nproc=options.common.nproc, nhost=options.common.nhost)
+        record = cached_result(cachekey)
+        if record is not None and reuse_result(record, jobname, outdir, literalfiles, interpolatedfiles):
+            # The outputs are already in place for the child steps
+            if 'step' in settings:
+                settings.step.jobs[stepkey] = ConfDict(dict(outdir=outdir, jobname=jobname, jobid=None))
+            return
+        profiling.lap('cache')
+
+    # The restart files of an interrupted run are kept so that the job resumes from them
+    stages = read_stages(jobdir)
+    if stages is not None and stages.get('interrupted') and not settings.remotes:
+        resumed = {key for key in config.get('restartfiles', {}) if (outdir/jobname-key).isfile()}
+    else:
+        resumed = set()
+    # Input files that the restart files replace
+    restarted = {config.restartfiles[key] for key in resumed}
+
     if outdir.isdir():
         if jobdir.isdir():
             try:
@@ -448,16 +697,23 @@ def submit_single_job(workdir, inputname, filtergroups):
                     return
             except FileNotFoundError:
                 pass
-        if not set(outdir.listdir()).isdisjoint(f'{jobname}.{key}' for key in config.outputfiles):
+        if not set(outdir.listdir()).isdisjoint(f'{jobname}.{key}' for key in config.outputfiles if key not in resumed):
             completer.set_message(_('Si corre este cálculo los archivos de salida existentes en el directorio $outdir serán sobreescritos, ¿desea continuar de todas formas?', outdir=outdir))
             if options.common.no or (not options.common.yes and not completer.binary_choice()):
                 messages.failure(_('Cancelado por el usuario'))
                 return
         if workdir != outdir:
             for ext in config.inputfiles:
-                (outdir/jobname-ext).remove()
+                if ext not in resumed:
+                    (outdir/jobname-ext).remove()
         for ext in config.outputfiles:
-            (outdir/jobname-ext).remove()
+            if ext not in resumed:
+                (outdir/jobname-ext).remove()
+        if resumed:
+            for key in restarted:
+                literalfiles.pop(stagedir/jobname-key, None)
+                interpolatedfiles.pop(stagedir/jobname-key, None)
+            messages.warning(_('El trabajo "$jobname" continuará a partir de los archivos de reinicio de la ejecución interrumpida', jobname=jobname))
     else:
         try:
             outdir.makedirs()
@@ -465,36 +721,39 @@ def submit_single_job(workdir, inputname, filtergroups):
             messages.failure(_('No se puede crear la carpeta $outdir porque ya existe un archivo con el mismo nombre', outdir=outdir))
             return
 
-    for destpath, litfile in literalfiles.items():
-        litfile.copyas(destpath)
+    profiling.lap('checks')
 
-    for destpath, contents in interpolatedfiles.items():
-        with open(destpath, 'w') as f:
-            f.write(contents)
+    stage_inputs(literalfiles, interpolatedfiles)
+
+    profiling.lap('staging')
 
 #    for key, targetfile in options.restartfiles.items():
 #        targetfile.symlink(stagedir/jobname*config.fileopts[key])
 
     ############ Remote execution ###########
 
-    if options.remote.remote_host:
+    if settings.remotes:
+        host = settings.router.choose()
+        remote = settings.remotes[host]
         remote_args = ArgGroups()
         reloutdir = os.path.relpath(outdir, paths.home)
-        remote_tmpdir = paths.remotedir/names.user*names.host/'tmp'
-        remote_outdir = paths.remotedir/names.user*names.host/'out'
+        remote_tmpdir = (remote.remotedir/names.user-names.host)/'tmp'
+        remote_outdir = (remote.remotedir/names.user-names.host)/'out'
         remote_args.gather(options.common)
         remote_args.flags.add('raw')
         remote_args.flags.add('job')
         remote_args.flags.add('move')
+        # The wrapper of the host reports the id of the job it submits
+        remote_args.flags.add('report_jobs')
         remote_args.options['cwd'] = remote_tmpdir/reloutdir
         remote_args.options['out'] = remote_outdir/reloutdir
-        for key, value in parameterdict.items():
-            remote_args.options[key] = val
+        for key, value in paramdict.items():
+            remote_args.options[key] = value
         filelist = []
         for key in config.filekeys:
-            if (outdir/jobname*key).isfile():
-                filelist.append(paths.home/'.'/reloutdir/jobname*key)
-        arglist = ['ssh', '-qt', '-S', paths.socket, options.remote.remote_host]
+            if (outdir/jobname-key).isfile():
+                filelist.append(paths.home/'.'/reloutdir/jobname-key)
+        arglist = ['ssh', '-qt', '-S', remote.socket, host]
         arglist.extend(f'{env}={val}' for env, val in environ.items())
         arglist.append(names.command)
         arglist.extend(option(key) for key in remote_args.flags)
@@ -505,52 +764,70 @@ def submit_single_job(workdir, inputname, filtergroups):
             print('<FILE LIST>', ' '.join(filelist), '</FILE LIST>')
             print('<COMMAND LINE>', ' '.join(arglist), '</COMMAND LINE>')
         else:
+            profiling.count('subprocesses', 4)
             try:
-                check_output(['ssh', '-S', paths.socket, options.remote.remote_host, f"mkdir -p '{remote_tmpdir}' '{remote_outdir}'"])
-                check_output([f'rsync', '-e', "ssh -S '{paths.socket}'", '-qRLtz'] + filelist + [f'{options.remote.remote_host}:{remote_tmpdir}'])
-                check_output([f'rsync', '-e', "ssh -S '{paths.socket}'", '-qRLtz', '-f', '-! */'] + filelist + [f'{options.remote.remote_host}:{remote_outdir}'])
+                check_output(['ssh', '-S', remote.socket, host, f"mkdir -p '{remote_tmpdir}' '{remote_outdir}'"], env=dict(environment))
+                check_output(['rsync', '-e', f"ssh -S '{remote.socket}'", '-qRLtz'] + filelist + [f'{host}:{remote_tmpdir}'], env=dict(environment))
+                check_output(['rsync', '-e', f"ssh -S '{remote.socket}'", '-qRLtz', '-f', '-! */'] + filelist + [f'{host}:{remote_outdir}'], env=dict(environment))
             except CalledProcessError as e:
-                messages.error(_('Error al copiar los archivos al servidor $host', host=options.remote.remote_host), e.output.decode(sys.stdout.encoding).strip())
-            call(arglist)
+                messages.error(_('Error al copiar los archivos al servidor $host', host=host), e.output.decode(sys.stdout.encoding).strip())
+            status, reports = run_remote(arglist)
+            # The job is followed through the index of the host that ran it, its id is unknown if the host postponed it
+            if status == 0:
+                if reports:
+                    index_job(reports[-1]['jobid'], jobname, jobdir, host=host, remotejobdir=reports[-1]['jobdir'])
+                else:
+                    # Raw jobs are staged in their working directory
+                    index_job(None, jobname, jobdir, host=host, remotejobdir=remote_tmpdir/reloutdir/'.job')
+        profiling.lap('remote')
         return
 
     ############ Local execution ###########
 
-    for path in config.parameterpaths:
-        try:
-            path = ConfigTemplate(path).safe_substitute(names)
-            path = FilterGroupTemplate(path).substitute(filtergroups)
-            path = InterpolationTemplate(path).substitute(parameterdict)
-        except ValueError as e:
-            messages.error(_('La ruta $path contiene variables de interpolación inválidas', path=path), f'key={e.args[0]}')
-        except KeyError as e:
-            messages.error(_('La ruta $path contiene variables de interpolación indefinidas', path=path), f'key={e.args[0]}')
-        trunk = AbsPath()
-        for part in AbsPath(path).parts:
-            trunk.assertdir()
-            trunk = trunk/part
-        parameterpaths.append(trunk)
+    # The cache lookup already resolved them
+    if not options.common.cache:
+        parameterpaths = resolve_parameterpaths(filtergroups, paramdict)
 
     imports = []
     exports = []
+    checkpoints = []
+
+    stagedkeys = settings.step.stage if 'step' in settings else {}
 
     for key in config.inputfiles:
-        if (workdir/inputname-key).isfile():
-            imports.append(script.importfile(stagedir/jobname-key, settings.execdir/config.filekeys[key]))
+        if (workdir/inputname-key).isfile() and key not in stagedkeys and key not in restarted:
+            imports.append(script.importfile(stagedir/jobname-key, f'$execdir/{config.filekeys[key]}'))
+
+    # Outputs of the parent steps are copied when the job starts, after the parents finished
+    for key, source in stagedkeys.items():
+        parent, dot, parentkey = source.partition('.')
+        parentjob = parentjobs[parent]
+        imports.append(script.importfile(parentjob.outdir/parentjob.jobname-parentkey, f'$execdir/{config.filekeys[key]}'))
 
 #    for key in options.restartfiles:
 #        imports.append(script.importfile(stagedir/jobname-config.fileopts[key], settings.execdir/config.filekeys[config.fileopts[key]]))
 
     for path in parameterpaths:
         if path.isfile():
-            imports.append(script.importfile(path, settings.execdir/path.name))
+            imports.append(script.importfile(path, f'$execdir/{path.name}'))
         elif path.isdir():
-            imports.append(script.importdir(path, settings.execdir))
+            imports.append(script.importdir(path, '$execdir'))
         else:
             messages.error(_('La ruta de parámetros $path no existe', path=path))
 
+    # Restart files left in the output directory by an interrupted run are picked up when the job starts again
+    restarts = []
+    for key, target in config.get('restartfiles', {}).items():
+        if key in resumed:
+            imports.append(script.copyfile(outdir/jobname-key, f'$execdir/{config.filekeys[target]}'))
+        elif options.common.requeue:
+            restarts.append(script.copyfile(outdir/jobname-key, f'$execdir/{config.filekeys[target]}') + ' 2> /dev/null')
+        checkpoints.append(script.exportfile(f'$execdir/{config.filekeys[key]}', outdir/jobname-key))
+
     for key in config.outputfiles:
-        exports.append(script.exportfile(settings.execdir/config.filekeys[key], outdir/jobname-key))
+        exports.append(script.exportfile(f'$execdir/{config.filekeys[key]}', outdir/jobname-key))
+
+    exportpaths = ' '.join(f'"{outdir/jobname-key}"' for key in config.outputfiles)
 
     try:
         jobdir.mkdir()
@@ -558,42 +835,112 @@ def submit_single_job(workdir, inputname, filtergroups):
         messages.failure(_('No se puede crear la carpeta $jobdir porque ya existe un archivo con ese nombre', jobdir=jobdir))
         return
 
+    inputsize = sum(os.path.getsize(i) for i in literalfiles.values()) + sum(len(i.encode()) for i in interpolatedfiles.values())
+
+    # KiB of scratch the job is estimated to need, the program estimate is given in MiB
+    namevars.append(f'scratchneed={1024*int(config.get("scratchsize", 0)) + (inputsize + 1023)//1024}')
+    walltime = memory = None
+
+    if options.common.right_size:
+        walltime, memory = predict(settings.history, config.progname, settings.version, options.common.nproc, inputsize)
+        jobmeta.extend(sizing_meta(walltime, memory))
+        settings.sizing[jobdir] = walltime, memory
+
+    if 'step' in settings:
+        dependencies = [job.jobid for job in parentjobs.values() if job.jobid is not None]
+        if dependencies:
+            jobmeta.append(dependency_meta(dependencies))
+        settings.step.jobdirs[jobdir] = stepkey, outdir
+
+    # The history of finished jobs is built from the resources they asked for, jobq selects jobs by them too
+    with open(jobdir/'resources.json', 'w') as f:
+        json.dump(dict(program=config.progname, version=settings.version, parameters=dict(paramdict), nproc=options.common.nproc, size=inputsize, walltime=walltime, memory=memory), f)
+
+    # A stage file left by a previous run would make the job look finished
+    (jobdir/'stages.json').remove()
+    # Only a rerun of this job may pick up its checkpoint
+    (jobdir/'checkpoint').remove()
+
     jobscript = jobdir/'script'
 
     with open(jobscript, 'w') as f:
         f.write('#!/bin/bash -x' + '\n')
-        f.write(''.join(i + '\n' for i in script.meta))
+        f.write(''.join(i + '\n' for i in script.meta + jobmeta))
         f.write('shopt -s extglob nullglob' + '\n')
-        f.write(''.join(i + '\n' for i in script.vars))
+        f.write(''.join(i + '\n' for i in script.vars + namevars))
         f.write(''.join(i + '\n' for i in script.config))
-        f.write(script.makedir(settings.execdir) + '\n')
+        f.write(''.join(i + '\n' for i in script.timing))
+        f.write(''.join(i + '\n' for i in script.events))
+        f.write(''.join(i + '\n' for i in script.scratch))
+        f.write(script.makedir('$execdir') + '\n')
+        f.write('stagestart=$(date +%s.%N)' + '\n')
+        f.write('jobstart=$stagestart' + '\n')
         f.write(''.join(i + '\n' for i in imports))
-        f.write(script.chdir(settings.execdir) + '\n')
+        # The scheduler runs a requeued job from the start, the checkpoint of the interrupted run is restored
+        if restarts:
+            f.write(f'if [[ -f "{jobdir/"checkpoint"}" ]]; then' + '\n')
+            f.write(''.join('    ' + i + '\n' for i in restarts))
+            f.write('fi' + '\n')
+        f.write('stagetime imports "$(stagebytes "$execdir")"' + '\n')
+        f.write(script.chdir('$execdir') + '\n')
         f.write(''.join(i + '\n' for i in config.prescript))
-        f.write(' '.join(script.body) + '\n')
+        f.write('stagetime prescript' + '\n')
+        f.write('interrupted=' + '\n')
+        f.write(''.join(i + '\n' for i in script.traps))
+        f.write(' '.join(['"${runtimer[@]}"'] + script.body) + ' &' + '\n')
+        f.write('runpid=$!' + '\n')
+        f.write('wait $runpid' + '\n')
+        f.write('runstatus=$?' + '\n')
+        # A trapped signal interrupts the wait while the program may still be writing its restart files
+        f.write('while kill -0 $runpid 2> /dev/null; do wait $runpid; runstatus=$?; done' + '\n')
+        f.write('stagetime run' + '\n')
+        if checkpoints:
+            f.write('if [[ -n $interrupted ]]; then' + '\n')
+            f.write(''.join('    ' + i + '\n' for i in checkpoints))
+            if restarts:
+                f.write(f'    touch "{jobdir/"checkpoint"}"' + '\n')
+            f.write('    stagetime checkpoint' + '\n')
+            if restarts:
+                f.write('else' + '\n')
+                f.write(f'    rm -f "{jobdir/"checkpoint"}"' + '\n')
+            f.write('fi' + '\n')
         f.write(''.join(i + '\n' for i in config.postscript))
+        f.write('stagetime postscript' + '\n')
         f.write(''.join(i + '\n' for i in exports))
-        f.write(script.removedir(settings.execdir) + '\n')
+        f.write(f'stagetime exports "$(stagebytes {exportpaths})"' + '\n')
+        f.write('writestages stages.json' + '\n')
+        f.write(script.exportfile('$execdir/stages.json', jobdir/'stages.json') + '\n')
+        f.write(f'emitevent "$(jobevent "{outdir}" "{jobdir}" stages.json)"' + '\n')
+        f.write(script.removedir('$execdir') + '\n')
         f.write(''.join(i + '\n' for i in config.offscript))
 
+    profiling.lap('script')
+
+    # The job is recorded in the cache once the scheduler gives it an id
+    if options.common.cache and settings.batchsize and not options.debug.dry_run:
+        settings.cachekeys[jobdir] = cachekey, outdir
+
     if options.debug.dry_run:
 
         messages.success(_('Se procesó el trabajo "$jobname" y se generaron los archivos para el envío en el directorio $jobdir', jobname=jobname, jobdir=jobdir))
+        add_submitted(jobname, jobdir, None)
+
+    elif settings.batchsize:
+
+        batchjobs.append((jobname, jobdir))
+        settings.batchcontexts[jobdir] = copy_context()
+        if len(batchjobs) >= settings.batchsize:
+            submit_batch()
 
     else:
 
+        wait_delay()
+
         try:
-            delay = float(config.delay) + os.stat(paths.jobq/'lockfile').st_mtime - time.time()
-        except ValueError:
-            messages.error(_('Se esperaba un valor numérico'), f'delay={config.delay}')
-        except (FileNotFoundError) as e:
-            pass
-        else:
-            if delay > 0:
-                time.sleep(delay)
-    
-        try:
-            jobid = submitjob(jobscript)
+            jobid = retrysubmit(jobscript, jobname, attempts=1 if settings.postponed else None)
+        except TransientError as error:
+            postpone_jobs(jobscript, jobname, [(jobname, jobdir)], error)
+            return
         except RuntimeError as error:
             messages.failure(_('El gestor de trabajos reportó el siguiente error al enviar el trabajo $jobname: $error', jobname=jobname, error=error))
             return
@@ -601,5 +948,164 @@ def submit_single_job(workdir, inputname, filtergroups):
             messages.success(_('El trabajo "$jobname" se correrá en $nproc núcleo(s) en $clustername con el número $jobid', jobname=jobname, nproc=options.common.nproc, clustername=names.cluster, jobid=jobid))
             with open(jobdir/'id', 'w') as f:
                 f.write(jobid)
-            with open(paths.jobq/'lockfile', 'a'):
-                os.utime(paths.jobq/'lockfile', None)
+            index_job(jobid, jobname, jobdir)
+            report_job(jobid, jobdir)
+            if options.common.cache:
+                record_result(cachekey, jobname, outdir, jobdir, jobid, options.common.nproc)
+            add_submitted(jobname, jobdir, jobid)
+            metrics.inc('jobq_submissions_total', program=config.progname, scheduler=config.scheduler)
+            touch_lockfile()
+
+def report_job(jobid, jobdir):
+# The host that routed the job here reads its id from the output of the wrapper
+    if options.remote.report_jobs:
+        print(json.dumps(dict(jobid=jobid, jobdir=str(jobdir))), flush=True)
+
+def resolve_parameterpaths(filtergroups, paramdict):
+    parameterpaths = []
+    for path in config.parameterpaths:
+        try:
+            path = ConfigTemplate(path).safe_substitute(names)
+            path = FilterGroupTemplate(path).substitute(filtergroups)
+            path = InterpolationTemplate(path).substitute(paramdict)
+        except ValueError as e:
+            messages.error(_('La ruta $path contiene variables de interpolación inválidas', path=path), f'key={e.args[0]}')
+        except KeyError as e:
+            messages.error(_('La ruta $path contiene variables de interpolación indefinidas', path=path), f'key={e.args[0]}')
+        trunk = AbsPath()
+        for part in AbsPath(path).parts:
+            trunk.assertdir()
+            trunk = trunk/part
+        parameterpaths.append(trunk)
+    return parameterpaths
+
+def stage_inputs(literalfiles, interpolatedfiles):
+# Copy or write the input files into the output directory
+    stagingstart = time.perf_counter()
+    stagedbytes = 0
+    for destpath, litfile in literalfiles.items():
+        litfile.copyas(destpath)
+        profiling.copied(destpath)
+        stagedbytes += os.path.getsize(destpath)
+    for destpath, contents in interpolatedfiles.items():
+        with open(destpath, 'w') as f:
+            stagedbytes += f.write(contents)
+        profiling.copied(destpath)
+    if literalfiles or interpolatedfiles:
+        metrics.inc('jobq_staged_bytes_total', stagedbytes, program=config.progname)
+        metrics.observe('jobq_staging_seconds', time.perf_counter() - stagingstart, program=config.progname)
+
+def reuse_result(record, jobname, outdir, literalfiles, interpolatedfiles):
+# Link the outputs of a finished identical job into outdir, False if other results would be overwritten
+    links = {}
+    for key in config.outputfiles:
+        cachedfile = AbsPath(record['outdir'])/record['name']-key
+        if cachedfile.isfile():
+            links[outdir/jobname-key] = cachedfile
+    if not links:
+        return False
+    for destpath, cachedfile in links.items():
+        if destpath.exists() and not os.path.samefile(destpath, cachedfile):
+            return False
+    try:
+        outdir.makedirs()
+    except FileExistsError:
+        return False
+    stage_inputs(literalfiles, interpolatedfiles)
+    for destpath, cachedfile in links.items():
+        if not destpath.exists():
+            cachedfile.linkas(destpath)
+    hours = saved_hours(record)
+    settings.cachehits += 1
+    settings.savedhours += hours
+    metrics.inc('jobq_cache_hits_total', program=config.progname)
+    metrics.inc('jobq_cache_saved_core_hours_total', hours, program=config.progname)
+    messages.success(_('El trabajo "$jobname" es idéntico al trabajo terminado en $outdir, se reutilizaron sus resultados', jobname=jobname, outdir=record['outdir']))
+    return True
+
+def submit_batch():
+# Submit the pending jobs as a single array job that runs the script of each job as a task
+
+    if not batchjobs:
+        return
+
+    batchdir = paths.jobq/'batches'
+    batchdir.mkdir()
+    batchname = f'{batchjobs[0][0]}+{len(batchjobs) - 1}' if len(batchjobs) > 1 else batchjobs[0][0]
+    fd, batchscript = tempfile.mkstemp(prefix=f'{names.command}.', dir=batchdir)
+
+    with os.fdopen(fd, 'w') as f:
+        f.write('#!/bin/bash' + '\n')
+        f.write(''.join(i + '\n' for i in script.meta))
+        f.write(''.join(ConfigTemplate(i).substitute(jobname=batchname, size=len(batchjobs)) + '\n' for i in config.array))
+        if options.common.right_size:
+            # Every task gets the largest request, unless one of them has no prediction
+            walltimes, memories = zip(*(settings.sizing[jobdir] for jobname, jobdir in batchjobs))
+            f.write(''.join(i + '\n' for i in sizing_meta(None if None in walltimes else max(walltimes), None if None in memories else max(memories))))
+        f.write(f'case "{config.arraytask}" in' + '\n')
+        for i, (jobname, jobdir) in enumerate(batchjobs, start=1):
+            f.write(f'{i}) exec /bin/bash -x "{jobdir/"script"}" ;;' + '\n')
+        f.write('esac' + '\n')
+
+    profiling.lap('script')
+
+    wait_delay()
+
+    try:
+        jobid = retrysubmit(batchscript, batchname, array=True, attempts=1 if settings.postponed else None)
+    except TransientError as error:
+        postpone_jobs(batchscript, batchname, batchjobs, error, array=True)
+    except RuntimeError as error:
+        for jobname, jobdir in batchjobs:
+            job_message(jobdir, messages.failure, _('El gestor de trabajos reportó el siguiente error al enviar el trabajo $jobname: $error', jobname=jobname, error=error))
+    else:
+        for i, (jobname, jobdir) in enumerate(batchjobs, start=1):
+            taskid = ConfigTemplate(config.arrayjobid).substitute(jobid=jobid, task=i)
+            job_message(jobdir, messages.success, _('El trabajo "$jobname" se correrá en $nproc núcleo(s) en $clustername con el número $jobid', jobname=jobname, nproc=options.common.nproc, clustername=names.cluster, jobid=taskid))
+            with open(jobdir/'id', 'w') as f:
+                f.write(taskid)
+            index_job(taskid, jobname, jobdir)
+            report_job(taskid, jobdir)
+            if jobdir in settings.cachekeys:
+                cachekey, outdir = settings.cachekeys[jobdir]
+                record_result(cachekey, jobname, outdir, jobdir, taskid, options.common.nproc)
+            add_submitted(jobname, jobdir, taskid)
+        metrics.inc('jobq_submissions_total', len(batchjobs), program=config.progname, scheduler=config.scheduler)
+        touch_lockfile()
+
+    batchjobs.clear()
+    settings.batchcontexts.clear()
+    settings.cachekeys.clear()
+
+def job_message(jobdir, function, *args):
+# Show a message about a job in the context that staged it, the daemon sends it to the client that asked for the job
+    if jobdir in settings.batchcontexts:
+        settings.batchcontexts[jobdir].run(function, *args)
+    else:
+        function(*args)
+
+def postpone_jobs(jobscript, name, jobs, error, array=False):
+# Leave the jobs in the outbox, once the scheduler is known to be down the next jobs are not retried
+    postpone(jobscript, name, jobs, array)
+    settings.postponed += len(jobs)
+    metrics.inc('jobq_postponed_jobs_total', len(jobs), scheduler=config.scheduler)
+    for jobname, jobdir in jobs:
+        job_message(jobdir, messages.warning, _('El gestor de trabajos no responde, el envío del trabajo "$jobname" quedó pendiente', jobname=jobname), str(error))
+
+def wait_delay():
+# Throttle consecutive submissions according to config.delay
+    try:
+        delay = float(config.delay) + os.stat(paths.jobq/'lockfile').st_mtime - time.time()
+    except ValueError:
+        messages.error(_('Se esperaba un valor numérico'), f'delay={config.delay}')
+    except (FileNotFoundError) as e:
+        pass
+    else:
+        if delay > 0:
+            with profiling.phase('delay'):
+                time.sleep(delay)
+            metrics.inc('jobq_throttle_wait_seconds_total', delay)
+
+def touch_lockfile():
+    with open(paths.jobq/'lockfile', 'a'):
+        os.utime(paths.jobq/'lockfile', None)
@@ -96,6 +96,35 @@ def natural_sorted(*args, **kwargs):
         kwargs['key'] = lambda x: [int(c) if c.isdigit() else c.casefold() for c in re.split('(\d+)', x)]
     return sorted(*args, **kwargs)
 
+def sweep_split(value):
+# Split a comma separated list of sweep values ignoring commas inside
+# parentheses or brackets, a backslash escapes a literal comma
+    values = []
+    current = ''
+    depth = 0
+    escaped = False
+    for char in value:
+        if escaped:
+            current += char
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == ',' and depth == 0:
+            values.append(current)
+            current = ''
+        else:
+            if char in '([{':
+                depth += 1
+            elif char in ')]}' and depth > 0:
+                depth -= 1
+            current += char
+    values.append(current)
+    return list(dict.fromkeys(values))
+
+def sweep_tag(value):
+# Turn a sweep value into a string that is safe for file names
+    return re.sub(r'[^A-Za-z0-9.+-]+', '-', value).strip('-') or '-'
+
 def option(key, value=None):
     if value is None:
         return('--{}'.format(key.replace('_', '-')))
@@ -0,0 +1,109 @@
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+eventheader = struct.Struct('iIII')
+
+class InotifyWatcher:
+# Report the files closed after writing or moved into the directories
+    def __init__(self, directories):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        try:
+            self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        self.directories = {}
+        for directory in directories:
+            wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                os.close(self.fd)
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), directory)
+            self.directories[wd] = directory
+        self.lastread = time.time_ns()
+    def read(self, timeout=None):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        since = self.lastread
+        self.lastread = time.time_ns()
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = eventheader.unpack_from(data, offset)
+            offset += eventheader.size
+            name = data[offset:offset+length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped, the files written since the last read are found by their modification time
+                events.extend(self.rescan(since))
+            elif wd in self.directories and name:
+                events.append((self.directories[wd], os.fsdecode(name)))
+        return events
+    def rescan(self, since):
+        events = []
+        for directory in self.directories.values():
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file() and entry.stat().st_mtime_ns >= since:
+                        events.append((directory, entry.name))
+        return events
+
+class PollingWatcher:
+# Report the new or rewritten files whose size and modification time did not change between two polls
+    def __init__(self, directories, interval):
+        self.directories = directories
+        self.interval = interval
+        self.reported = {directory: self.signatures(directory) for directory in directories}
+        self.growing = {}
+    def signatures(self, directory):
+        signatures = {}
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    signatures[entry.name] = (stat.st_mtime_ns, stat.st_size)
+        return signatures
+    def read(self, timeout=None):
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        events = []
+        for directory in self.directories:
+            current = self.signatures(directory)
+            # A removed file is new again when it is written back
+            for name in set(self.reported[directory]) - set(current):
+                del self.reported[directory][name]
+            for name, signature in current.items():
+                if self.reported[directory].get(name) == signature:
+                    continue
+                path = os.path.join(directory, name)
+                if self.growing.get(path) == signature:
+                    del self.growing[path]
+                    self.reported[directory][name] = signature
+                    events.append((directory, name))
+                else:
+                    self.growing[path] = signature
+        return events
+
+def open_watcher(directories, interval=None):
+# Use inotify unless polling is requested or inotify is not available
+    if interval is None:
+        try:
+            return InotifyWatcher(directories)
+        except OSError:
+            interval = 5.0
+    return PollingWatcher(directories, interval)
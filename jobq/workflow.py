@@ -0,0 +1,52 @@
+import re
+from clinterface import messages, _
+from .shared import config
+from .utils import ConfigTemplate
+from .json5 import json5_load
+
+def load_workflow(path):
+# Steps of the workflow file in an order where every step comes after its parents
+    steps = json5_load(path)
+    if not isinstance(steps, dict) or not steps:
+        messages.error(_('El flujo de trabajo $path no tiene pasos', path=path))
+    for name, step in steps.items():
+        if not re.fullmatch(r'[A-Za-z0-9][A-Za-z0-9_-]*', name):
+            messages.error(_('El nombre del paso $step no es válido', step=name), f'workflow={path}')
+        after = step.get('after', [])
+        step['after'] = [after] if isinstance(after, str) else list(after)
+        step['args'] = [str(i) for i in step.get('args', [])]
+        step['stage'] = dict(step.get('stage', {}))
+        for key, source in step['stage'].items():
+            parent, dot, parentkey = source.partition('.')
+            if key not in config.filekeys:
+                messages.error(_('El paso $step copia un archivo desconocido', step=name), f'stage[{key}]={source}')
+            if parent not in steps or parentkey not in config.outputfiles:
+                messages.error(_('El paso $step copia un archivo que ningún paso produce', step=name), f'stage[{key}]={source}')
+            # Staging from a step implies waiting for it
+            if parent not in step['after']:
+                step['after'].append(parent)
+        for parent in step['after']:
+            if parent not in steps:
+                messages.error(_('El paso $step depende de un paso que no existe', step=name), f'after={parent}')
+    ordered = []
+    visiting = set()
+    def visit(name):
+        if name in ordered:
+            return
+        if name in visiting:
+            messages.error(_('El flujo de trabajo $path tiene una dependencia circular', path=path), f'step={name}')
+        visiting.add(name)
+        for parent in steps[name]['after']:
+            visit(parent)
+        visiting.discard(name)
+        ordered.append(name)
+    for name in steps:
+        visit(name)
+    return [(name, steps[name]) for name in ordered]
+
+def dependency_meta(jobids):
+# Scheduler directive that holds a job until all of jobids finish successfully
+    if 'dependency' not in config:
+        messages.error(_('El gestor de trabajos no soporta dependencias entre trabajos'))
+    items = [ConfigTemplate(config.get('dependencyitem', '&jobid')).substitute(jobid=jobid) for jobid in jobids]
+    return ConfigTemplate(config.dependency).substitute(jobids=config.get('dependencyjoin', ':').join(items))
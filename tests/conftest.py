@@ -0,0 +1,15 @@
+import os
+import sys
+import pytest
+
+# The tests import jobq and the fake scheduler commands of the benchmarks from the source tree
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from jobq.shared import currentstate
+
+@pytest.fixture(autouse=True)
+def fresh_state():
+# Every test starts with its own runtime state
+    token = currentstate.set(None)
+    yield
+    currentstate.reset(token)
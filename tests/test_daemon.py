@@ -0,0 +1,67 @@
+import json
+import socket
+import threading
+from unittest import mock
+from jobq import client
+from jobq.daemon import Coalescer, Client, RelayedPrompt, output
+
+def add_all(coalescer, requests, flush):
+# Add every (key, item) from its own thread and return the results in the same order
+    results = [None]*len(requests)
+    def add(i, key, item):
+        results[i] = coalescer.add(key, item, flush)
+    threads = [threading.Thread(target=add, args=(i, key, item)) for i, (key, item) in enumerate(requests)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+def test_requests_within_the_window_are_grouped():
+    batches = []
+    def flush(items):
+        batches.append(sorted(items))
+        return len(items)
+    results = add_all(Coalescer(0.2), [('a', 1), ('a', 2), ('b', 3), ('a', 4)], flush)
+    assert sorted(batches) == [[1, 2, 4], [3]]
+    assert results == [3, 3, 1, 3]
+
+def test_later_requests_start_a_new_group():
+    batches = []
+    def flush(items):
+        batches.append(items)
+    coalescer = Coalescer(0.01)
+    coalescer.add('a', 1, flush)
+    coalescer.add('a', 2, flush)
+    assert batches == [[1], [2]]
+
+def test_failing_flush_releases_the_callers():
+    def flush(items):
+        raise RuntimeError('scheduler down')
+    with mock.patch.object(threading, 'excepthook'):
+        results = add_all(Coalescer(0.05), [('a', 1), ('a', 2)], flush)
+    assert results == [None, None]
+
+def test_prompts_are_answered_by_the_client():
+    server, other = socket.socketpair()
+    answers = []
+    def serve():
+        with server, server.makefile('rb') as rfile, server.makefile('wb') as wfile:
+            request = json.loads(rfile.readline())
+            relay = Client(rfile, wfile)
+            output.set([relay])
+            prompt = RelayedPrompt('completer')
+            prompt.set_truthy_options(['si'])
+            prompt.set_falsy_options(['no'])
+            prompt.set_message(request['question'])
+            answers.append(prompt.binary_choice())
+            relay.send(status=0, result=None)
+    thread = threading.Thread(target=serve)
+    thread.start()
+    with mock.patch.object(client, 'answer', side_effect=lambda prompt: prompt['message'] == 'continue?') as answer:
+        assert client.request(other, question='continue?') == (0, None)
+    thread.join(5)
+    assert answers == [True]
+    prompt = answer.call_args[0][0]
+    assert prompt['method'] == 'binary_choice'
+    assert prompt['truthy'] == ['si']
@@ -0,0 +1,30 @@
+import pytest
+from jobq.fileutils import read_manifest
+
+def write(tmp_path, data):
+    path = tmp_path/'manifest'
+    path.write_bytes(data)
+    return str(path)
+
+def test_newline_separated(tmp_path):
+    path = write(tmp_path, b'a.gjf\nb.gjf\n\nc.gjf')
+    assert list(read_manifest(path)) == ['a.gjf', 'b.gjf', 'c.gjf']
+
+def test_crlf(tmp_path):
+    path = write(tmp_path, b'a.gjf\r\nb.gjf\r\n')
+    assert list(read_manifest(path)) == ['a.gjf', 'b.gjf']
+
+def test_nul_separated_keeps_newlines(tmp_path):
+    path = write(tmp_path, b'a b.gjf\0c\nd.gjf\0')
+    assert list(read_manifest(path)) == ['a b.gjf', 'c\nd.gjf']
+
+@pytest.mark.parametrize('chunksize', [1, 2, 3, 5, 7])
+def test_chunk_boundaries(tmp_path, chunksize):
+    entries = ['first.gjf', 'second.gjf', 'third.gjf']
+    for separator in (b'\n', b'\r\n', b'\0'):
+        path = write(tmp_path, separator.join(i.encode() for i in entries) + separator)
+        assert list(read_manifest(path, chunksize=chunksize)) == entries
+
+def test_non_utf8_names(tmp_path):
+    path = write(tmp_path, b'caf\xe9.gjf\n')
+    assert [i.encode('utf-8', 'surrogateescape') for i in read_manifest(path)] == [b'caf\xe9.gjf']
@@ -0,0 +1,102 @@
+import os
+import time
+import pytest
+from unittest import mock
+from jobq import queue
+from jobq.shared import config, get_state
+from jobq.json5 import json5_load
+from jobq.fileutils import AbsPath
+from jobq.queue import retrysubmit, findjob, TransientError, unsuremessage
+from benchmarks.fakes import install_fakes, fake_env
+
+specdir = AbsPath(os.path.dirname(queue.__file__))/'specfiles'/'schedulers'
+
+@pytest.fixture
+def scheduler(tmp_path):
+# Load the Slurm specfile with the fake sbatch and squeue first in PATH, the returned function sets their behavior
+    bindir = str(tmp_path/'bin')
+    install_fakes(bindir)
+    config.update(json5_load(specdir/'slurm.json'))
+    config.submitbackoff = 0
+    jobscript = tmp_path/'script'
+    jobscript.write_text('#!/bin/bash\n')
+    def behave(**settings):
+        get_state().environment = fake_env(bindir, str(tmp_path), **settings)
+        return str(jobscript)
+    return behave
+
+def squeue_line(jobid, submit):
+    return f'{jobid} {time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(submit))}'
+
+def test_submit(scheduler):
+    jobscript = scheduler(failures=0)
+    assert retrysubmit(jobscript, 'job') == '1001'
+    assert retrysubmit(jobscript, 'job') == '1002'
+
+def test_transient_errors_are_retried(scheduler):
+    jobscript = scheduler(failures=1000)
+    config.unsureerrors = []
+    config.transienterrors = ['Socket timed out']
+    with mock.patch.object(queue, 'submitjob', wraps=queue.submitjob) as submitjob:
+        with pytest.raises(TransientError) as error:
+            retrysubmit(jobscript, 'job', attempts=3)
+    assert submitjob.call_count == 3
+    assert unsuremessage not in str(error.value)
+
+def test_permanent_errors_are_not_retried(scheduler):
+    jobscript = scheduler(failures=1000)
+    config.unsureerrors = []
+    config.transienterrors = []
+    with mock.patch.object(queue, 'submitjob', wraps=queue.submitjob) as submitjob:
+        with pytest.raises(RuntimeError) as error:
+            retrysubmit(jobscript, 'job', attempts=3)
+    assert submitjob.call_count == 1
+    assert not isinstance(error.value, TransientError)
+
+def test_unsure_submission_is_found(scheduler):
+    # The reply was lost but the scheduler accepted the job
+    jobscript = scheduler(failures=1000, state=squeue_line(1234, time.time()))
+    with mock.patch.object(queue, 'submitjob', wraps=queue.submitjob) as submitjob:
+        assert retrysubmit(jobscript, 'job', attempts=3) == '1234'
+    assert submitjob.call_count == 1
+
+def test_unsure_submission_is_retried_when_not_found(scheduler):
+    # Only a job of an older submission has the same name
+    jobscript = scheduler(failures=1000, state=squeue_line(1234, time.time() - 3600))
+    with mock.patch.object(queue, 'submitjob', wraps=queue.submitjob) as submitjob:
+        with pytest.raises(RuntimeError) as error:
+            retrysubmit(jobscript, 'job', attempts=3)
+    assert submitjob.call_count == 3
+    assert unsuremessage in str(error.value)
+
+def test_unsure_submission_is_not_postponed(scheduler):
+    # The queue cannot be checked, a postponed job could run twice
+    jobscript = scheduler(failures=1000, state='')
+    with pytest.raises(RuntimeError) as error:
+        retrysubmit(jobscript, 'job', attempts=2)
+    assert not isinstance(error.value, TransientError)
+    assert unsuremessage in str(error.value)
+
+def test_unsure_submission_without_findcmd(scheduler):
+    jobscript = scheduler(failures=1000)
+    del config['findcmd']
+    with mock.patch.object(queue, 'submitjob', wraps=queue.submitjob) as submitjob:
+        with pytest.raises(RuntimeError) as error:
+            retrysubmit(jobscript, 'job', attempts=3)
+    assert submitjob.call_count == 1
+    assert unsuremessage in str(error.value)
+
+def test_findjob(scheduler):
+    now = time.time()
+    scheduler(state='\n'.join([squeue_line(1, now - 3600), 'garbage', squeue_line('2_[1-4]', now)]))
+    assert findjob('job', now) == '2'
+    scheduler(state=squeue_line(1, now - 3600))
+    assert findjob('job', now) is None
+    # A controller clock a few seconds behind is tolerated
+    scheduler(state=squeue_line(3, now - 5))
+    assert findjob('job', now) == '3'
+
+def test_findjob_error(scheduler):
+    scheduler(state='')
+    with pytest.raises(TransientError):
+        findjob('job', time.time())
@@ -0,0 +1,25 @@
+import pytest
+from jobq.utils import sweep_split, sweep_tag
+
+@pytest.mark.parametrize('value, expected', [
+    ('b3lyp', ['b3lyp']),
+    ('0.1,0.2,0.3', ['0.1', '0.2', '0.3']),
+    ('b3lyp,,pbe0', ['b3lyp', '', 'pbe0']),
+    ('f(1,2),g[3,4],{5,6}', ['f(1,2)', 'g[3,4]', '{5,6}']),
+    ('a(b,(c,d)),e', ['a(b,(c,d))', 'e']),
+    (r'1\,5,2', ['1,5', '2']),
+    (r'a\\,b', ['a\\', 'b']),
+    ('x),y', ['x)', 'y']),
+    ('a,b,a', ['a', 'b']),
+])
+def test_sweep_split(value, expected):
+    assert sweep_split(value) == expected
+
+@pytest.mark.parametrize('value, expected', [
+    ('0.25', '0.25'),
+    ('6-31+G(d,p)', '6-31+G-d-p'),
+    ('/opt/basis sets/', 'opt-basis-sets'),
+    ('***', '-'),
+])
+def test_sweep_tag(value, expected):
+    assert sweep_tag(value) == expected
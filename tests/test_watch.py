@@ -0,0 +1,61 @@
+import os
+from jobq.watch import PollingWatcher
+
+def write(path, text, mtime=None):
+    with open(path, 'w') as f:
+        f.write(text)
+    if mtime is not None:
+        os.utime(path, ns=(mtime, mtime))
+
+def test_existing_files_are_not_reported(tmp_path):
+    write(tmp_path/'old.gjf', 'old')
+    watcher = PollingWatcher([str(tmp_path)], 0)
+    assert watcher.read() == []
+    assert watcher.read() == []
+
+def test_new_file_is_reported_once_stable(tmp_path):
+    watcher = PollingWatcher([str(tmp_path)], 0)
+    write(tmp_path/'new.gjf', 'new')
+    assert watcher.read() == []
+    assert watcher.read() == [(str(tmp_path), 'new.gjf')]
+    assert watcher.read() == []
+
+def test_growing_file_waits(tmp_path):
+    watcher = PollingWatcher([str(tmp_path)], 0)
+    write(tmp_path/'big.gjf', 'a', mtime=1)
+    assert watcher.read() == []
+    write(tmp_path/'big.gjf', 'ab', mtime=2)
+    assert watcher.read() == []
+    assert watcher.read() == [(str(tmp_path), 'big.gjf')]
+
+def test_rewritten_file_is_reported_again(tmp_path):
+    write(tmp_path/'job.gjf', 'first', mtime=1)
+    watcher = PollingWatcher([str(tmp_path)], 0)
+    write(tmp_path/'job.gjf', 'second', mtime=2)
+    watcher.read()
+    assert watcher.read() == [(str(tmp_path), 'job.gjf')]
+
+def test_removed_file_is_new_when_written_back(tmp_path):
+    write(tmp_path/'job.gjf', 'same', mtime=1)
+    watcher = PollingWatcher([str(tmp_path)], 0)
+    os.remove(tmp_path/'job.gjf')
+    assert watcher.read() == []
+    write(tmp_path/'job.gjf', 'same', mtime=1)
+    watcher.read()
+    assert watcher.read() == [(str(tmp_path), 'job.gjf')]
+
+def test_several_directories(tmp_path):
+    first, second = tmp_path/'first', tmp_path/'second'
+    first.mkdir()
+    second.mkdir()
+    watcher = PollingWatcher([str(first), str(second)], 0)
+    write(first/'a.gjf', 'a')
+    write(second/'b.gjf', 'b')
+    watcher.read()
+    assert sorted(watcher.read()) == [(str(first), 'a.gjf'), (str(second), 'b.gjf')]
+
+def test_directories_are_not_reported(tmp_path):
+    watcher = PollingWatcher([str(tmp_path)], 0)
+    (tmp_path/'subdir').mkdir()
+    watcher.read()
+    assert watcher.read() == []
@@ -0,0 +1,76 @@
+import os
+import numpy
+import pytest
+from jobq import readmol
+from jobq.shared import paths
+from jobq.fileutils import AbsPath
+from jobq.readmol import xyzindex, readxyzframe
+
+def frame(natom, shift):
+    lines = [str(natom), f'frame {shift}']
+    lines.extend(f'H {shift:.1f} {i:.1f} 0.0' for i in range(natom))
+    return ''.join(line + '\n' for line in lines)
+
+@pytest.fixture
+def trajectory(tmp_path):
+    # Frames of the same size take the fast path, the last one does not
+    frames = [frame(2, 0), frame(2, 1), frame(2, 2), frame(3, 3)]
+    path = tmp_path/'traj.xyz'
+    path.write_text(''.join(frames))
+    offsets = [0]
+    for text in frames[:-1]:
+        offsets.append(offsets[-1] + len(text))
+    return AbsPath(str(path)), offsets
+
+@pytest.fixture
+def jobqdir(tmp_path, monkeypatch):
+    paths.jobq = AbsPath(str(tmp_path/'jobq'))
+    # Index every file regardless of its size
+    monkeypatch.setattr(readmol, 'indexminsize', 0)
+    return tmp_path/'jobq'/'xyzindex'
+
+def test_offsets(trajectory):
+    molfile, offsets = trajectory
+    assert list(xyzindex(molfile)) == offsets
+
+def test_missing_final_newline(tmp_path):
+    path = tmp_path/'last.xyz'
+    path.write_text(frame(1, 0) + frame(1, 1).rstrip('\n'))
+    molfile = AbsPath(str(path))
+    offsets = xyzindex(molfile)
+    assert len(offsets) == 2
+    assert readxyzframe(molfile, offsets[1]).coords[0, 0] == 1.0
+
+def test_read_frames(trajectory):
+    molfile, offsets = trajectory
+    for shift, offset in enumerate(xyzindex(molfile)):
+        coords = readxyzframe(molfile, offset).coords
+        assert numpy.all(coords[:, 0] == shift)
+    assert len(readxyzframe(molfile, offsets[-1])) == 3
+
+def test_truncated_frame(tmp_path):
+    path = tmp_path/'broken.xyz'
+    path.write_text(frame(2, 0) + '5\ntitle\nH 0 0 0\n')
+    with pytest.raises(SystemExit):
+        xyzindex(AbsPath(str(path)))
+
+def test_small_files_are_not_indexed(trajectory, jobqdir, monkeypatch):
+    monkeypatch.setattr(readmol, 'indexminsize', 1 << 20)
+    molfile, offsets = trajectory
+    xyzindex(molfile)
+    assert not jobqdir.exists()
+
+def test_index_is_reused(trajectory, jobqdir, monkeypatch):
+    molfile, offsets = trajectory
+    assert list(xyzindex(molfile)) == offsets
+    assert len(os.listdir(jobqdir)) == 1
+    # A valid index is read without opening the trajectory through mmap
+    monkeypatch.setattr(readmol.mmap, 'mmap', None)
+    assert list(xyzindex(molfile)) == offsets
+
+def test_index_is_rebuilt_when_the_file_changes(trajectory, jobqdir):
+    molfile, offsets = trajectory
+    xyzindex(molfile)
+    with open(molfile, 'a') as f:
+        f.write(frame(1, 4))
+    assert len(xyzindex(molfile)) == len(offsets) + 1